@@ -0,0 +1,129 @@
+# In process camera capture.
+#
+# CameraCapture keeps the video device open between pictures (OpenCV's V4L2 backend) so that a
+# picture does not pay for starting fswebcam, opening the device and negotiating the video format.
+# When an average of several frames is wanted the frames are summed in place into one numpy
+# array and the JPEG is written directly from it.
+#
+# OpenCV (cv2) and numpy are optional. If they are not installed, or the device can't be read,
+# capture returns False and the camera controller falls back to fswebcam.
+#
+
+from sys import exc_info
+from threading import Lock
+
+from python.logger import get_sub_logger
+
+logger = get_sub_logger(__name__)
+
+try:
+    import cv2
+    import numpy
+except ImportError:
+    cv2 = None
+    numpy = None
+
+class CameraCapture():
+
+    def __init__(self, device=0, resolution=(1280, 720), fps=60, average_frames=60, jpeg_quality=90,
+                 flush_frames=4):
+
+        self.device = device
+        self.average_frames = average_frames
+        self.resolution = resolution
+        self.fps = fps
+        self.jpeg_quality = jpeg_quality
+
+        # The driver keeps filling its buffers while the device is open so the first few
+        # frames of a capture can be stale. They are skipped.
+        self.flush_frames = flush_frames
+
+        self.cap = None
+        self.lock = Lock()
+
+    def available(self):
+        return cv2 is not None
+
+    def open(self):
+
+        if self.cap is not None:
+            return True
+
+        if cv2 is None:
+            return False
+
+        try:
+            cap = cv2.VideoCapture(self.device)
+            if not cap.isOpened():
+                logger.error('cannot open camera device {}'.format(self.device))
+                return False
+
+            cap.set(cv2.CAP_PROP_FRAME_WIDTH, self.resolution[0])
+            cap.set(cv2.CAP_PROP_FRAME_HEIGHT, self.resolution[1])
+            cap.set(cv2.CAP_PROP_FPS, self.fps)
+            cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+
+            logger.info('opened camera device {} at {}x{}'.format(self.device,
+                        int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))))
+            self.cap = cap
+            return True
+        except:
+            logger.error('cannot open camera device {}: {}, {}'.format(self.device, exc_info()[0], exc_info()[1]))
+            return False
+
+    def close(self):
+
+        with self.lock:
+            if self.cap is not None:
+                self.cap.release()
+                self.cap = None
+
+    def capture(self, file_location, frames=1):
+        """ Save the average of frames frames as a JPEG at file_location. Returns True on success. """
+
+        with self.lock:
+
+            if not self.open():
+                return False
+
+            try:
+                for i in range(self.flush_frames):
+                    self.cap.grab()
+
+                total = None
+                count = 0
+
+                for i in range(frames):
+                    ok, frame = self.cap.read()
+                    if not ok:
+                        continue
+                    if total is None:
+                        total = frame.astype(numpy.float32)
+                    else:
+                        numpy.add(total, frame, out=total)
+                    count += 1
+
+                if count == 0:
+                    # The device may have gone away. Open it again next time.
+                    logger.error('camera device {} returned no frames'.format(self.device))
+                    self.cap.release()
+                    self.cap = None
+                    return False
+
+                if count < frames:
+                    logger.warning('camera device {} returned {} of {} frames'.format(self.device, count, frames))
+
+                # total / count, rounded, in place.
+                numpy.multiply(total, 1.0 / count, out=total)
+                numpy.add(total, 0.5, out=total)
+
+                if cv2.imwrite(file_location, total.astype(numpy.uint8),
+                               [int(cv2.IMWRITE_JPEG_QUALITY), self.jpeg_quality]):
+                    return True
+
+                logger.error('cannot write camera image {}'.format(file_location))
+                return False
+
+            except:
+                logger.error('camera capture error: {}, {}'.format(exc_info()[0], exc_info()[1]))
+                return False
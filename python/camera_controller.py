@@ -1,24 +1,109 @@
 # fopd resource
-
-from os import getcwd, path as os_path
-from datetime import datetime
+#
+# Optional args:
+#   take_an_average    - average several frames to hide flickering lights (default False).
+#   capture_backend    - 'fswebcam' (default) runs fswebcam for every picture. 'opencv' keeps the camera
+#                        open and captures in process (needs OpenCV and numpy) and falls back to fswebcam
+#                        if the camera can't be read that way.
+#   capture_device     - opencv: the video device number (default 0, i.e. /dev/video0).
+#   capture_resolution - opencv: (width, height) (default (1280, 720)).
+#   capture_fps        - opencv: frames per second (default 60).
+#   average_frames     - opencv: the number of frames averaged when take_an_average is True (default 60).
+#   jpeg_quality       - opencv: 0 to 100 (default 90).
+#   dedupe_max_distance - skip a scheduled picture if its perceptual hash differs from the last kept
+#                        picture's in this many bits or fewer (e.g. 4). The picture is deleted and not
+#                        sent to the subscribers. Needs Pillow. Default None (keep every picture).
+#   timelapse_args     - make a time-lapse video of the previous (UTC) day's pictures every day, e.g.
+#                        {'hour':1, 'fps':10, 'format':'mp4', 'subscribers':('image_uploader',)}. hour is local
+#                        time and should be before the 9 am picture clean up. The video is handed to the
+#                        named subscribers. Needs ffmpeg. Default None (no daily time-lapse).
+#                        Videos older than timelapse_args['max_day_age'] days (default 7) are deleted
+#                        when the next one is made.
+#   subscriber_workers - the most subscribers that are sent a picture at the same time (default 2).
+#   subscriber_queue_size - the most pictures waiting for each subscriber (default 10).
+#   subscriber_max_retries - retry a subscriber's failed delivery this many times (default 5).
+#   subscriber_retry_delay - wait this many seconds before the first retry, doubling for every
+#                        retry after that (default 30) up to subscriber_max_retry_delay (default 3600).
+#
+# Pictures are handed to the subscribers on worker threads (see camera_subscribers/dispatcher.py).
+#
+
+from os import getcwd, path as os_path, remove
+from datetime import datetime, timedelta
 from time import sleep
 from subprocess import check_call, CalledProcessError, run, PIPE, STDOUT
 from sys import path, exc_info
 from shutil import copyfile
-from threading import Lock
+from threading import Lock, Thread
 
-from python.data_file_paths import camera_image_directory
+from python.camera_capture import CameraCapture
+from python.data_file_paths import camera_image_directory, timelapse_directory
+from python.image_pipeline import hash_distance, picture_hash
+from python.camera_subscribers.dispatcher import SubscriberDispatcher
 from python.camera_subscribers.make_subscriber import get_camera_subscribers
 from python.logger import get_sub_logger 
 from python.LogFileEntryTable import LogFileEntryTable
+from python.timelapse import delete_old_timelapses, make_timelapse
 
 logger = get_sub_logger(__name__)
 log_entry_table = LogFileEntryTable(60*60)
 
 camera_lock = Lock()
 
-def snap(repl: 'fop repl monitor', pose_on_cmd: 'fop command', pose_off_cmd: 'fop command', take_an_average: bool) -> 'file_path':
+def fswebcam_snap(file_location, take_an_average):
+
+    #Note: A client had issues with the camera images having dark bands. We think this is because
+    #      the lights they were using are flickering at 60 HZ. The fswebcam args -fps 60 
+    #      -frames 60 reduces the banding considerably. The take_an_average boolean is sourced
+    #      from the configuration file.
+    #
+    if take_an_average:
+        camera_shell_command = 'fswebcam -r 1280x720 --no-banner --timestamp --fps 60 --frames 60'\
+                             + ' --verbose  --save {}'.format(file_location)
+    else:
+        camera_shell_command = 'fswebcam -r 1280x720 --no-banner --timestamp "%d-%m-%Y %H:%M:%S (%Z)"'\
+                             + ' --verbose  --save {}'.format(file_location)
+
+    logger.debug('Preparing to run shell command: {}'.format(camera_shell_command))
+
+    try:
+        # Take the picture
+        # Figure out if you can suppress fswebcam's output or take the picture using native python code.
+        #- picture_results = check_call(camera_shell_command, shell=True)
+        #TBD - refactor to run as shell=False. This will make the sytem safer against injection
+        # attacks.
+        picture_results = run(camera_shell_command, stdout=PIPE, stderr=PIPE, shell=True, check=False)
+
+        if picture_results.returncode == 0:
+                
+            if len(picture_results.stderr) != 0:
+                logger.debug('---stderr: {}: '.format(picture_results.stderr.decode('ascii')))
+
+            logger.debug('fsweb command success. See the following lines for more info:')
+            logger.debug('---return code: {} ...'.format(picture_results.returncode))
+            logger.debug('---args: {} ...'.format(picture_results.args))
+            logger.debug('---stdout: {}'.format(picture_results.stdout.decode('ascii')))
+
+            return file_location
+
+        else:
+           logger.error('fsweb command failed. See following lines for more info:')
+           logger.error('---return code: {}'.format(picture_results.returncode))
+           logger.error('---stderr: {}'.format(picture_results.stderr.decode('ascii')))
+           logger.error('---args: {}'.format(picture_results.args))
+           logger.error('---stdout: {}'.format(picture_results.stdout.decode('ascii')))
+           return None
+
+    except CalledProcessError as e:
+        logger.error('fswebcam call failed with the following results: {}: {}'.format(\
+                           exc_info()[0], exc_info()[1]))
+        return None
+    except:
+        logger.error('Camera error: {}: {}'.format(exc_info()[0], exc_info()[1]))
+        return None
+
+def snap(repl: 'fop repl monitor', pose_on_cmd: 'fop command', pose_off_cmd: 'fop command', take_an_average: bool,
+         capture: 'CameraCapture' = None) -> 'file_path':
 
     # Wait for camera to become available.
     camera_lock.acquire()
@@ -32,55 +117,13 @@ def snap(repl: 'fop repl monitor', pose_on_cmd: 'fop command', pose_off_cmd: 'fo
         file_name = '{:%Y%m%d_%H_%M_%S}.jpg'.format(datetime.utcnow())
         file_location = os_path.join(camera_image_directory, file_name)
 
-        #Note: A client had issues with the camera images having dark bands. We think this is because
-        #      the lights they were using are flickering at 60 HZ. The fswebcam args -fps 60 
-        #      -frames 60 reduces the banding considerably. The take_an_average boolean is sourced
-        #      from the configuration file.
-        #
-        if take_an_average:
-            camera_shell_command = 'fswebcam -r 1280x720 --no-banner --timestamp --fps 60 --frames 60'\
-                                 + ' --verbose  --save {}'.format(file_location)
-        else:
-            camera_shell_command = 'fswebcam -r 1280x720 --no-banner --timestamp "%d-%m-%Y %H:%M:%S (%Z)"'\
-                                 + ' --verbose  --save {}'.format(file_location)
+        # Use the in process capture engine if there is one. Averaging its frames has the same
+        # effect on flickering lights as fswebcam's --frames option.
+        if capture and capture.capture(file_location, capture.average_frames if take_an_average else 1):
+            return file_location
 
-        logger.debug('Preparing to run shell command: {}'.format(camera_shell_command))
-
-        try:
-            # Take the picture
-            # Figure out if you can suppress fswebcam's output or take the picture using native python code.
-            #- picture_results = check_call(camera_shell_command, shell=True)
-            #TBD - refactor to run as shell=False. This will make the sytem safer against injection
-            # attacks.
-            picture_results = run(camera_shell_command, stdout=PIPE, stderr=PIPE, shell=True, check=False)
+        return fswebcam_snap(file_location, take_an_average)
 
-            if picture_results.returncode == 0:
-                    
-                if len(picture_results.stderr) != 0:
-                    logger.debug('---stderr: {}: '.format(picture_results.stderr.decode('ascii')))
-
-                logger.debug('fsweb command success. See the following lines for more info:')
-                logger.debug('---return code: {} ...'.format(picture_results.returncode))
-                logger.debug('---args: {} ...'.format(picture_results.args))
-                logger.debug('---stdout: {}'.format(picture_results.stdout.decode('ascii')))
-
-                return file_location
-
-            else:
-               logger.error('fsweb command failed. See following lines for more info:')
-               logger.error('---return code: {}'.format(picture_results.returncode))
-               logger.error('---stderr: {}'.format(picture_results.stderr.decode('ascii')))
-               logger.error('---args: {}'.format(picture_results.args))
-               logger.error('---stdout: {}'.format(picture_results.stdout.decode('ascii')))
-               return None
-
-        except CalledProcessError as e:
-            logger.error('fswebcam call failed with the following results: {}: {}'.format(\
-                               exc_info()[0], exc_info()[1]))
-            return None
-        except:
-            logger.error('Camera error: {}: {}'.format(exc_info()[0], exc_info()[1]))
-            return None
     finally:
         # TODO: Track down the official documentation on this and replace the following with it.
         # According to someone on stack overflow: The finally clause is also executed “on the way out” 
@@ -103,24 +146,29 @@ def make_help(args):
         s = s + "{}.snap()                 - Takes a picture and returns the location of the file.\n".format(prefix)
         s = s + "{}.show_subs()            - Display a list of the Camera Subscribers.\n".format(prefix)
         s = s + "{}.update(sub)            - Takes a picture and sends it to the subscriber indicated by target.\n".format(prefix)
-        s = s + "                          - Example: {}.update('LocalWebServer')".format(prefix)
+        s = s + "                          - Example: {}.update('LocalWebServer')\n".format(prefix)
+        s = s + "{}.sub_stats()            - Show the deliveries, failures and latency of each subscriber.\n".format(prefix)
+        s = s + "{}.timelapse(start, end=None, fps=10, video_format='mp4'|'webp')\n".format(prefix)
+        s = s + "                          - Make a time-lapse video of the pictures taken from start up to end\n"
+        s = s + "                            (UTC) and return its location. Example: {}.timelapse('20181017', '20181018')".format(prefix)
         
         return s
 
     return help
 
 
-def make_update(app_state, args, camera_subscribers: list, take_an_average: bool):
+def make_update(app_state, args, camera_subscribers: list, take_an_average: bool, capture, dispatcher):
 
     def update(sub):
         logger.info('got here')
 
         for s in camera_subscribers:
             if s.name.lower() == sub.lower():          
-                file_location = snap(app_state['sys']['cmd'], args['pose_on_cmd'], args['pose_off_cmd'], take_an_average)
+                file_location = snap(app_state['sys']['cmd'], args['pose_on_cmd'], args['pose_off_cmd'], take_an_average,
+                                     capture)
                 if file_location == None:
                     return 'Cannot take a picture'
-                s.new_picture(file_location)
+                dispatcher.dispatch(s, file_location)
                 return 'OK'
 
         return 'Cannot find the subscriber. Try running {}.show_subs()'.format(args['name'])
@@ -128,6 +176,30 @@ def make_update(app_state, args, camera_subscribers: list, take_an_average: bool
     return update
 
 
+def make_timelapse_cmd():
+
+    def timelapse(start, end=None, fps=10, video_format='mp4'):
+
+        video = make_timelapse(camera_image_directory, timelapse_directory, start, end, fps, video_format)
+        if video is None:
+            return 'Cannot make the time-lapse. See the log for details.'
+        return video
+
+    return timelapse
+
+def run_daily_timelapse(timelapse_args, dispatcher, camera_subscribers):
+
+    delete_old_timelapses(timelapse_directory, timelapse_args.get('max_day_age', 7))
+
+    now = datetime.utcnow()
+    video = make_timelapse(camera_image_directory, timelapse_directory, (now - timedelta(days=1)).strftime('%Y%m%d'),
+                           now.strftime('%Y%m%d'), timelapse_args.get('fps', 10), timelapse_args.get('format', 'mp4'))
+
+    if video:
+        for s in camera_subscribers:
+            if s.name in timelapse_args.get('subscribers', ()):
+                dispatcher.dispatch(s, video)
+
 def make_show_subs(camera_subscribers):
 
     def show_subs():
@@ -142,66 +214,160 @@ def make_show_subs(camera_subscribers):
     return show_subs
 
 
-def start(app_state, args, b):
+def init(app_state, args):
 
     logger.setLevel(args['log_level'])
     logger.info('Starting camera controller.')
 
-    state = {'startup':True, 'daily_archive_has_run':False}
+    state = {'startup':True, 'daily_archive_has_run':False, 'daily_timelapse_has_run':False, 'capture':None,
+             'last_hash':None}
    
     camera_subscribers = get_camera_subscribers(args['subscribers'])
 
+    state['dispatcher'] = SubscriberDispatcher(camera_subscribers, args.get('subscriber_workers', 2),
+                                               args.get('subscriber_queue_size', 10),
+                                               args.get('subscriber_max_retries', 5),
+                                               args.get('subscriber_retry_delay', 30),
+                                               args.get('subscriber_max_retry_delay', 3600))
+
     if 'take_an_average' in args.keys():
         take_an_average = args['take_an_average']
     else:
         take_an_average = False
 
+    if args.get('capture_backend', 'fswebcam') == 'opencv':
+        capture = CameraCapture(args.get('capture_device', 0), args.get('capture_resolution', (1280, 720)),
+                                args.get('capture_fps', 60), args.get('average_frames', 60),
+                                args.get('jpeg_quality', 90))
+        if capture.available():
+            state['capture'] = capture
+        else:
+            logger.error('OpenCV and numpy are needed for the opencv capture backend. Will use fswebcam.')
+
     # Inject your commands into app_state.
     app_state[args['name']] = {} 
     app_state[args['name']]['help'] = make_help(args) 
-    app_state[args['name']]['snap'] = lambda: snap(app_state['sys']['cmd'], args['pose_on_cmd'], args['pose_off_cmd'], take_an_average)
+    app_state[args['name']]['snap'] = lambda: snap(app_state['sys']['cmd'], args['pose_on_cmd'], args['pose_off_cmd'], take_an_average,
+                                                   state['capture'])
     app_state[args['name']]['show_subs'] = make_show_subs(camera_subscribers) 
-    app_state[args['name']]['update'] = make_update(app_state, args, camera_subscribers, take_an_average) 
+    app_state[args['name']]['update'] = make_update(app_state, args, camera_subscribers, take_an_average, state['capture'],
+                                                    state['dispatcher']) 
+    app_state[args['name']]['sub_stats'] = state['dispatcher'].show_stats
+    app_state[args['name']]['timelapse'] = make_timelapse_cmd()
 
-    # Don't proceed until all the other threads are up and ready.
-    b.wait()    
+    return state, camera_subscribers, take_an_average
 
-    while not app_state['stop']:
+def is_duplicate(args, state, file_location):
+    """ Return True (and delete the picture) if the picture looks the same as the last one that was kept. """
 
-        this_instant = datetime.now() 
-        file_location = None
+    if args.get('dedupe_max_distance') is None:
+        return False
 
-        for s in camera_subscribers:
-            if s.wants_picture(this_instant, state['startup']):
-                if file_location == None:
-                    file_location = snap(app_state['sys']['cmd'], args['pose_on_cmd'], args['pose_off_cmd'], take_an_average)
-                    if file_location == None:
-                        logger.error('Cannot take a picture')
-                        break
-                try:
-                   s.new_picture(file_location)
-                except:
-                   logger.error('camera subscriber exception occured: {}, {}'.format(exc_info()[0], exc_info()[1]))
-            #+ elif s.wants_periodic_calls:
-            #+    s.periodic_call()
-
-        # NOTE syntax of delete info in config file ->  'delete_args':{'max_day_age': 2},
-        # Delete old pictures every morning at 9 am local time.
-        if 'delete_args' in args:
+    h = picture_hash(file_location)
+    if h is None:
+        return False
+
+    if state['last_hash'] is not None:
+        distance = hash_distance(h, state['last_hash'])
+        if distance <= args['dedupe_max_distance']:
+            logger.info('picture {} looks the same as the last one (distance {}), not keeping it'.format(
+                        file_location, distance))
             try:
-                if this_instant.hour == 9:
-                    if not state['daily_archive_has_run']:
-                        logger.info('will delete pictures older than {} days'.format(args['delete_args']['max_day_age']))
-                        run('find /data/fopd/pictures -name "*.*" -type f -mtime {} -exec rm -f {{}} \;'.format(
-                            args['delete_args']['max_day_age']), shell=True)
-                        state['daily_archive_has_run'] = True
-                else:
-                    state['daily_archive_has_run'] = False 
+                remove(file_location)
             except:
-                log_entry_table.add_log_entry(logger.error, 
-                    'camera exception while deleting old pictures: {}, {}'.format(exc_info()[0], exc_info()[1]))
+                logger.error('cannot delete picture {}: {}, {}'.format(file_location, exc_info()[0], exc_info()[1]))
+            return True
 
-        state['startup'] = False
-        sleep(1)  
+    state['last_hash'] = h
+    return False
+
+def check_subscribers(app_state, args, state, camera_subscribers, take_an_average):
+
+    this_instant = datetime.now() 
+    file_location = None
+    duplicate = False
+
+    for s in camera_subscribers:
+        if s.wants_picture(this_instant, state['startup']):
+            if file_location == None:
+                file_location = snap(app_state['sys']['cmd'], args['pose_on_cmd'], args['pose_off_cmd'], take_an_average,
+                                     state['capture'])
+                if file_location == None:
+                    logger.error('Cannot take a picture')
+                    break
+                if is_duplicate(args, state, file_location):
+                    duplicate = True
+            if not duplicate:
+                state['dispatcher'].dispatch(s, file_location)
+        else:
+            s.periodic_call()
+
+    # NOTE syntax of delete info in config file ->  'delete_args':{'max_day_age': 2},
+    # Delete old pictures every morning at 9 am local time.
+    if 'delete_args' in args:
+        try:
+            if this_instant.hour == 9:
+                if not state['daily_archive_has_run']:
+                    logger.info('will delete pictures older than {} days'.format(args['delete_args']['max_day_age']))
+                    run('find /data/fopd/pictures -name "*.*" -type f -mtime {} -exec rm -f {{}} \;'.format(
+                        args['delete_args']['max_day_age']), shell=True)
+                    state['daily_archive_has_run'] = True
+            else:
+                state['daily_archive_has_run'] = False 
+        except:
+            log_entry_table.add_log_entry(logger.error, 
+                'camera exception while deleting old pictures: {}, {}'.format(exc_info()[0], exc_info()[1]))
+
+    # Make yesterday's time-lapse once a day. Encoding takes a while so it gets its own thread.
+    if args.get('timelapse_args'):
+        if this_instant.hour == args['timelapse_args'].get('hour', 1):
+            if not state['daily_timelapse_has_run']:
+                state['daily_timelapse_has_run'] = True
+                Thread(target=run_daily_timelapse, name='timelapse', daemon=True,
+                       args=(args['timelapse_args'], state['dispatcher'], camera_subscribers)).start()
+        else:
+            state['daily_timelapse_has_run'] = False
+
+    state['startup'] = False
+
+def stop(state):
+
+    state['dispatcher'].close()
+
+    if state['capture']:
+        state['capture'].close()
 
     logger.info('Exiting the camera controller thread')
+
+def seconds_to_next_minute():
+
+    # The subscriber schedules have a resolution of one minute so wake up just after each minute
+    # turns over.
+    now = datetime.now()
+    return 61 - now.second - now.microsecond / 1000000
+
+# Event loop runtime entry point. See python/runtime.py
+def schedule(app_state, args):
+
+    state, camera_subscribers, take_an_average = init(app_state, args)
+
+    def tick():
+        check_subscribers(app_state, args, state, camera_subscribers, take_an_average)
+        return seconds_to_next_minute()
+
+    return {'tasks':[{'name':args['name'], 'interval':60, 'run_at_start':True, 'pool':'camera', 'func':tick}],
+            'stop':lambda: stop(state)}
+
+def start(app_state, args, b):
+
+    state, camera_subscribers, take_an_average = init(app_state, args)
+
+    # Don't proceed until all the other threads are up and ready.
+    b.wait()    
+
+    while not app_state['stop']:
+
+        check_subscribers(app_state, args, state, camera_subscribers, take_an_average)
+        sleep(1)  
+
+    stop(state)
@@ -25,12 +25,27 @@ class CameraSubscriber():
         # Public properties
         self.name = kwargs.get('name')
 
+        # Set by the SubscriberDispatcher that delivers the pictures (see dispatcher.py).
+        self.dispatcher = None
+
     def periodic_call(self):
         """ The camera_controller will call this variable once per cycle from within it's control loop.
             Typcially control loops run every second.  Override this method if you need this class to be
             called periodically. For example if you are implementing a network transaction and need to be
-            able to do retries """
+            able to do retries. The default retries a failed new_picture call once its back off delay
+            has passed. """
+
+        if self.dispatcher:
+            self.dispatcher.pump(self)
+
+    def queued_pictures(self):
+        """ Override this method, and enqueue, if this class keeps its own queue of pictures on disk.
+            Return the number of pictures in the queue. None (the default) means there is no queue. """
+        return None
 
+    def enqueue(self, file_location):
+        """ Save file_location to this class's queue on disk. It is called on the camera's thread as
+            soon as the picture is taken. new_picture is called later to work through the queue. """
         pass
 
     def wants_picture(self, time_stamp, startup_flag):
@@ -1,12 +1,35 @@
+from os import path
+
 from python.camera_subscribers.CameraSubscriber import CameraSubscriber
-from python.file_uploader import upload_camera_image
+from python.data_file_paths import upload_queue_directory
+from python.file_uploader import UploadQueue
 
 # image subscriber
 #
+# Optional args:
+#   upload_timeout - seconds to wait for the server to accept the connection or to send data
+#                    before the upload fails and is retried later (default 60).
+#
 class FopCloudStorage(CameraSubscriber):
 
-    # upload each new image to the cloud
+    def __init__(self, **kwargs):
+
+        CameraSubscriber.__init__(self, **kwargs)
+
+        # Pictures wait in the upload queue until the server has accepted them.
+        self.upload_queue = UploadQueue(path.join(upload_queue_directory, self.name), kwargs.get('upload_timeout', 60))
+
+    # Pictures go into the upload queue as soon as they are taken so that none are lost while the
+    # server can't be reached or fopd restarts.
+    def enqueue(self, file_location):
+        self.upload_queue.put(file_location, self.posting_url, self.device_id)
+
+    def queued_pictures(self):
+        return len(self.upload_queue)
+
+    # upload the queued images to the cloud, oldest first. file_location has already been queued.
+    # Returns False if an upload failed so that it is retried.
     def new_picture(self, file_location):
 
-        CameraSubscriber.logger.info('uploading latest camera picture to the fop server')
-        upload_camera_image(file_location, self.posting_url, self.device_id)
+        CameraSubscriber.logger.info('uploading {} camera pictures to the fop server'.format(len(self.upload_queue)))
+        return self.upload_queue.drain()
@@ -1,24 +1,39 @@
 from os import getcwd, path
 from python.camera_subscribers.CameraSubscriber import CameraSubscriber
-from shutil import copyfile
 from sys import exc_info
 
 from python.data_file_paths import local_web_image_directory
+from python.image_pipeline import publish_web_image
 
-# Copy the picture to the web directory
+# Put the picture on the local web site as image.jpg, scaled to the size the home page shows it at.
+#
+# Optional args:
+#   web_image_size - the largest (width, height) of image.jpg (default (720, 720) which fits the
+#                    720 pixel wide picture on the home page).
+#   web_image_quality - JPEG quality (default 85).
 #
 class LocalWebServer(CameraSubscriber):
 
+    def __init__(self, **kwargs):
+
+        CameraSubscriber.__init__(self, **kwargs)
+
+        self.web_image_size = kwargs.get('web_image_size', (720, 720))
+        self.web_image_quality = kwargs.get('web_image_quality', 85)
+
     def new_picture(self, file_location):
 
        try:
           current_image_copy_location = path.join(local_web_image_directory,  'image.jpg')
           CameraSubscriber.logger.info('updating local web site picture')
-          CameraSubscriber.logger.debug('copying newest picture to web directory: source image'
+          CameraSubscriber.logger.debug('publishing newest picture to web directory: source image'
                                       + ' path: {}, destination path: {}'.format(\
                                         file_location, current_image_copy_location))
-          copyfile(file_location, current_image_copy_location)
+          publish_web_image(file_location, current_image_copy_location, self.web_image_size,
+                            self.web_image_quality)
+          return True
        except:
           CameraSubscriber.logger.error('Could not copy latest image file to the web directory ({}).'.format(local_web_image_directory)
                                       + ' Check fswebcam for proper operations: {}, {}'.format(\
                                           exc_info()[0], exc_info()[1]))
+          return False
@@ -0,0 +1,172 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from sys import exc_info
+from threading import Lock
+from time import time
+
+from python.logger import get_sub_logger
+
+logger = get_sub_logger(__name__)
+
+# Camera subscriber dispatcher
+#
+# Hands new pictures to the camera subscribers on a small pool of worker threads so that a slow
+# subscriber (e.g. an upload to the cloud) does not hold up the camera controller or the other
+# subscribers.
+#
+# - Each subscriber has its own queue of pictures and gets them one at a time, in order. If a
+#   queue is full the oldest picture is dropped.
+# - A subscriber that keeps its own queue on disk (e.g. FopCloudStorage) is handed each picture
+#   right away, on the camera's thread, by its enqueue method. Its new_picture then only works
+#   through that queue, so no picture waits in memory, none are dropped and the ones that were
+#   queued before a restart are sent afterwards. Failed deliveries to these subscribers are
+#   retried (at most every max_retry_delay seconds) until they work.
+# - At most max_workers subscribers are sent a picture at the same time.
+# - A delivery fails if new_picture raises an exception or returns False. It is retried after
+#   retry_delay seconds, doubling after each failure up to max_retry_delay, until max_retries
+#   retries have failed. Retries are started by the subscriber's periodic_call which the camera
+#   controller calls every cycle.
+#
+class SubscriberDispatcher():
+
+    def __init__(self, subscribers, max_workers=2, max_queue=10, max_retries=5, retry_delay=30,
+                 max_retry_delay=3600):
+
+        self.pool = ThreadPoolExecutor(max_workers=max_workers)
+        self.lock = Lock()
+
+        self.max_queue = max_queue
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+
+        self.subscribers = subscribers
+        self.state = {}
+
+        for s in subscribers:
+            self.state[s] = {'pending':deque(), 'busy':False, 'attempts':0, 'next_attempt':0,
+                             'delivered':0, 'failures':0, 'dropped':0, 'total_latency':0.0,
+                             'max_latency':0.0, 'last_error':None, 'persistent':s.queued_pictures() is not None}
+            s.dispatcher = self
+
+            # Send the pictures that were queued on disk before fopd was (re)started.
+            if self.state[s]['persistent'] and s.queued_pictures() > 0:
+                self.state[s]['pending'].append((None, time()))
+
+    def dispatch(self, sub, file_location):
+        """ Queue file_location for sub. Returns once a subscriber with a queue on disk has saved the
+            picture to it, otherwise immediately. """
+
+        if self.state[sub]['persistent']:
+            self.enqueue(sub, file_location)
+            return
+
+        with self.lock:
+            s = self.state[sub]
+            s['pending'].append((file_location, time()))
+            if len(s['pending']) > self.max_queue:
+                # Drop the oldest picture that is not being delivered right now.
+                if s['busy']:
+                    dropped = s['pending'][1]
+                    del s['pending'][1]
+                else:
+                    dropped = s['pending'].popleft()
+                    s['attempts'] = 0
+                    s['next_attempt'] = 0
+                s['dropped'] += 1
+                logger.warning('{} is falling behind, dropped picture {}'.format(sub.name, dropped[0]))
+
+        self.pump(sub)
+
+    def enqueue(self, sub, file_location):
+
+        try:
+            sub.enqueue(file_location)
+        except:
+            logger.error('{} cannot queue picture {}: {}, {}'.format(sub.name, file_location, exc_info()[0],
+                         exc_info()[1]))
+            return
+
+        with self.lock:
+            s = self.state[sub]
+            # One delivery works through the whole disk queue so at most one is needed besides the
+            # one (if any) that is running now. It may have listed the queue before this picture was added.
+            if len(s['pending']) < (2 if s['busy'] else 1):
+                s['pending'].append((file_location, time()))
+
+        self.pump(sub)
+
+    def pump(self, sub):
+        """ Start delivering sub's next picture if it has one, is idle and is not waiting to retry. """
+
+        with self.lock:
+            s = self.state[sub]
+            if s['busy'] or not s['pending'] or time() < s['next_attempt']:
+                return
+            s['busy'] = True
+            picture = s['pending'][0]
+
+        self.pool.submit(self.deliver, sub, picture)
+
+    def deliver(self, sub, picture):
+
+        try:
+            ok = sub.new_picture(picture[0]) is not False
+            error = None if ok else 'new_picture failed'
+        except:
+            ok = False
+            error = '{}, {}'.format(exc_info()[0], exc_info()[1])
+
+        with self.lock:
+
+            s = self.state[sub]
+            s['busy'] = False
+
+            if ok:
+                # Latency is measured from when the picture was taken, so it includes queueing and retries.
+                latency = time() - picture[1]
+                s['pending'].popleft()
+                s['delivered'] += 1
+                s['total_latency'] += latency
+                s['max_latency'] = max(s['max_latency'], latency)
+                s['attempts'] = 0
+                s['next_attempt'] = 0
+            else:
+                s['failures'] += 1
+                s['attempts'] += 1
+                s['last_error'] = error
+
+                if s['attempts'] > self.max_retries and not s['persistent']:
+                    s['pending'].popleft()
+                    s['dropped'] += 1
+                    s['attempts'] = 0
+                    s['next_attempt'] = 0
+                    logger.error('{} failed to take picture {}, giving up: {}'.format(sub.name, picture[0], error))
+                else:
+                    delay = min(self.retry_delay * 2 ** (s['attempts'] - 1), self.max_retry_delay)
+                    s['next_attempt'] = time() + delay
+                    logger.warning('{} failed to take picture {}, will retry in {} seconds: {}'.format(
+                                   sub.name, picture[0] or 'queue', delay, error))
+
+        if ok:
+            # Send the next queued picture right away.
+            self.pump(sub)
+
+    def show_stats(self):
+
+        lines = []
+
+        with self.lock:
+            for sub in self.subscribers:
+                s = self.state[sub]
+                mean = s['total_latency'] / s['delivered'] if s['delivered'] else 0
+                queued = sub.queued_pictures() if s['persistent'] else len(s['pending'])
+                lines.append('{}: delivered {}, failures {}, dropped {}, queued {}, latency mean {:.1f} s, max {:.1f} s{}'.format(
+                             sub.name, s['delivered'], s['failures'], s['dropped'], queued,
+                             mean, s['max_latency'],
+                             ', last error: {}'.format(s['last_error']) if s['last_error'] else ''))
+
+        return '\n'.join(lines) if lines else 'there are no camera subscribers'
+
+    def close(self):
+        self.pool.shutdown(wait=False)
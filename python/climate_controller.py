@@ -1,21 +1,25 @@
-# TBD: Need to write the state file out whenever a change is made that makes this necessary (such as someone turning
-#      a recipe on or off.  Add this functionality. Currenlty the state file is written out every state_file_write_interval
-#      seconds and when the program gracefully exits.
+# The state file only holds the climate_state keys listed in persisted_state_keys. It is written when one of them
+# changes, but no more often than once every state_file_write_interval seconds unless the write is forced (e.g. when
+# a recipe is started, stopped or loaded, and when the program gracefully exits). The recipe is written to its own
+# file, named after the hash of its contents, so that it is only written when it changes.
 
+from bisect import bisect_right
+from hashlib import sha256
 from logging import DEBUG, INFO, WARNING, ERROR, CRITICAL
-from os import path, getcwd
+from os import fsync, listdir, path, getcwd, remove, replace
 from sys import exc_info
 from threading import Lock
-from time import sleep, time
+from time import localtime, sleep, time
 
 import datetime
-from json import dump, dumps, load 
+from json import dumps, load 
 
 from python.logData import logDB
 from python.logger import get_sub_logger
 from python.LogFileEntryTable import LogFileEntryTable
 
 from python.data_file_paths import recipes_directory_location, state_directory_location
+from python.event_stream import event_stream
 
 # Provide a lock to control access to the climate controller state
 
@@ -29,6 +33,24 @@ log_entry_table = LogFileEntryTable(60*60)
 # State variables:
 climate_state = {} 
 
+# The actuator states that are published to the live event stream.
+actuator_state_keys = ('grow_light_on', 'vent_fan_on', 'circ_fan_on', 'air_flush_on', 'air_cooler_on',
+                       'air_heater_on', 'flood_on')
+
+# These are the climate_state keys that are saved in the state file. Everything else is worked out again
+# when the climate controller starts.
+persisted_state_keys = ('run_mode', 'recipe_start_time', 'cur_day', 'cur_phase_index')
+
+# What was last written to the state file. See write_state_file.
+state_file_snapshot = {'state':None, 'recipe':None, 'recipe_hash':None}
+
+# Compiled form of climate_state['recipe'] - see compile_recipe.
+recipe_index = {'recipe':None, 'phases':[], 'phase_start_days':[]}
+
+# The recipe day and phase only change at midnight (relative to the recipe start time) so they
+# are worked out once per day. See update_recipe_day.
+recipe_day_cache = {'recipe':None, 'recipe_start_time':None, 'day_end_ts':0, 'cur_day':None, 'phase_index':None}
+
 # Load the recipe file found at rel_path and stick the JSON into climate_state['recipe']
 #
 def load_recipe_file(rel_path):
@@ -45,6 +67,7 @@ def load_recipe_file(rel_path):
         with open(recipe_path) as f:
             try:
                 climate_state['recipe'] = load(f)
+                compile_recipe(climate_state['recipe'])
                 return (True, 'OK')
             except:
                 msg = 'cannot load and parse recipe file {}, {}, {}.'.format(recipe_path, exc_info()[0], exc_info()[1])
@@ -70,32 +93,103 @@ def load_state_file(rel_path):
         
         with open(state_file_path) as f:
             try:
-                climate_state = load(f)
+                state = load(f)
+
+                # Older state files contain the recipe. Newer ones refer to a separate recipe file.
+                if 'recipe_hash' in state:
+                    recipe_hash = state.pop('recipe_hash')
+                    state['recipe'] = None
+                    if recipe_hash:
+                        try:
+                            with open(recipe_file_path(state_file_path, recipe_hash)) as rf:
+                                state['recipe'] = load(rf)
+                        except:
+                            logger.error('cannot load the recipe file for the state file: {}, {}'.format(
+                                         exc_info()[0], exc_info()[1]))
+
+                climate_state.update(state)
             except:
                 logger.error('cannot load state file.')
         
     else:
         logger.debug('no state file found. The climate controller will be set to off.')
 
+def recipe_file_path(state_file_path, recipe_hash):
+    return '{}.recipe.{}.json'.format(state_file_path, recipe_hash)
+
+# Write to a temporary file and then rename it so that a power cut can't leave a half written file.
+#
+def write_file_atomically(file_path, data):
+
+    tmp_path = file_path + '.tmp'
+
+    with open(tmp_path, 'w') as f:
+        f.write(data)
+        f.flush()
+        fsync(f.fileno())
+
+    replace(tmp_path, file_path)
+
+# Delete the recipe files that the state file no longer refers to.
+#
+def remove_old_recipe_files(state_file_path, recipe_hash):
+
+    prefix = path.basename(state_file_path) + '.recipe.'
+
+    for f in listdir(path.dirname(state_file_path) or '.'):
+        if f.startswith(prefix) and f != path.basename(recipe_file_path(state_file_path, recipe_hash)):
+            try:
+                remove(path.join(path.dirname(state_file_path), f))
+            except:
+                logger.warning('cannot remove old recipe file {}: {}, {}'.format(f, exc_info()[0], exc_info()[1]))
+
+# Write the state file if any of the persisted state has changed. Unless force is True, writes are
+# at least update_interval seconds apart so that a burst of changes results in one write.
+#
 def write_state_file(rel_path, update_interval: 'secs', force: bool):
 
-    global climate_state
+    global climate_state, state_file_snapshot
 
-    if force or (time() >= climate_state['last_state_file_update_time'] + update_interval):
+    state = {}
+    for k in persisted_state_keys:
+        state[k] = climate_state.get(k)
 
-        # Go ahead and log the update time even though the file write is not done. This way
-        # you won't bang on the file system over and over in the presence of errors.
-        climate_state['last_state_file_update_time'] = time()
-       
-        try:
-            #- state_file_path = getcwd() + rel_path
-            state_file_path = path.join(state_directory_location, rel_path)
-            logger.info('writing climate state file {}'.format(state_file_path))
+    recipe = climate_state.get('recipe')
 
-            with open(state_file_path, 'w') as outfile:
-                    dump(climate_state, outfile)
-        except:
-            logger.error('error encountered while writing state file: {}{}'.format(exc_info()[0], exc_info()[1]))
+    if state == state_file_snapshot['state'] and recipe is state_file_snapshot['recipe']:
+        return
+
+    if not force and time() < climate_state['last_state_file_update_time'] + update_interval:
+        return
+
+    # Go ahead and log the update time even though the file write is not done. This way
+    # you won't bang on the file system over and over in the presence of errors.
+    climate_state['last_state_file_update_time'] = time()
+   
+    try:
+        #- state_file_path = getcwd() + rel_path
+        state_file_path = path.join(state_directory_location, rel_path)
+        logger.info('writing climate state file {}'.format(state_file_path))
+
+        if recipe is state_file_snapshot['recipe']:
+            recipe_hash = state_file_snapshot['recipe_hash']
+        elif recipe:
+            recipe_json = dumps(recipe, sort_keys=True)
+            recipe_hash = sha256(recipe_json.encode('utf-8')).hexdigest()
+            if not path.isfile(recipe_file_path(state_file_path, recipe_hash)):
+                write_file_atomically(recipe_file_path(state_file_path, recipe_hash), recipe_json)
+        else:
+            recipe_hash = None
+
+        state['recipe_hash'] = recipe_hash
+        write_file_atomically(state_file_path, dumps(state))
+        del state['recipe_hash']
+
+        remove_old_recipe_files(state_file_path, recipe_hash)
+
+        state_file_snapshot = {'state':state, 'recipe':recipe, 'recipe_hash':recipe_hash}
+    except:
+        logger.error('error encountered while writing state file: {}{}'.format(exc_info()[0], exc_info()[1]))
 
 
 def make_help(prefix):
@@ -115,6 +209,7 @@ def make_help(prefix):
         s = s + nul_pre + "                           - e.g. {}.cmd('lr', recipe_path='/climate_recipes/test1.rcp')\n".format(prefix)
         s = s + cmd_pre + "cmd('stop')                - stop the current recipe.\n"
         s = s + cmd_pre + 'recipe()                   - Return the current recipe in JSON format.\n'
+        s = s + cmd_pre + 'schedule()                 - Show the recipe phases and when each one starts.\n'
         s = s + cmd_pre + 'state()                    - Show climate controller state.\n'
         
         return s
@@ -131,6 +226,50 @@ def show_recipe():
     else:
         return None 
 
+def show_schedule():
+
+    global climate_state
+
+    try:
+        if climate_state['recipe'] == None:
+            return 'There is no recipe loaded.'
+
+        if recipe_index['recipe'] is not climate_state['recipe']:
+            compile_recipe(climate_state['recipe'])
+
+        phases = climate_state['recipe']['phases']
+
+        if climate_state['recipe_start_time'] == None:
+            s = 'The recipe is not running.\n'
+            for i, p in enumerate(phases):
+                s = s + 'Phase {}: {}, starts on day {}, {} days\n'.format(i, p['name'], recipe_index['phase_start_days'][i],
+                                                                         p['cycles'])
+            return s
+
+        recipe_start = datetime.datetime.fromtimestamp(climate_state['recipe_start_time'])
+        now = datetime.datetime.now()
+
+        s = show_date(climate_state['recipe_start_time'], 'Recipe start time')
+        s = s + 'Current day index: {}\n'.format(climate_state['cur_day'])
+
+        for i, p in enumerate(phases):
+            phase_start = recipe_start + datetime.timedelta(days=recipe_index['phase_start_days'][i])
+            if i == climate_state['cur_phase_index']:
+                status = 'current'
+            elif phase_start > now:
+                status = 'upcoming'
+            else:
+                status = 'done'
+            s = s + 'Phase {}: {}, {}, starts {}, {} days\n'.format(i, p['name'], status, phase_start.isoformat(),
+                                                                   p['cycles'])
+
+        recipe_end = recipe_start + datetime.timedelta(days=recipe_index['phase_start_days'][-1])
+        return s + 'Recipe end: {}\n'.format(recipe_end.isoformat())
+
+    except:
+        logger.error('show_schedule command {}{}'.format(exc_info()[0], exc_info()[1]))
+        return "Error - can't show schedule"
+
 def show_date(date, prelude_msg):
 
     if date != None:
@@ -218,10 +357,12 @@ def make_cmd(config_args):
                     climate_state['run_mode'] = 'on'
                     climate_state['recipe_start_time'] = (datetime.datetime.now()\
                         - datetime.timedelta(days=climate_state['cur_day'])).timestamp()
+                    write_state_file(config_args['state_file'], 0, True)
                     return 'OK'
                 elif args[0] == 'stop':
                     climate_state['run_mode'] = 'off'
                     climate_state['recipe_start_time'] = None
+                    write_state_file(config_args['state_file'], 0, True)
                     return 'OK'
                 elif args[0] == 'load_recipe' or args[0] == 'lr':
 
@@ -310,6 +451,93 @@ def init_state(args):
     climate_state['log_cycle'] = False
 
 
+# Convert a recipe start or end time to minutes past midnight. Accept times as either integers,
+# floats (i.e the hour) or strings (e.g. hh:mm). An integer end time means the end of that hour.
+#
+def recipe_time_to_minute(t, is_end_time):
+
+    if isinstance(t, (int)):
+        return int(t) * 60 + (59 if is_end_time else 0)
+    elif isinstance(t, (float)):
+        return int(t) * 60 + int((t - int(t)) * 60)
+    else:
+        recipe_time = datetime.datetime.strptime(t, '%H:%M').time()
+        return recipe_time.hour * 60 + recipe_time.minute
+
+# Compile the time intervals of a recipe step into a sorted list of segment start minutes and
+# a parallel list of the interval (or None) that is in effect for each segment. Intervals include
+# their start and end minutes. An interval whose end is before its start wraps past midnight.
+# Where intervals overlap the first one in the recipe wins.
+#
+def compile_step(times):
+
+    spans = []
+    for t in times:
+        start = recipe_time_to_minute(t['start_time'], False)
+        end = recipe_time_to_minute(t['end_time'], True)
+        if start <= end:
+            spans.append((start, end, t))
+        else:
+            spans.append((start, 24 * 60 - 1, t))
+            spans.append((0, end, t))
+
+    boundaries = sorted(set([0] + [s[0] for s in spans] + [s[1] + 1 for s in spans if s[1] + 1 < 24 * 60]))
+
+    starts = []
+    entries = []
+    for b in boundaries:
+        entry = None
+        for s in spans:
+            if s[0] <= b <= s[1]:
+                entry = s[2]
+                break
+        if not entries or entries[-1] is not entry:
+            starts.append(b)
+            entries.append(entry)
+
+    return {'starts':starts, 'entries':entries, 'count':len(times)}
+
+# Compile the step time intervals of every phase of the recipe so that the control loops don't have to
+# parse the recipe times every second. A step whose times cannot be parsed is stored as an error message.
+#
+def compile_recipe(recipe):
+
+    global recipe_index
+
+    phases = []
+
+    # phase_start_days[i] is the recipe day index on which phase i starts. The last entry is the day after
+    # the recipe ends.
+    phase_start_days = [0]
+
+    if recipe:
+        for p in recipe['phases']:
+            phase_start_days.append(phase_start_days[-1] + p['cycles'])
+            steps = {}
+            for step_name, times in p['step'].items():
+                try:
+                    steps[step_name] = compile_step(times)
+                except:
+                    steps[step_name] = 'cannot compile the recipe times for step {}: {}, {}'.format(step_name,
+                                       exc_info()[0], exc_info()[1])
+                    logger.error(steps[step_name])
+            phases.append(steps)
+
+    recipe_index = {'recipe':recipe, 'phases':phases, 'phase_start_days':phase_start_days}
+
+def get_step_index(step_name):
+
+    # The recipe can be replaced by loading a state file or a recipe file.
+    if recipe_index['recipe'] is not climate_state['recipe']:
+        compile_recipe(climate_state['recipe'])
+
+    step = recipe_index['phases'][climate_state['cur_phase_index']][step_name]
+
+    if isinstance(step, str):
+        raise ValueError(step)
+
+    return step
+
 # step_name -> e.g. light_intensity, air_fush
 # value names -> tuple list of value names to return
 #
@@ -321,76 +549,32 @@ def get_current_recipe_step_values(step_name, value_names, log_missing_entries=T
 
     try:
         
-        times = climate_state['recipe']['phases'][climate_state['cur_phase_index']]['step'][step_name]
+        step = get_step_index(step_name)
 
-        if len(times) > 0:
-            
-            for t in times:
+        if step['count'] > 0:
 
-                past_start = False
-                lte_end = False
-               
-                # accept times as either integers, floats (i.e the hour) or strings (e.g. hh:mm)
-                if isinstance(t['start_time'], (int)):
-                    start = [int(t['start_time']), 0]
-                elif isinstance(t['start_time'], (float)):
-                    start = [int(t['start_time']), int((t['start_time'] - int(t['start_time'])) * 60)]
-                else:
-                    start_time = datetime.datetime.strptime(t['start_time'], '%H:%M').time()
-                    start = [start_time.hour, start_time.minute] 
+            t = step['entries'][bisect_right(step['starts'], climate_state['cur_hour'] * 60 + climate_state['cur_min']) - 1]
 
-                if start[0] <= climate_state['cur_hour']: 
-                    #- if len(start) > 1:
-                    if start[1] <= climate_state['cur_min']:
-                        past_start = True
-                    else:
-                        past_start = False
+            if t is not None:
+
+                values = {}
+
+                for vn in value_names:
+                    if vn in t:
+                        values[vn] = t[vn]
+                    elif vn == "units":
+                        # Unit's is an optional attribute, default it to minutes.
+                        values["units"] = "minutes" 
                     #- else:
-                        past_start = True 
+                    #-    logger.warning('cannot find value {} in step {}.'.format(vn, step_name))
+                    else:
+                        # An expected recipe value is missing. So do not return anything
+                        if log_missing_entries:
+                            log_entry_table.add_log_entry(logger.warning, 'cannot find value {} in step {}.'.format(vn, step_name)) 
+                        return None
 
-                if isinstance(t['end_time'], (int)):
-                    end = [int(t['end_time']), 59]
-                elif isinstance(t['end_time'], (float)):
-                    end = [int(t['end_time']), int((t['end_time'] - int(t['end_time'])) * 60)]
-                else:
-                    end_time = datetime.datetime.strptime(t['end_time'], '%H:%M').time()
-                    end = [end_time.hour, end_time.minute] 
-                
-                #- if len(end) == 1:
-                #-    if end[0] >= climate_state['cur_hour']: 
-                #-        lte_end = True
-                #-    else:
-                #-        lte_end = False
-                #- else:
-                if (end[0] > climate_state['cur_hour']) or\
-                   (end[0] == climate_state['cur_hour'] and end[1] >= climate_state['cur_min']):
-                        lte_end = True
-                else:
-                    lte_end = False 
-                
-                # DEBUG logger.info('step name: {}, start: {}, end: {}, past_start: {}, lte_end: {}'.format(step_name, start, end, past_start, lte_end))
-                #- if len(end) > 0:
-                #-     logger.info('gte_start {}, lte_end {}'.format(past_start, lte_end))
-                if past_start and lte_end:
-
-                    values = {}
-
-                    for vn in value_names:
-                        if vn in t:
-                            values[vn] = t[vn]
-                        elif vn == "units":
-                            # Unit's is an optional attribute, default it to minutes.
-                            values["units"] = "minutes" 
-                        #- else:
-                        #-    logger.warning('cannot find value {} in step {}.'.format(vn, step_name))
-                        else:
-                            # An expected recipe value is missing. So do not return anything
-                            if log_missing_entries:
-                                log_entry_table.add_log_entry(logger.warning, 'cannot find value {} in step {}.'.format(vn, step_name)) 
-                            return None
-
-                    # You've found the step that cooresponds to the current time so now exit.
-                    return values
+                # You've found the step that cooresponds to the current time so now exit.
+                return values
             
             # If the code has gotten this far then there were no time intervals in the step that match the current time. 
             if log_missing_entries:
@@ -792,18 +976,14 @@ def get_phase_index(cur_day_index, phases):
 
     try:
 
-        rcp_day_index = 0
+        if recipe_index['recipe'] is not climate_state['recipe']:
+            compile_recipe(climate_state['recipe'])
 
-        for i in range(0, len(phases)):
-            
-            rcp_phase_cycles = phases[i]['cycles']
-
-            if cur_day_index >= rcp_day_index and cur_day_index < rcp_day_index + rcp_phase_cycles: 
+        # Find the last phase that starts on or before today.
+        i = bisect_right(recipe_index['phase_start_days'], cur_day_index) - 1
 
-                return i
-
-            else:
-                rcp_day_index = rcp_day_index + rcp_phase_cycles
+        if cur_day_index >= 0 and i < len(phases):
+            return i
 
         #- logger.error('the current recipe does not apply to today. It may be over.')
         log_entry_table.add_log_entry(logger.error, 'the current recipe does not apply to today. It may be over.') 
@@ -821,23 +1001,47 @@ def log_if_log_cycle(level, msg):
     if climate_state['log_cycle']:
         logger.log(level, msg)
 
+# Set the current recipe day and phase. These are only recalculated when the recipe day rolls over
+# or when the recipe or its start time changes.
+#
+def update_recipe_day(now_ts):
+
+    global climate_state, recipe_day_cache
+
+    c = recipe_day_cache
+
+    if c['recipe'] is not climate_state['recipe'] or c['recipe_start_time'] != climate_state['recipe_start_time']\
+       or now_ts >= c['day_end_ts']:
+
+        if climate_state['recipe_start_time'] != None:
+            recipe_start = datetime.datetime.fromtimestamp(climate_state['recipe_start_time'])
+            cur_day = (datetime.datetime.fromtimestamp(now_ts) - recipe_start).days
+            day_end_ts = (recipe_start + datetime.timedelta(days=cur_day + 1)).timestamp()
+            phase_index = get_phase_index(cur_day, climate_state['recipe']['phases'])
+        else:
+            # Check every minute in case the recipe is started.
+            cur_day = None
+            day_end_ts = now_ts + 60
+            phase_index = None
+
+        recipe_day_cache = {'recipe':climate_state['recipe'], 'recipe_start_time':climate_state['recipe_start_time'],
+                            'day_end_ts':day_end_ts, 'cur_day':cur_day, 'phase_index':phase_index}
+
+    climate_state['cur_day'] = recipe_day_cache['cur_day']
+    climate_state['cur_phase_index'] = recipe_day_cache['phase_index']
+
 def update_climate_state(min_log_period, control_loops):
 
     global climate_state
     
-    now = datetime.datetime.now()
-    
-    climate_state['cur_min'] = now.minute
-    climate_state['cur_hour'] = now.hour
-    
-    if climate_state['recipe_start_time'] != None:
-        climate_state['cur_day'] = (now - datetime.datetime.fromtimestamp(climate_state['recipe_start_time'])).days
-    else:
-        climate_state['cur_day'] = None
+    climate_state['cur_time'] = time()   # Return the time in seconds since the epoch as a floating point number.
 
-    climate_state['cur_phase_index'] = get_phase_index(climate_state['cur_day'], climate_state['recipe']['phases'])
+    now = localtime(climate_state['cur_time'])
+    
+    climate_state['cur_min'] = now.tm_min
+    climate_state['cur_hour'] = now.tm_hour
 
-    climate_state['cur_time'] = time()   # Return the time in seconds since the epoch as a floating point number.
+    update_recipe_day(climate_state['cur_time'])
 
     if climate_state['cur_time']  - climate_state['last_log_time'] >= min_log_period:   
         climate_state['last_log_time'] = climate_state['cur_time']
@@ -889,9 +1093,7 @@ def create_control_loops(control_configs, app_state):
     return controls
 
 
-def start(app_state, args, barrier):
-
-    global climate_state
+def init(app_state, args):
 
     logger.setLevel(args['log_level'])
     logger.info('starting climate controller thread')
@@ -901,45 +1103,70 @@ def start(app_state, args, barrier):
     app_state[args['name']]['cmd'] = make_cmd(args)
     app_state[args['name']]['help'] = make_help(args['name']) 
     app_state[args['name']]['recipe'] = show_recipe
+    app_state[args['name']]['schedule'] = show_schedule
     app_state[args['name']]['state'] = show_state
 
     # Load current state and recipe
     init_state(args)
 
-    # Don't proceed until all the other resources are available.
-    barrier.wait()    
+def run_control_loops(args, control_loops):
 
-    # by convention we expect a standard fopd hardware interface to exist.
-    hw_int = app_state[args['hardware_interface']]
+    state_lock.acquire()
 
-    # TODO - refactor to create the control loops before the barrier wait
-    control_loops = create_control_loops(args['controls'], app_state) 
+    try:
+        if climate_state['run_mode'] == 'on': 
+
+            update_climate_state(args['min_log_period'], control_loops)
+           
+            for loop in control_loops:
+                if loop['enabled']:
+                    loop['func'](*loop['args'])
 
+        event_stream.publish_state(args['name'], {k:climate_state[k] for k in actuator_state_keys})
 
-    while not app_state['stop']:
+        # Write the state file if the persisted state has changed, at most once every
+        # state_file_write_interval seconds.
+        #
+        write_state_file(args['state_file'], args['state_file_write_interval'], False)
 
-       state_lock.acquire()
+    finally:
+        state_lock.release()
 
-       try:
-           if climate_state['run_mode'] == 'on': 
+def stop(args):
 
-               update_climate_state(args['min_log_period'], control_loops)
-              
-               for loop in control_loops:
-                   if loop['enabled']:
-                       loop['func'](*loop['args'])
+    write_state_file(args['state_file'], args['state_file_write_interval'], True)
+    logger.info('exiting climate controller thread')
 
-           # Every once in a while write the state to the state file to make sure the file 
-           # stays up to date.  
-           # TODO: A more sophisticated system would write only when
-           # changes were made.
-           #
-           write_state_file(args['state_file'], args['state_file_write_interval'], False)
+# Event loop runtime entry point. See python/runtime.py
+def schedule(app_state, args):
 
-       finally:
-           state_lock.release()
+    init(app_state, args)
 
+    # The hardware interfaces are initialized alongside this resource so the control loops
+    # can't be created until the runtime starts ticking.
+    state = {'control_loops':None}
+
+    def tick():
+        if state['control_loops'] is None:
+            state['control_loops'] = create_control_loops(args['controls'], app_state)
+        run_control_loops(args, state['control_loops'])
+
+    return {'tasks':[{'name':args['name'], 'interval':1, 'func':tick}],
+            'stop':lambda: stop(args)}
+
+def start(app_state, args, barrier):
+
+    init(app_state, args)
+
+    # Don't proceed until all the other resources are available.
+    barrier.wait()    
+
+    # TODO - refactor to create the control loops before the barrier wait
+    control_loops = create_control_loops(args['controls'], app_state) 
+
+    while not app_state['stop']:
+
+       run_control_loops(args, control_loops)
        sleep(1)
 
-    write_state_file(args['state_file'], args['state_file_write_interval'], True)
-    logger.info('exiting climate controller thread')
+    stop(args)
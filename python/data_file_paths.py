@@ -9,5 +9,7 @@ state_directory_location = fopd_data_directory + 'state/'
 local_web_chart_directory = 'web/static/'
 local_web_image_directory = 'web/static/'
 camera_image_directory = fopd_data_directory + 'pictures/'
+upload_queue_directory = fopd_data_directory + 'upload_queue/'
+timelapse_directory = fopd_data_directory + 'timelapse/'
 log_directory = fopd_data_directory + 'logs/'
 couchdb_local_config_file_directory = fopd_data_directory + 'couchdb/etc'
@@ -5,13 +5,35 @@
 #   sensor_readings
 #   mqtt
 #
+# Optional args:
+#   couchdb_flush_size - post to couchdb once this many readings are waiting (default 10).
+#   couchdb_flush_age  - post to couchdb once the oldest waiting reading is this many seconds old (default 5).
+#   log_rollups        - also log the count, min, max, mean, standard deviation and last value of every
+#                        update of each reading during the sample interval (default False).
+#   report_mode        - 'interval' (default) logs every reading once per sample_interval. 'change' logs a
+#                        reading when it moves outside its deadband, when it has not been logged for
+#                        max_silence seconds and when the sensor fails (the reading becomes None) or
+#                        recovers. Rollups are still logged once per sample_interval.
+#   change_check_interval - in change mode, look for changes this often in seconds (default 1).
+#   deadband_abs       - in change mode, ignore changes of this size or smaller (default 0).
+#   deadband_rel       - in change mode, ignore changes of this fraction of the last logged value or
+#                        smaller (default 0). The larger of the two deadbands applies.
+#   deadbands          - per reading deadbands, e.g. {'air_temp':{'abs':0.2}, 'air_co2':{'rel':0.05}}.
+#                        Readings are named as in the source resource's get command.
+#   max_silence        - in change mode, log a reading that has not changed after this many seconds
+#                        (default sample_interval).
+#
+#  Sensor failures are only published via MQTT (as readings with a value of None) because the
+#  local couchdb charts can't plot them.
+#
 #  No app_state variables are written.
 #
 
 from time import sleep, time
 
-from python.logData import logDB
+from python.logData import logDB, logDB_rollup, start_couchdb_writer, stop_couchdb_writer
 from python.logger import get_sub_logger 
+from python.reading_rollup import TableRollup
 
 logger = get_sub_logger(__name__)
 
@@ -28,47 +50,208 @@ def time_to_sample(interval, state):
    else:
       return False
     
-def start(app_state, args, b):
-   
+def init(args):
+
     logger.setLevel(args['log_level'])
     logger.info('starting data logger')
 
+    # Readings are handed to a background writer that posts them to couchdb in batches.
+    if args['log_data_to_local_couchdb']:
+        start_couchdb_writer(args.get('couchdb_flush_size', 10), args.get('couchdb_flush_age', 5))
+
+def log_rollups(app_state, args, state):
+
+    source = app_state[args['source']]['sensor_readings']
+
+    # Start collecting rollups the first time through. The source's readings don't exist until
+    # the source has started.
+    if state['rollup'] is None:
+        if not hasattr(source, 'add_listener'):
+            logger.error('the data logger source {} does not support rollups.'.format(args['source']))
+            return
+        state['rollup'] = TableRollup(source)
+        return
+
+    rollups = [r for r in state['rollup'].take() if r['count'] > 0]
+
+    if not rollups:
+        return
+
+    if args['log_data_to_local_couchdb']:
+        for r in rollups:
+            logDB_rollup(r)
+
+    if args['log_data_via_mqtt'] and (args['mqtt_resource'] in app_state):
+        app_state[args['mqtt_resource']]['publish_rollups'](rollups)
+
+def publish_readings(app_state, args, readings):
+
+    if args['log_data_via_mqtt'] and (args['mqtt_resource'] in app_state):
+        if readings:
+            app_state[args['mqtt_resource']]['publish_readings'](readings)
+    elif not (args['mqtt_resource'] in app_state):
+        logger.warning('no mqtt client avaiable.')
+
+def log_readings(app_state, args, state):
+
+    logger.info('Logging sensor readings')
+
+    if args['source'] and 'sensor_readings' in app_state[args['source']]:
+
+        # Collect the readings so that they can be sent to the MQTT broker together.
+        readings = []
+
+        for r in app_state[args['source']]['sensor_readings']:
+
+            # check for empty values - don't log them. Warn somebody about it.
+            if r['value'] is None:
+                logger.warning('Empty value for {} {}'.format(r['subject'], r['attribute']))
+                continue 
+            if r['ts'] is None:
+                logger.warning('Empty time stamp for {} {}'.format(r['subject'], r['attribute']))
+                continue
+
+            #Log the value to local couchdb
+            if args['log_data_to_local_couchdb']:
+                logDB(r)
+
+            readings.append(r)
+
+        #Log the values remotely.
+        publish_readings(app_state, args, readings)
+
+        if args.get('log_rollups', False):
+            log_rollups(app_state, args, state)
+    else:
+        logger.error('no sensor readings available.')
+
+def reading_name(source, i, r):
+
+    if hasattr(source, 'name_of'):
+        return source.name_of(i)
+
+    return '{}_{}'.format(r['subject'], r['attribute'])
+
+def outside_deadband(old, new, deadband):
+
+    try:
+        return abs(new - old) > max(deadband.get('abs', 0), deadband.get('rel', 0) * abs(old))
+    except TypeError:
+        # Not a number (e.g. a switch state).
+        return new != old
+
+def report_changes(app_state, args, state):
+
+    if not (args['source'] and 'sensor_readings' in app_state[args['source']]):
+        logger.error('no sensor readings available.')
+        return
+
+    source = app_state[args['source']]['sensor_readings']
+    now = time()
+
+    # ReadingTables number their updates so there is nothing to do if nothing has been updated
+    # since the last look and no reading is due for a heartbeat.
+    seq = getattr(source, 'seq', None)
+    if seq is not None and seq == state['seq'] and now < state['next_heartbeat']:
+        return
+    state['seq'] = seq
+
+    max_silence = args.get('max_silence', args['sample_interval'])
+    default_deadband = {'abs':args.get('deadband_abs', 0), 'rel':args.get('deadband_rel', 0)}
+    deadbands = args.get('deadbands', {})
+
+    readings = []
+    failures = []
+
+    for i, r in enumerate(source):
+
+        if r['ts'] is None:
+            # The sensor has not been read yet.
+            continue
+
+        last = state['reported'].get(i)
+
+        if r['value'] is None:
+            if last is None or last['value'] is not None:
+                logger.warning('{} {} sensor failure'.format(r['subject'], r['attribute']))
+                failures.append(r)
+                state['reported'][i] = {'value':None, 'time':now}
+            continue
+
+        if last is None or last['value'] is None or now - last['time'] >= max_silence \
+           or outside_deadband(last['value'], r['value'],
+                               deadbands.get(reading_name(source, i, r), default_deadband)):
+
+            if args['log_data_to_local_couchdb']:
+                logDB(r)
+            readings.append(r)
+            state['reported'][i] = {'value':r['value'], 'time':now}
+
+    if readings or failures:
+        logger.info('logging {} changed readings and {} sensor failures'.format(len(readings), len(failures)))
+        publish_readings(app_state, args, readings + failures)
+
+    reported_times = [v['time'] for v in state['reported'].values() if v['value'] is not None]
+    state['next_heartbeat'] = (min(reported_times) if reported_times else now) + max_silence
+
+def new_state():
+
     # Set state so that a sample is taken on startup.
-    state = {'next_sample_time':0}
-    
-    # Don't proceed till the sensor logger and mqtt threads are up and running. Otherwise you 
-    # won't have any sensor readings to log or any mqtt to send them.
-    b.wait()    
+    return {'next_sample_time':0, 'rollup':None, 'reported':{}, 'seq':None, 'next_heartbeat':0}
 
-    while not app_state['stop']:
+def stop():
+
+    stop_couchdb_writer()
+    logger.info('data logger thread stopping')
+
+# Event loop runtime entry point. See python/runtime.py
+def schedule(app_state, args):
+
+    init(args)
+
+    if args['sample_interval'] <= 0 or args['sample_interval'] > 86400:
+        logger.error('The data logging sample interval must be '
+                   + 'set to a value between 1 and 86400. BTW: 86400 seconds is 24 hours.')
+        return {'tasks':[], 'stop':stop}
+
+    state = new_state()
 
-       if time_to_sample(args['sample_interval'], state):
+    if args.get('report_mode', 'interval') == 'change':
+        tasks = [{'name':args['name'], 'interval':args.get('change_check_interval', 1), 'run_at_start':True,
+                  'func':lambda: report_changes(app_state, args, state)}]
+        if args.get('log_rollups', False):
+            tasks.append({'name':args['name'] + '_rollups', 'interval':args['sample_interval'],
+                          'run_at_start':True, 'func':lambda: log_rollups(app_state, args, state)})
+        return {'tasks':tasks, 'stop':stop}
 
-            logger.info('Logging sensor readings')
+    # Take a sample on startup and then every sample_interval seconds.
+    return {'tasks':[{'name':args['name'], 'interval':args['sample_interval'], 'run_at_start':True,
+                      'func':lambda: log_readings(app_state, args, state)}],
+            'stop':stop}
 
-            if args['source'] and 'sensor_readings' in app_state[args['source']]:
-                for r in app_state[args['source']]['sensor_readings']:
+def start(app_state, args, b):
+   
+    init(args)
 
-                    # check for empty values - don't log them. Warn somebody about it.
-                    if r['value'] is None:
-                        logger.warning('Empty value for {} {}'.format(r['subject'], r['attribute']))
-                        continue 
-                    if r['ts'] is None:
-                        logger.warning('Empty time stamp for {} {}'.format(r['subject'], r['attribute']))
-                        continue
+    state = new_state()
+    change_mode = args.get('report_mode', 'interval') == 'change'
+    next_check_time = 0
+    
+    # Don't proceed till the sensor logger and mqtt threads are up and running. Otherwise you 
+    # won't have any sensor readings to log or any mqtt to send them.
+    b.wait()    
 
-                    #Log the value to local couchdb
-                    if args['log_data_to_local_couchdb']:
-                        logDB(r)
+    while not app_state['stop']:
 
-                    #Log the value remotely.
-                    if args['log_data_via_mqtt'] and (args['mqtt_resource'] in app_state):
-                        app_state[args['mqtt_resource']]['publish_queue'].put(['sensor_reading', r])
-                    elif not (args['mqtt_resource'] in app_state):
-                        logger.warning('no mqtt client avaiable.')
-            else:
-                logger.error('no sensor readings available.')
+       if change_mode:
+            if time() >= next_check_time:
+                next_check_time = time() + args.get('change_check_interval', 1)
+                report_changes(app_state, args, state)
+            if time_to_sample(args['sample_interval'], state) and args.get('log_rollups', False):
+                log_rollups(app_state, args, state)
+       elif time_to_sample(args['sample_interval'], state):
+            log_readings(app_state, args, state)
       
        sleep(1)
 
-    logger.info('data logger thread stopping')
+    stop()
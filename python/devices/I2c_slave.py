@@ -36,9 +36,9 @@ class I2c_slave():
 
     def init_sensor_value_list(self, vals: list):
 
-       """ vals is the master list of sensor readings.  It may contain readings 
-           from sensors other than this one.  Tack this sensor's readings onto the list
-           and remember where in the list the readings are at. """
+       """ vals is the master table (a ReadingTable) of sensor readings.  It may contain readings 
+           from sensors other than this one.  Tack this sensor's readings onto the table
+           and remember where in the table the readings are at. """
       
        self.vals = vals
        
@@ -46,11 +46,9 @@ class I2c_slave():
 
        for a in self.config['attributes']:
 
-           self.vals.append(
+           #- self.attribute_value_indexes.append(a['attribute'].lower(), len(vals) - 1)
+           self.attribute_value_indexes[a['attribute'].lower()] = self.vals.add(
                {'value_name':a['value_name'], 'type':'environment', 'device_name':self.config['device_name'], 
                 'device_id':self.config['device_id'],
                 'subject':a['subject'], 'subject_location_id':a['subject_location_id'], 
                 'attribute':a['attribute'], 'value':None, 'units':a['units'], 'ts':None})
-
-           #- self.attribute_value_indexes.append(a['attribute'].lower(), len(vals) - 1)
-           self.attribute_value_indexes[a['attribute'].lower()] = len(vals) - 1
@@ -68,17 +68,15 @@ class Mh_z16_ndir_co2(I2c_slave):
             self.ppm = None
             self.parse(self.receive())
             if self.ppm:
-               self.vals[self.attribute_value_indexes['co2']]['value'] = '{:+.1f}'.format(self.ppm)
+               self.vals.update(self.attribute_value_indexes['co2'], round(self.ppm, 1), ts)
             else:
-               self.vals[self.attribute_value_indexes['co2']]['value'] = None
-
-            self.vals[self.attribute_value_indexes['co2']]['ts'] = ts 
+               self.vals.update(self.attribute_value_indexes['co2'], None, ts)
 
         #- except IOError:
         except:
             logger.error('cannot read MH-Z16 Co2 sensor: {}, {}'.format(exc_info()[0], exc_info()[1]))
             # Blank the sensor readings
-            self.vals[self.attribute_value_indexes['co2']]['value'] = None
+            self.vals.update(self.attribute_value_indexes['co2'], None)
 
 
     def parse(self, response):
@@ -62,18 +62,16 @@ class am2315(I2c_slave):
 
             for k,v in self.attribute_value_indexes.items():
                 if k == 'humidity':
-                    self.vals[v]['value'] = '{:+.1f}'.format(h)
-                    self.vals[v]['ts'] = ts 
+                    self.vals.update(v, round(h, 1), ts)
                 elif k == 'temperature':
-                    self.vals[v]['value'] = '{:+.1f}'.format(t)
-                    self.vals[v]['ts'] = ts 
+                    self.vals.update(v, round(t, 1), ts)
                 else:
                     logger.error('si7021 sensor - unknown attribute value {}, check the configuration'.format(k))
         except:
             logger.error('cannot read am2315 sensor: {}, {}'.format(exc_info()[0], exc_info()[1]))
             # Blank the sensor readings
             for k,v in self.attribute_value_indexes.items():
-                self.vals[v]['value'] = None 
+                self.vals.update(v, None, ts)
 
 
     def read_word(self):
@@ -50,8 +50,8 @@ class SecretKey:
         with open(configuration_directory_location + 'private_key', 'rb') as fp:
 
             self.secret_key = bytearray(32)
-            for i in range(0, 32):
-                self.secret_key[i] = ord(fp.read(1))
+            if fp.readinto(self.secret_key) != 32:
+                raise SecretKeyException('the private key file is too short')
 
             return self.secret_key
 
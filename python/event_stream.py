@@ -0,0 +1,130 @@
+# Live stream of fopd state changes.
+#
+# Resources publish changes to the module's event_stream (reading updates and actuator states)
+# and the local web server forwards them to browsers as server-sent events (see web/flask_app.py).
+#
+# Each subscriber has its own queue of pending changes keyed by what changed (e.g. the reading).
+# A new change replaces a pending change with the same key so a slow browser gets the latest value
+# of everything instead of an ever growing backlog, and it never holds up the publishers. New
+# subscribers start with the latest value of everything.
+#
+# Events are (event name, data) pairs:
+#
+#   ('reading', {'source':'mc', 'name':'air_temp', 'value':22.5, 'ts':1538000000.0})
+#   ('actuator', {'source':'cc', 'name':'grow_light_on', 'value':True, 'ts':1538000000.0})
+#
+
+from collections import OrderedDict
+from threading import Condition, Lock
+from time import time
+
+class StreamClient():
+
+    def __init__(self, latest):
+
+        self.condition = Condition()
+        self.pending = OrderedDict(latest)
+        self.closed = False
+
+    def put(self, key, event):
+
+        with self.condition:
+            self.pending[key] = event
+            self.condition.notify()
+
+    def take(self, timeout):
+        """ Wait up to timeout seconds for changes and return them as a list of events. The
+            list is empty if nothing changed or the client has been closed. """
+
+        with self.condition:
+            if not self.pending and not self.closed:
+                self.condition.wait(timeout)
+            events = list(self.pending.values())
+            self.pending.clear()
+            return events
+
+    def close(self):
+
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+class EventStream():
+
+    def __init__(self):
+
+        self.lock = Lock()
+        self.clients = []
+        self.latest = OrderedDict()
+        self.watched_tables = set()
+
+    def publish(self, event_name, key, data):
+
+        event = (event_name, data)
+
+        with self.lock:
+            self.latest[key] = event
+            clients = list(self.clients)
+
+        for c in clients:
+            c.put(key, event)
+
+    def publish_state(self, source, state):
+        """ Publish the actuator states (a dictionary of name:value) that have changed since they
+            were last published. """
+
+        ts = time()
+
+        for name, value in state.items():
+            key = ('actuator', source, name)
+            last = self.latest.get(key)
+            if last is None or last[1]['value'] != value:
+                self.publish('actuator', key, {'source':source, 'name':name, 'value':value, 'ts':ts})
+
+    def watch_table(self, source, table):
+        """ Publish every update of the readings in table (a ReadingTable). """
+
+        with self.lock:
+            if id(table) in self.watched_tables:
+                return
+            self.watched_tables.add(id(table))
+
+        names = [table.name_of(i) for i in range(len(table))]
+
+        def on_update(i, value, ts):
+            if i < len(names):
+                self.publish('reading', ('reading', source, names[i]),
+                             {'source':source, 'name':names[i], 'value':value, 'ts':ts})
+
+        table.add_listener(on_update)
+
+    def subscribe(self, max_clients):
+        """ Return a new StreamClient or None if there are already max_clients. """
+
+        with self.lock:
+            if len(self.clients) >= max_clients:
+                return None
+            client = StreamClient(self.latest)
+            self.clients.append(client)
+            return client
+
+    def unsubscribe(self, client):
+
+        with self.lock:
+            if client in self.clients:
+                self.clients.remove(client)
+        client.close()
+
+    def close(self):
+        """ stop callback - Release every subscriber. """
+
+        with self.lock:
+            clients = list(self.clients)
+
+        for c in clients:
+            c.close()
+
+    def client_count(self):
+        return len(self.clients)
+
+event_stream = EventStream()
@@ -2,7 +2,10 @@ from base64 import standard_b64encode
 from datetime import datetime, timezone
 from hashlib import sha256
 from jose import jws 
+from json import dumps, load
+from os import fsync, listdir, makedirs, path, remove, replace
 from requests import post
+from threading import Lock
 from time import time
 from uuid import uuid4
 
@@ -41,31 +44,129 @@ def claim_info(file_hash, time_stamp, camera_id):
             'file_dt':time_stamp,
             'file_hash':file_hash}
 
+# Files are read in chunks of this size.
+read_chunk_size = 64 * 1024
+
+# The decrypted hmac key is cached for the life of the process.
+hmac_key = None
+hmac_key_lock = Lock()
+
+def get_hmac_key():
+
+    global hmac_key
+
+    with hmac_key_lock:
+        if hmac_key is None:
+            hmac_key = decrypt(hmac_secret_key_b64_cipher)
+        return hmac_key
+
+def hash_bytes(data):
+    return standard_b64encode(sha256(data).digest()).decode('utf-8')
+
 def get_file_hash(path_name):
 
     m = sha256()
     with open(path_name, 'rb') as f:
-        for line in f:
-            m.update(line)
-            
+        for chunk in iter(lambda: f.read(read_chunk_size), b''):
+            m.update(chunk)
+
     return standard_b64encode(m.digest()).decode('utf-8')
 
-def get_jws(path_name, camera_id):
+def get_jws(path_name, camera_id, file_hash=None):
     """ create a jws token
         hmac_secret_key_b64_cipher - A 64 byte random value shared between the JWT client and the JWT server.
     """
 
-    return jws.sign(claim_info(get_file_hash(path_name), extract_timestamp(path_name), camera_id), 
-                    decrypt(hmac_secret_key_b64_cipher),
+    if file_hash is None:
+        file_hash = get_file_hash(path_name)
+
+    return jws.sign(claim_info(file_hash, extract_timestamp(path_name), camera_id), 
+                    get_hmac_key(),
                     algorithm='HS256')
 
-def upload_camera_image(path_name, url, camera_id):
+# Returns True if the server accepted the image. timeout is the number of seconds to wait for the
+# server to accept the connection or to send data (see requests) so that a hung upload can't hold
+# a subscriber worker forever.
+def upload_camera_image(path_name, url, camera_id, timeout=60):
 
+    # Read the file once. The hash (for the jws) and the upload both use the same bytes.
     with open(path_name, 'rb') as f:
-        r = post('{}'.format(url), 
-                 data={'auth_method':'JWS', 'auth_data':get_jws(path_name, camera_id)}, 
-                 files={'file':f}) 
+        data = f.read()
+
+    r = post('{}'.format(url), 
+             data={'auth_method':'JWS', 'auth_data':get_jws(path_name, camera_id, hash_bytes(data))}, 
+             files={'file':(path.basename(path_name), data)},
+             timeout=timeout) 
 
     result = r.content.decode('utf-8')
     if result != 'ok':
         logger.error('Image upload error, server response -> {}'.format(result))
+        return False
+
+    return True
+
+# Pictures waiting to be uploaded are kept on disk, one small json file per picture, so that the
+# pictures taken while the network or the server is down are uploaded later, oldest first, even
+# if fopd is restarted in the meantime. The entries are named after the picture files, which are
+# named after the time that they were taken.
+#
+class UploadQueue():
+
+    def __init__(self, directory, timeout=60):
+
+        self.directory = directory
+        self.timeout = timeout
+        self.lock = Lock()
+
+    def entry_names(self):
+
+        if not path.isdir(self.directory):
+            return []
+
+        return sorted([n for n in listdir(self.directory) if n.endswith('.json')])
+
+    def __len__(self):
+        return len(self.entry_names())
+
+    def put(self, path_name, url, camera_id):
+        """ Add a picture to the queue. Adding a picture that is already queued does nothing. """
+
+        with self.lock:
+
+            makedirs(self.directory, exist_ok=True)
+
+            entry_path = path.join(self.directory, path.basename(path_name) + '.json')
+            if path.exists(entry_path):
+                return
+
+            tmp_path = entry_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                f.write(dumps({'path':path_name, 'url':url, 'camera_id':camera_id}))
+                f.flush()
+                fsync(f.fileno())
+            replace(tmp_path, entry_path)
+
+    def drain(self):
+        """ Upload the queued pictures, oldest first. Returns False if an upload failed. The failed
+            picture and the ones after it stay queued. """
+
+        with self.lock:
+
+            for name in self.entry_names():
+
+                entry_path = path.join(self.directory, name)
+
+                with open(entry_path) as f:
+                    entry = load(f)
+
+                if not path.exists(entry['path']):
+                    logger.warning('queued picture {} no longer exists, it will not be uploaded'.format(entry['path']))
+                    remove(entry_path)
+                    continue
+
+                if not upload_camera_image(entry['path'], entry['url'], entry['camera_id'], self.timeout):
+                    return False
+
+                remove(entry_path)
+
+        return True
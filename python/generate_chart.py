@@ -1,17 +1,23 @@
 from os import getcwd, path
 import pygal
 from sys import exc_info
-import requests
 import json
 from datetime import datetime
 
-from python.encryption.nacl_fop import decrypt
-
 from python.data_file_paths import local_web_chart_directory
-from config import local_couchdb_url, couchdb_username, couchdb_password_b64_cipher 
+from python.logData import get_couchdb_session
 
 enable_display_unit_error_msg = None 
 
+# Each chart keeps its last points in memory so that only readings that are newer than the
+# newest cached one (the high water mark) are fetched from couchdb. The chart is only rendered
+# again when new readings arrive.
+#
+#   chart_cache[chart_file_name] = {'key':(attribute, couchdb_name), 'points':[[timestamp, value], ...],
+#                                   'high_water':timestamp of the newest point or None}
+#
+chart_cache = {}
+
 # TODO: Current the system supports converting from celsius to fahrenheit. As the need arises
 #       add more unit conversions.
 #
@@ -43,72 +49,124 @@ def apply_unit_conversion(val_tree, chart_info, logger):
     else:
         return val_tree['value']['value']
 
-def get_chart_data(couchdb_url, chart_info, logger):
+def get_chart_data(couchdb_url, chart_info, logger, limit=60, since=None):
+    """ Return the newest limit rows, newest first, of the chart's readings that are newer than since. """
+
+    # The attribute_value view is keyed by [attribute, name, timestamp].
+    if since is None:
+        endkey = '["{0}","{1}"]'
+    else:
+        endkey = '["{0}","{1}",' + json.dumps(since) + ']'
 
-    # Get the data from couch
-    #
     couch_query = couchdb_url + '/_design/doc/_view/attribute_value?'\
-                     + 'startkey=["{0}","{1}",{2}]&endkey=["{0}"]&descending=true&limit=60'.format(
-                     chart_info['attribute'], chart_info['couchdb_name'], '{}')
+                     + ('startkey=["{0}","{1}",{2}]&endkey=' + endkey + '&descending=true&limit={3}').format(
+                     chart_info['attribute'], chart_info['couchdb_name'], '{}', limit)
                      
     logger.info('prepared couchdb query: {}'.format(couch_query))
     
     try:
-        r = requests.get(couch_query,
-                         auth=(couchdb_username, decrypt(couchdb_password_b64_cipher).decode('utf-8')))
+        r = get_couchdb_session().get(couch_query)
 
         if r.status_code != 200: 
             logger.error('local couchdb return an error code: {}, {}...'.format(r.status_code, r.text[0:100]))
             return None
         else:
-            return r.json()
+            data = r.json()
+            if since is not None:
+                # endkey is inclusive so drop the row at the high water mark.
+                data['rows'] = [x for x in data['rows'] if x['value']['timestamp'] > since]
+            return data
 
     except:
         logger.error('Cannot connect to the local Couchdb instance: {}, {}'.format(exc_info()[0], exc_info()[1]))
         return None
 
+def update_chart_cache(couchdb_url, chart_info, logger, points):
+    """ Fetch the chart's new readings. Return the cache entry or None if there is nothing new. """
 
-# Use a view in CouchDB to get the data
-#use the first key for attribute type
-#order descending so when limit the results will get the latest at the top
+    key = (chart_info['attribute'], chart_info['couchdb_name'])
+    cache = chart_cache.get(chart_info['chart_file_name'])
 
-def generate_chart(couchdb_url, chart_info, logger):
+    if cache is None or cache['key'] != key:
+        cache = {'key':key, 'points':[], 'high_water':None}
+        chart_cache[chart_info['chart_file_name']] = cache
 
-    logger.debug('generating web charts')
+    data = get_chart_data(couchdb_url, chart_info, logger, points, cache['high_water'])
+
+    if not data or not data['rows']:
+        return None
+
+    global enable_display_unit_error_msg
+    enable_display_unit_error_msg = True
+
+    # Rows are newest first.
+    new_points = [[x['value']['timestamp'], float(apply_unit_conversion(x, chart_info, logger))]
+                  for x in reversed(data['rows'])]
+
+    cache['points'] = (cache['points'] + new_points)[-points:]
+    cache['high_water'] = cache['points'][-1][0]
+
+    return cache
+
+
+def make_line_chart(chart_info, cache):
+
+    ts_lst = [datetime.fromtimestamp(p[0]).strftime('%m/%d %I:%M %p') for p in cache['points']]
+    v_lst = [p[1] for p in cache['points']]
+
+    # line_chart = pygal.Line(interpolate='cubic')
+    line_chart = pygal.Line(x_label_rotation=20, show_minor_x_labels=False)
+    line_chart.title = chart_info['chart_title']
+    line_chart.y_title= chart_info['y_axis_title']
+    line_chart.x_title= chart_info['x_axis_title']
+
+    line_chart.x_labels = ts_lst
+    # Major label every 8'th time point
+    line_chart.x_labels_major = ts_lst[::8]
+
+    line_chart.add(chart_info['data_stream_name'], v_lst)
+
+    return line_chart
+
+def render_chart(couchdb_url, chart_info, logger, points=60):
+    """ Return the chart as svg (bytes) and its data version (the time stamp of the newest reading).
+        svg is None if there are no new readings since the last call. """
 
     try:
+        cache = update_chart_cache(couchdb_url, chart_info, logger, points)
 
-        data =  get_chart_data(couchdb_url, chart_info, logger)
-        if data:
-            
-            global enable_display_unit_error_msg
-            enable_display_unit_error_msg = True
-            v_lst = [float(apply_unit_conversion(x, chart_info, logger)) for x in data['rows']]
+        if cache:
+            return make_line_chart(chart_info, cache).render(), cache['high_water']
+        else:
+            return None, chart_cache[chart_info['chart_file_name']]['high_water']
+    except:
+        logger.error('Chart rendering failed: {}, {}'.format(exc_info()[0], exc_info()[1]))
+        return None, None
 
-            ts_lst = [datetime.fromtimestamp(x['value']['timestamp']).strftime('%m/%d %I:%M %p')\
-                      for x in data['rows']]
-            ts_lst.reverse()
 
-            # line_chart = pygal.Line(interpolate='cubic')
-            line_chart = pygal.Line(x_label_rotation=20, show_minor_x_labels=False)
-            line_chart.title = chart_info['chart_title']
-            line_chart.y_title= chart_info['y_axis_title']
-            line_chart.x_title= chart_info['x_axis_title']
+# Use a view in CouchDB to get the data
+#use the first key for attribute type
+#order descending so when limit the results will get the latest at the top
+
+def generate_chart(couchdb_url, chart_info, logger, points=60):
 
-            line_chart.x_labels = ts_lst
-            # Major label every 8'th time point
-            line_chart.x_labels_major = ts_lst[::8]
+    logger.debug('generating web charts')
+
+    try:
 
-            #need to reverse order to go from earliest to latest
-            v_lst.reverse()
+        cache = update_chart_cache(couchdb_url, chart_info, logger, points)
 
-            line_chart.add(chart_info['data_stream_name'], v_lst)
+        if cache:
+            
+            line_chart = make_line_chart(chart_info, cache)
             #- line_chart.render_to_file(getcwd() + '/web/static/' + chart_info['chart_file_name'])
 
 
             line_chart.render_to_file(path.join(local_web_chart_directory, chart_info['chart_file_name']))
             #- line_chart.render_to_file(path.join(web_directory_location, chart_info['chart_file_name']))
 
+        elif chart_cache[chart_info['chart_file_name']]['high_water'] is not None:
+            logger.debug('no new data for {}, keeping the current chart'.format(chart_info['chart_file_name']))
         else:
             logger.error('No chart data available')
     except:
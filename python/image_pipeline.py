@@ -0,0 +1,86 @@
+# Camera picture post processing.
+#
+# - picture_hash returns a perceptual hash (dHash) of a picture. Pictures that look alike have
+#   hashes that differ in only a few bits (see hash_distance) so the camera controller can skip
+#   pictures that are nearly identical to the last one (e.g. the grow chamber with the lights off).
+# - publish_web_image puts a picture on the local web site as a progressive JPEG that is no
+#   bigger than the web page shows it.
+#
+# Files are always replaced atomically (write a temporary file and rename it) so the web server
+# never serves a half written picture.
+#
+# Pillow (PIL) is optional. Without it pictures are not hashed and publish_web_image hard links
+# (or copies) the picture as is.
+#
+
+from os import link, path, remove, replace
+from shutil import copyfile
+from sys import exc_info
+
+from python.logger import get_sub_logger
+
+logger = get_sub_logger(__name__)
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+def picture_hash(file_location, hash_size=8):
+    """ Return the dHash of the picture as an int, or None if it can't be computed. """
+
+    if Image is None:
+        return None
+
+    try:
+        with Image.open(file_location) as im:
+            # Compare each pixel to its right hand neighbour in a tiny grey scale copy of the picture.
+            pixels = list(im.convert('L').resize((hash_size + 1, hash_size), Image.BILINEAR).getdata())
+
+        h = 0
+        for row in range(hash_size):
+            for col in range(hash_size):
+                i = row * (hash_size + 1) + col
+                h = (h << 1) | (1 if pixels[i] > pixels[i + 1] else 0)
+        return h
+
+    except:
+        logger.error('cannot hash picture {}: {}, {}'.format(file_location, exc_info()[0], exc_info()[1]))
+        return None
+
+def hash_distance(h1, h2):
+    """ Return the number of bits that are different in two picture hashes. """
+    return bin(h1 ^ h2).count('1')
+
+def link_or_copy(src, dest):
+
+    tmp = dest + '.tmp'
+    if path.exists(tmp):
+        remove(tmp)
+
+    try:
+        link(src, tmp)
+    except OSError:
+        # e.g. src and dest are on different file systems.
+        copyfile(src, tmp)
+
+    replace(tmp, dest)
+
+def save_jpeg(im, dest, quality):
+
+    tmp = dest + '.tmp'
+    im.save(tmp, 'JPEG', quality=quality, optimize=True, progressive=True)
+    replace(tmp, dest)
+
+def publish_web_image(file_location, dest, max_size=(720, 720), quality=85):
+    """ Put the picture at file_location on the web site at dest. """
+
+    if Image is None:
+        link_or_copy(file_location, dest)
+        return
+
+    with Image.open(file_location) as im:
+
+        web_image = im.convert('RGB')
+        web_image.thumbnail(max_size, Image.LANCZOS)
+        save_jpeg(web_image, dest, quality)
@@ -1,6 +1,9 @@
 from sys import path, exc_info
 from os import getcwd
 from datetime import tzinfo, datetime
+from queue import Queue, Empty
+from threading import Lock, Thread
+from time import time
 import requests
 import json
 
@@ -10,6 +13,16 @@ from python.logger import get_sub_logger
 
 logger = get_sub_logger(__name__)
 
+# One pooled http session is shared by all the local couchdb traffic. The couchdb password is
+# decrypted once when the session is created instead of once per post.
+couchdb_session = None
+couchdb_session_lock = Lock()
+
+# The background writer (see start_couchdb_writer) puts log records on this queue. If there is
+# no writer running then logDB posts each record on the caller's thread.
+couchdb_write_queue = None
+couchdb_writer_thread = None
+
 # TBD - Need to make add capability to system to log to a file.
 def logFile(timestamp, name, status, attribute, value, comment):
     #TBD - Need to put a file rotation scheme in place for the text file.
@@ -26,23 +39,81 @@ def logFile(timestamp, name, status, attribute, value, comment):
         logger.error('Error writing to data file: {}'.format(exc_info()[0]))
 
 
+def get_couchdb_session():
+
+    global couchdb_session
+
+    with couchdb_session_lock:
+        if couchdb_session is None:
+            session = requests.Session()
+            session.auth = (couchdb_username, decrypt(couchdb_password_b64_cipher).decode('utf-8'))
+            session.headers.update({'content-type': 'application/json'})
+            couchdb_session = session
+
+        return couchdb_session
+
+
+def make_log_record(r, comment=''):
+
+    return {'timestamp' : r['ts'],
+            'name' :      '{} {}'.format(r['subject'],r['attribute']),
+            'status' :    'Success',
+            'attribute' : r['attribute'],
+            'value' :     r['value'],
+            'units' :     r['units'],
+            'comment' :   comment}
+
+
+# Rollup documents summarize every reading taken during an interval (see python/reading_rollup.py).
+# They are named '<subject> <attribute> rollup' so that they don't show up in the reading charts.
+#
+def make_rollup_record(rollup, comment=''):
+
+    return {'timestamp' : rollup['end'],
+            'name' :      '{} {} rollup'.format(rollup['subject'], rollup['attribute']),
+            'status' :    'Success',
+            'type' :      'rollup',
+            'attribute' : rollup['attribute'],
+            'units' :     rollup['units'],
+            'start' :     rollup['start'],
+            'end' :       rollup['end'],
+            'count' :     rollup['count'],
+            'missing' :   rollup['missing'],
+            'min' :       rollup['min'],
+            'max' :       rollup['max'],
+            'mean' :      rollup['mean'],
+            'stddev' :    rollup['stddev'],
+            'last' :      rollup['last'],
+            'comment' :   comment}
+
+
 def logDB(r, comment=''):
 
-    log_record = {'timestamp' : r['ts'],
-                  'name' :      '{} {}'.format(r['subject'],r['attribute']),
-                  'status' :    'Success',
-                  'attribute' : r['attribute'],
-                  'value' :     r['value'],
-                  'units' :     r['units'],
-                  'comment' :   comment}
+    log_record = make_log_record(r, comment)
 
     logger.info('couchd db write: {}, {}, {}, {}, {}'.format(log_record['name'], 
                                                              log_record['status'], log_record['attribute'], 
                                                              log_record['value'], log_record['comment']))
 
-    json_data = json.dumps(log_record)
-    headers = {'content-type': 'application/json'}
-    
+    write_log_record(log_record)
+
+
+def logDB_rollup(rollup, comment=''):
+
+    log_record = make_rollup_record(rollup, comment)
+
+    logger.info('couchd db write: {}, count: {}, min: {}, max: {}, mean: {}'.format(log_record['name'], 
+                log_record['count'], log_record['min'], log_record['max'], log_record['mean']))
+
+    write_log_record(log_record)
+
+
+def write_log_record(log_record):
+
+    if couchdb_write_queue:
+        couchdb_write_queue.put(log_record)
+        return
+
     """
     if there is a network problem like a DNS failure, or refused connection the Requests library will
     raise a ConnectionError exception.  With invalid HTTP responses, Requests will also raise an HTTPError 
@@ -52,9 +123,91 @@ def logDB(r, comment=''):
     """
 
     try:
-        r = requests.post(local_couchdb_url, data = json_data, headers=headers, 
-                          auth=(couchdb_username, decrypt(couchdb_password_b64_cipher).decode('utf-8')))
+        r = get_couchdb_session().post(local_couchdb_url, data = json.dumps(log_record))
+        if r.status_code != 201:
+            logger.error('local couchdb return an error code: {}, {}...'.format(r.status_code, r.text[0:100]))
+    except:
+        logger.error('cannot post data to the local couchdb: {}, {}'.format(exc_info()[0], exc_info()[1]))
+
+
+def post_bulk_docs(docs):
+
+    # _bulk_docs answers 201 even when individual documents are rejected so look at the
+    # per document results as well as the status code.
+    try:
+        r = get_couchdb_session().post(local_couchdb_url + '/_bulk_docs', data = json.dumps({'docs':docs}))
         if r.status_code != 201:
             logger.error('local couchdb return an error code: {}, {}...'.format(r.status_code, r.text[0:100]))
+            return
+
+        errors = [d for d in r.json() if 'error' in d]
+        if errors:
+            logger.error('local couchdb rejected {} of {} documents: {}...'.format(len(errors), len(docs), errors[0]))
+        else:
+            logger.debug('posted {} documents to the local couchdb'.format(len(docs)))
     except:
         logger.error('cannot post data to the local couchdb: {}, {}'.format(exc_info()[0], exc_info()[1]))
+
+
+def run_couchdb_writer(write_queue, flush_size, flush_age):
+
+    # Collect log records into a batch and post the batch when it holds flush_size records or
+    # when its oldest record is flush_age seconds old. A None on the queue flushes and stops the writer.
+    batch = []
+    batch_start_time = None
+
+    while True:
+
+        if batch:
+            timeout = max(0, batch_start_time + flush_age - time())
+        else:
+            # Nothing is waiting to be written so sleep until the next record arrives.
+            timeout = None
+
+        try:
+            log_record = write_queue.get(timeout=timeout)
+        except Empty:
+            log_record = False
+
+        if log_record:
+            if not batch:
+                batch_start_time = time()
+            batch.append(log_record)
+
+        if batch and (log_record is None or len(batch) >= flush_size or time() - batch_start_time >= flush_age):
+            post_bulk_docs(batch)
+            batch = []
+
+        if log_record is None:
+            break
+
+    logger.info('couchdb writer stopping')
+
+
+def start_couchdb_writer(flush_size=10, flush_age=5):
+
+    global couchdb_write_queue, couchdb_writer_thread
+
+    if couchdb_writer_thread:
+        return
+
+    logger.info('starting couchdb writer, flush size: {}, flush age: {} seconds'.format(flush_size, flush_age))
+
+    couchdb_write_queue = Queue()
+    couchdb_writer_thread = Thread(target=run_couchdb_writer, name='couchdb_writer', daemon=True,
+                                   args=(couchdb_write_queue, flush_size, flush_age))
+    couchdb_writer_thread.start()
+
+
+def stop_couchdb_writer():
+
+    # Flush whatever is waiting and go back to posting on the caller's thread.
+    global couchdb_write_queue, couchdb_writer_thread
+
+    if couchdb_writer_thread:
+        write_queue, writer_thread = couchdb_write_queue, couchdb_writer_thread
+        couchdb_write_queue = None
+        couchdb_writer_thread = None
+
+        write_queue.put(None)
+        writer_thread.join(timeout=30)
@@ -4,6 +4,7 @@ from logging import getLogger
 
 from importlib import import_module
 from python.repl import start as repl_start
+from python.runtime import EventLoopRuntime
 from python.logger import get_top_level_logger
 from python.updater import updater_init 
 
@@ -32,17 +33,37 @@ def execute_main(args, default_device_name):
     logger.info('fopd device id: {}'.format(system['device_id']))
 
     c = {'device_name': device_name}
-    app_state = {'system': system, 'config': c, 'stop': False, 'silent_mode':args.silent, 'sys':{'cmd':None}}
+    # stop_callbacks holds functions that are called when fopd is told to stop. Resources that block
+    # waiting for work (e.g. on a queue) add a function here that wakes them up.
+    app_state = {'system': system, 'config': c, 'stop': False, 'stop_callbacks': [], 'silent_mode':args.silent,
+                 'sys':{'cmd':None}}
 
     # create a Barrier that all the threads can syncronize on. This is to
     # allow threads such as mqtt or data loggers to get initialized before
     # other threads try to call them.
     #
+    # If the event loop runtime is configured then resources that support it (i.e. their module
+    # has a schedule function) are run by a single event loop thread instead of a thread apiece.
+    use_event_loop = system.get('runtime', {}).get('mode') == 'event_loop'
+
     # Figure out how many active resources there are. Each active one needs to sync to the barrier.
     active_resource_count = 0
+    loop_resources = []
+    thread_resources = []
     for r in system['resources']:
+
+        m = import_module(r['imp'])
+
         if r['enabled']:
-            active_resource_count += 1
+            if use_event_loop and hasattr(m, 'schedule'):
+                loop_resources.append({'module':m, 'args':r['args']})
+            else:
+                thread_resources.append((m, r))
+                active_resource_count += 1
+
+    # The event loop runtime syncs to the barrier once for all of its resources.
+    if loop_resources:
+        active_resource_count += 1
 
     # Each resource will use the barrier to signal when they have completed their initialization.
     # In addtion add one to the active resource count for the repl thread. It will also signal when it
@@ -53,15 +74,15 @@ def execute_main(args, default_device_name):
 
     # Each resource is implemented as a thread. Setup all the threads.
     tl = []
-    for r in system['resources']:
-
-        m = import_module(r['imp'])
-
-        if r['enabled']:
-            if r['daemon']:
-                tl.append(threading.Thread(target=m.start, daemon=r['daemon'], name=r['args']['name'], args=(app_state, r['args'], b)))
-            else:
-                tl.append(threading.Thread(target=m.start, name=r['args']['name'], args=(app_state, r['args'], b)))
+    for m, r in thread_resources:
+        if r['daemon']:
+            tl.append(threading.Thread(target=m.start, daemon=r['daemon'], name=r['args']['name'], args=(app_state, r['args'], b)))
+        else:
+            tl.append(threading.Thread(target=m.start, name=r['args']['name'], args=(app_state, r['args'], b)))
+
+    if loop_resources:
+        runtime = EventLoopRuntime(app_state, system['runtime'])
+        tl.append(threading.Thread(target=runtime.run, name='runtime', args=(loop_resources, b)))
 
     # start the built in REPL interpretter.
     tl.append(threading.Thread(target=repl_start, name='repl', args=(app_state, args.silent, b)))
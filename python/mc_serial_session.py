@@ -0,0 +1,222 @@
+# Serial session with the OpenAg micro-controller.
+#
+# The micro-controller answers each command with zero or more lines followed by an "OK" line. The
+# session owns the serial port: a writer thread sends queued requests and a reader thread collects
+# the lines of each response until it sees "OK" and hands the response to the waiting caller.
+#
+# - Requests are sent in priority order (lowest number first) so that a camera pose command does
+#   not wait behind queued status polls.
+# - Up to pipeline_depth requests can be outstanding at once. The micro-controller answers commands
+#   in order so responses are matched to requests first in, first out. The default of 1 matches
+#   the behaviour of sending a command and waiting for its response.
+# - A request whose response does not arrive within response_timeout seconds is abandoned and the
+#   input buffer is flushed so that later responses are not matched to the wrong request.
+# - A request whose caller stops waiting before it has been sent is cancelled and never sent, so
+#   a command that has been reported as failed is not run late.
+# - Lines that arrive while no request is outstanding (e.g. sensor error messages) are passed to
+#   the 'line' handlers. A reset banner from the micro-controller fails every outstanding request
+#   and is passed to the 'reset' handlers.
+#
+
+from collections import deque
+from heapq import heappush, heappop
+from itertools import count
+from sys import exc_info
+from threading import Condition, Event, Thread
+from time import sleep, time
+
+from python.logger import get_sub_logger
+
+logger = get_sub_logger(__name__)
+
+reset_banner = 'OpenAg Serial Monitor Starting'
+
+# Request priorities
+pose_priority = 0
+cmd_priority = 1
+poll_priority = 2
+
+class McSerialSession():
+
+    def __init__(self, ser, response_timeout=5, pipeline_depth=1):
+
+        self.ser = ser
+        self.response_timeout = response_timeout
+        self.pipeline_depth = pipeline_depth
+
+        self.condition = Condition()
+        self.stopped = False
+
+        # heap of (priority, sequence number, request)
+        self.pending = []
+        self.sequence = count()
+
+        # requests that have been sent and are waiting for a response - oldest first.
+        self.inflight = deque()
+
+        self.handlers = {'line':[], 'reset':[]}
+
+        self.threads = [Thread(target=self.run_writer, name='mc_writer', daemon=True),
+                        Thread(target=self.run_reader, name='mc_reader', daemon=True)]
+
+    def start(self):
+
+        for t in self.threads:
+            t.start()
+
+    def close(self):
+
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+        for t in self.threads:
+            t.join(self.response_timeout)
+
+    def add_handler(self, kind, func):
+        """ kind is 'line' or 'reset'. func(line) is called on the reader thread so it must not
+            make requests of its own. """
+
+        self.handlers[kind].append(func)
+
+    def request(self, cmd, priority=poll_priority, timeout=None):
+        """ Send cmd (bytes) and return the lines of the response (without the "OK" line), or
+            None if no response arrived in time. """
+
+        r = {'cmd':cmd, 'done':Event(), 'response':None, 'sent_time':None, 'cancelled':False}
+
+        with self.condition:
+            if self.stopped:
+                return None
+            heappush(self.pending, (priority, next(self.sequence), r))
+            self.condition.notify_all()
+
+        if not r['done'].wait(timeout if timeout is not None else self.response_timeout * 2):
+            with self.condition:
+                if r['sent_time'] is None:
+                    # Still queued. Don't send it.
+                    r['cancelled'] = True
+                    logger.warning('micro-controller command {} was not sent in time, cancelled it'.format(cmd))
+                else:
+                    logger.warning('no response from the micro-controller to {}'.format(cmd))
+
+        return r['response']
+
+    def complete(self, r, response):
+
+        r['response'] = response
+        r['done'].set()
+
+    def run_writer(self):
+
+        while True:
+
+            with self.condition:
+
+                while not self.stopped and (not self.pending or len(self.inflight) >= self.pipeline_depth):
+                    self.condition.wait()
+
+                if self.stopped:
+                    break
+
+                priority, seq, r = heappop(self.pending)
+                if r['cancelled']:
+                    continue
+
+                r['sent_time'] = time()
+                self.inflight.append(r)
+
+                # Write while holding the lock so that the order of the inflight queue
+                # matches the order of the commands on the wire.
+                try:
+                    logger.debug('micro-controller command: {}'.format(r['cmd']))
+                    self.ser.write(r['cmd'])
+                except:
+                    logger.error('serial interface error {}, {}'.format(exc_info()[0], exc_info()[1]))
+                    self.inflight.remove(r)
+                    self.complete(r, None)
+
+        # Nothing more will be sent so release anybody that is waiting.
+        with self.condition:
+            while self.pending:
+                self.complete(heappop(self.pending)[2], None)
+
+    def expire_requests(self):
+
+        with self.condition:
+
+            if self.inflight and time() - self.inflight[0]['sent_time'] > self.response_timeout:
+
+                logger.error('micro-controller response timeout, abandoning {} outstanding commands'.format(
+                             len(self.inflight)))
+
+                # The remaining responses can't be matched reliably so drop all of them.
+                while self.inflight:
+                    self.complete(self.inflight.popleft(), None)
+                self.ser.reset_input_buffer()
+                self.condition.notify_all()
+                return True
+
+        return False
+
+    def call_handlers(self, kind, line):
+
+        for h in self.handlers[kind]:
+            try:
+                h(line)
+            except:
+                logger.error('micro-controller {} handler failed: {}, {}'.format(kind, exc_info()[0], exc_info()[1]))
+
+    def run_reader(self):
+
+        partial = b''
+        lines = []
+
+        while not self.stopped:
+
+            if self.expire_requests():
+                partial = b''
+                lines = []
+
+            try:
+                data = self.ser.read_until(b'\n')
+            except:
+                logger.error('serial interface error {}, {}'.format(exc_info()[0], exc_info()[1]))
+                sleep(1)
+                continue
+
+            if not data.endswith(b'\n'):
+                # The serial port timed out part way through a line (or with nothing to read).
+                partial = partial + data
+                continue
+
+            line = (partial + data).decode('utf-8', 'replace').rstrip('\r\n')
+            partial = b''
+
+            if line.startswith(reset_banner):
+                logger.warning('micro reset detected: {}'.format(line))
+                with self.condition:
+                    while self.inflight:
+                        self.complete(self.inflight.popleft(), None)
+                    self.condition.notify_all()
+                lines = []
+                self.call_handlers('reset', line)
+                continue
+
+            with self.condition:
+                waiting = len(self.inflight) > 0
+
+            if not waiting:
+                # Nobody asked for this line.
+                if line != 'OK':
+                    self.call_handlers('line', line)
+                continue
+
+            if line == 'OK':
+                with self.condition:
+                    if self.inflight:
+                        self.complete(self.inflight.popleft(), lines)
+                    self.condition.notify_all()
+                lines = []
+            else:
+                lines.append(line)
@@ -1,7 +1,10 @@
 # Note: PJON is an open source network protocol for IoT communication that could be
 #       an alternative for MQTT. See https://github.com/gioblu/PJON
 
+from collections import OrderedDict
 from datetime import datetime
+from json import dumps
+from os import path as os_path
 from queue import Queue, Empty
 from subprocess import * 
 from sys import path, exc_info
@@ -10,9 +13,12 @@ from time import sleep, time
 #- import paho.mqtt.client
 import paho.mqtt.client as mqtt
 
+from python.data_file_paths import state_directory_location
 from python.logger import get_sub_logger 
 from python.encryption.nacl_fop import decrypt
-from python.send_mqtt_data import publish_sensor_reading, publish_cmd_response #- send_sensor_data_via_mqtt_v2
+from python.publish_journal import PublishJournal
+from python.stop import request_stop
+from python.send_mqtt_data import publish_sensor_reading, publish_sensor_readings, publish_sensor_rollups, publish_cmd_response #- send_sensor_data_via_mqtt_v2
 
 logger = get_sub_logger(__name__)
 
@@ -22,6 +28,18 @@ mqtt_connection_results = ('connection successful', 'connection refused - incorr
 
 connection_rc = None
 connection_flags = None
+broker_connected = False
+
+# A journal record that could not be published. It is not acknowledged. It is tried again, before
+# any later record, every journal retry_interval seconds, up to journal max_retries times.
+unpublished = {'record':None, 'retry_time':0, 'attempts':0}
+
+# publish_item returns this for an item that can never be published (an unknown item type or a
+# payload that can't be made). Any other failure returns None and may succeed if it is tried again.
+cannot_publish = 'cannot publish'
+
+# Journal records that are given up on are appended here, one json item per line.
+dead_letter_file = 'mqtt_dead_letters.json'
 
 def connection_result(rc):
     if rc >= 0 and rc <= 5:
@@ -60,24 +78,99 @@ def make_mqtt_help(res_name):
     def mqtt_help():
         return """\
         {0}.publish(sensor_reading) - Publish a sensor reading.
+        {0}.publish_readings(list)  - Publish a list of sensor readings taken at the same time.
+        {0}.publish_rollups(list)   - Publish a list of reading rollups (see python/reading_rollup.py).
+        {0}.journal_stats()         - Show the publish journal backlog and replay counters.
         """.format(res_name)
 
     return mqtt_help
 
 
-def make_on_connect(mqtt_client_id):
+def make_publish(publish_queue, journal):
+
+    # If there is a journal then readings go to disk first and the MQTT thread replays them to
+    # the broker, otherwise they wait in memory on the publish queue.
+    def publish(sensor_reading):
+        if journal:
+            journal.append(['sensor_reading', dict(sensor_reading)])
+            # wake the MQTT thread so that it replays the new record.
+            publish_queue.put(['wake', None])
+        else:
+            publish_queue.put(['sensor_reading', sensor_reading])
+        return 'OK'
+
+    return publish
+
+
+def make_publish_readings(publish_queue, journal, args):
+
+    # data/v1 sends one message per reading, data/v2 sends the whole list in one message.
+    def publish_readings(sensor_readings):
+
+        if args.get('data_topic_version', 'v1') == 'v2':
+            items = [['sensor_readings', [dict(r) for r in sensor_readings]]]
+        else:
+            items = [['sensor_reading', dict(r)] for r in sensor_readings]
+
+        for item in items:
+            if journal:
+                journal.append(item)
+            else:
+                publish_queue.put(item)
+
+        if journal:
+            publish_queue.put(['wake', None])
+
+        return 'OK'
+
+    return publish_readings
+
+
+def make_publish_rollups(publish_queue, journal):
+
+    def publish_rollups(rollups):
+
+        item = ['sensor_rollups', rollups]
+
+        if journal:
+            journal.append(item)
+            publish_queue.put(['wake', None])
+        else:
+            publish_queue.put(item)
+
+        return 'OK'
+
+    return publish_rollups
+
+
+def make_journal_stats(journal):
+
+    def journal_stats():
+        if journal:
+            return journal.stats()
+        else:
+            return 'the publish journal is not enabled'
+
+    return journal_stats
+
+
+def make_on_connect(mqtt_client_id, publish_queue):
 
     def on_connect(client, userdata, flags, rc):
 
-        global connection_rc, connection_flags
+        global connection_rc, connection_flags, broker_connected
         connection_rc = rc
         connection_flags = flags
+        broker_connected = rc == 0
 
         if rc == 0:
             logger.info('MQTT broker connection successful. Clean session: {}'.format(flags['session present']))
             if flags['session present'] != 1:
                 # The broker doesn't have the previous session so you need to subscribe again
                 subscribe_for_commands(client, mqtt_client_id)
+
+            # wake the MQTT thread so that it replays anything saved while the broker was away.
+            publish_queue.put(['wake', None])
         else:
             logger.error('MQTT broker connection failed: {}:{}'.format(rc, connection_result(rc)))
 
@@ -101,15 +194,22 @@ def on_connect(client, userdata, flags, rc):
 
 def on_disconnect(mqtt, userdata, rc):
 
-    global connection_rc
+    global connection_rc, broker_connected
     connection_rc = rc
+    broker_connected = False
     
     logger.warning('MQTT Disconnected.')
 
 
-def on_publish(mqttc, obj, mid):
+def make_on_publish(publish_queue):
+
+    # Let the MQTT thread know that the broker has the message so it can advance the journal.
+    def on_publish(mqttc, obj, mid):
 
-   logger.debug('MQTT message published, mid={}'.format(mid))
+        logger.debug('MQTT message published, mid={}'.format(mid))
+        publish_queue.put(['published', mid])
+
+    return on_publish
 
 
 def on_subscribe(mqtt, userdata, mid, granted_qos):
@@ -145,9 +245,9 @@ def start_paho_mqtt_client(args, app_state, publish_queue):
 
         # Configure the client callback functions
         #- mqtt_client.on_connect = on_connect
-        mqtt_client.on_connect = make_on_connect(args['mqtt_client_id'])
+        mqtt_client.on_connect = make_on_connect(args['mqtt_client_id'], publish_queue)
         mqtt_client.on_message = make_on_message(app_state, publish_queue)
-        mqtt_client.on_publish = on_publish
+        mqtt_client.on_publish = make_on_publish(publish_queue)
         mqtt_client.on_disconnect = on_disconnect
         mqtt_client.on_subscribe = on_subscribe
 
@@ -195,6 +295,142 @@ def subscribe_for_commands(mqtt_client, mqtt_client_id):
 2020-10-04 03:15:06 AM CDT INFO p3demo.python.mqtt_client:mqtt broker connection successful
 """
 
+def topic_qos(args, topic):
+
+    # e.g. 'topic_qos':{'data/v1':2, 'data/v2':1, 'cr/v1':2}, QoS 2 is used for unlisted topics.
+    return args.get('topic_qos', {}).get(topic, 2)
+
+
+def publish_item(mqtt_client, args, item):
+
+    try:
+        # The publish_sensor_xxx functions return None if the payload can't be made.
+        if item[0] == 'sensor_reading':
+            logger.info('publishing reading via MQTT')
+            result = publish_sensor_reading(mqtt_client, args['organization_id'], item[1], topic_qos(args, 'data/v1'))
+            return result if result is not None else cannot_publish
+
+        if item[0] == 'sensor_readings':
+            logger.info('publishing {} readings via MQTT'.format(len(item[1])))
+            result = publish_sensor_readings(mqtt_client, args['organization_id'], item[1], topic_qos(args, 'data/v2'))
+            return result if result is not None else cannot_publish
+
+        if item[0] == 'sensor_rollups':
+            logger.info('publishing {} rollups via MQTT'.format(len(item[1])))
+            result = publish_sensor_rollups(mqtt_client, args['organization_id'], item[1], topic_qos(args, 'rollup/v1'))
+            return result if result is not None else cannot_publish
+
+        if item[0] == 'cmd_response': 
+            logger.info('publishing commmand response via MQTT')
+            return publish_cmd_response(mqtt_client, args['organization_id'], item[1], topic_qos(args, 'cr/v1')) 
+
+        logger.error('unknown MQTT publish item encountered: {}'.format(item[0]))
+        return cannot_publish
+
+    except Exception as e:
+        logger.error('exception occurred in main loop of MQTT thread: {}{}'.format(\
+                     exc_info()[0], exc_info()[1]))
+
+    return None
+
+
+def commit_journal(journal, inflight):
+
+    # Journal records must be acknowledged in order so only commit the records at the front of
+    # the in flight list that the broker has confirmed.
+    while inflight and next(iter(inflight.values()))[1]:
+        position = inflight.popitem(last=False)[1][0]
+        journal.ack(position)
+
+
+def save_dead_letter(item):
+
+    try:
+        with open(os_path.join(state_directory_location, dead_letter_file), 'a') as f:
+            f.write(dumps(item) + '\n')
+    except:
+        logger.error('cannot save MQTT dead letter {}: {}, {}'.format(item, exc_info()[0], exc_info()[1]))
+
+
+def replay_journal(mqtt_client, args, journal, inflight):
+
+    # Don't hand paho more than max_inflight journal records at a time. Otherwise a long
+    # backlog would be copied from the disk into memory all at once.
+    while broker_connected and len(inflight) < args['journal'].get('max_inflight', 20):
+
+        if unpublished['record']:
+            if time() < unpublished['retry_time']:
+                return
+            record = unpublished['record']
+        else:
+            record = journal.next_record()
+            if not record:
+                return
+
+        result = publish_item(mqtt_client, args, record[0])
+
+        if result and result is not cannot_publish:
+            unpublished['record'] = None
+            unpublished['attempts'] = 0
+            inflight[result.mid] = [record[1], False]
+            continue
+
+        if unpublished['record'] is not record:
+            unpublished['attempts'] = 0
+        unpublished['attempts'] += 1
+
+        if result is cannot_publish or unpublished['attempts'] > args['journal'].get('max_retries', 10):
+            # Don't let the record block the rest of the journal. Keep a copy of it and acknowledge it.
+            logger.error('giving up on MQTT journal record {}, it is saved in {}'.format(record[0], dead_letter_file))
+            save_dead_letter(record[0])
+            unpublished['record'] = None
+            unpublished['attempts'] = 0
+            inflight[object()] = [record[1], True]
+            commit_journal(journal, inflight)
+        else:
+            # Probably a passing problem. Leave the record in the journal and try it again later.
+            logger.error('cannot publish journal record, will retry in {} seconds'.format(
+                         args['journal'].get('retry_interval', 60)))
+            unpublished['record'] = record
+            unpublished['retry_time'] = time() + args['journal'].get('retry_interval', 60)
+            return
+
+
+def dispatch_queue_item(mqtt_client, args, item, journal, inflight):
+
+    if item[0] == 'wake':
+        return
+
+    if item[0] == 'published':
+        if item[1] in inflight:
+            inflight[item[1]][1] = True
+            commit_journal(journal, inflight)
+        return
+
+    if journal and not broker_connected:
+        # Save the item until the broker comes back.
+        journal.append(item)
+        return
+
+    publish_item(mqtt_client, args, item)
+
+
+def create_journal(args):
+
+    if 'journal' in args and args['journal']['enable']:
+        try:
+            return PublishJournal(os_path.join(state_directory_location, 'mqtt_journal'), 
+                                  segment_bytes=args['journal'].get('segment_bytes', 1000*1000),
+                                  max_bytes=args['journal'].get('max_bytes', 50*1000*1000),
+                                  fsync_count=args['journal'].get('fsync_count', 20),
+                                  fsync_interval=args['journal'].get('fsync_interval', 5))
+        except:
+            logger.error('cannot open the MQTT publish journal, publishes will be held in memory: {}, {}'.format(
+                         exc_info()[0], exc_info()[1]))
+
+    return None
+
+
 # Start the mqtt client and put a reference to it in app_state.
 # If you don't start the mqtt client then don't do anything but log a message. 
 def start(app_state, args, b):
@@ -205,12 +441,30 @@ def start(app_state, args, b):
     app_state[args['name']] = {}
 
     publish_queue = Queue()
+    journal = None
+    if args['enable']:
+        journal = create_journal(args)
+
     app_state[args['name']]['publish_queue'] = publish_queue
+    app_state[args['name']]['journal'] = journal
+    app_state[args['name']]['publish'] = make_publish(publish_queue, journal)
+    app_state[args['name']]['publish_readings'] = make_publish_readings(publish_queue, journal, args)
+    app_state[args['name']]['publish_rollups'] = make_publish_rollups(publish_queue, journal)
     app_state[args['name']]['help'] = make_mqtt_help(args['name'])
     app_state[args['name']]['status'] = make_mqtt_status_cmd()
+    app_state[args['name']]['journal_stats'] = make_journal_stats(journal)
 
     mqtt_client = None
 
+    # mid -> [journal position, broker has acknowledged] for each journal record handed to paho.
+    inflight = OrderedDict()
+
+    # Publish requests that arrive while there is no MQTT client.
+    held_items = []
+
+    # Wake up the MQTT thread when fopd is stopping.
+    app_state['stop_callbacks'].append(lambda: publish_queue.put(['wake', None]))
+
     if args['enable']:
 
         last_client_start_attempt_time = time()
@@ -230,54 +484,53 @@ def start(app_state, args, b):
         except Exception as err:
             # assume a broken barrier
             logger.error('barrier error: {}'.format(str(err)))
-            app_state['stop'] = True
+            request_stop(app_state)
 
         while not app_state['stop']:
 
+            # Sleep until there is something to publish, the broker connects or acknowledges a 
+            # message, fopd is stopping, or it is time to retry creating an MQTT client.
+            if mqtt_client:
+                if unpublished['record']:
+                    timeout = max(0, unpublished['retry_time'] - time())
+                else:
+                    timeout = None
+            else:
+                timeout = max(0, last_client_start_attempt_time + args['client_create_retry_interval'] - time())
+
+            """
+            Queue.get(block=True, timeout=None)
+                Remove and return an item from the queue. If optional args block is true and timeout is None (the default), 
+                block if necessary until an item is available. If timeout is a positive number, it blocks at most timeout 
+                seconds and raises the Empty exception if no item was available within that time. Otherwise (block is false),
+                return an item if one is immediately available, else raise the Empty exception (timeout is ignored in that
+                case).
+            """
+            try:
+                item = publish_queue.get(timeout=timeout)
+            except Empty:
+                item = None
+
             if mqtt_client:
 
-                """
-                Queue.get(block=True, timeout=None)
-                    Remove and return an item from the queue. If optional args block is true and timeout is None (the default), 
-                    block if necessary until an item is available. If timeout is a positive number, it blocks at most timeout 
-                    seconds and raises the Empty exception if no item was available within that time. Otherwise (block is false),
-                    return an item if one is immediately available, else raise the Empty exception (timeout is ignored in that
-                    case).
-                """
-                try:
-                    item = publish_queue.get(False)
-
-                    try:
-
-                        if not mqtt_client: 
-                            logger.error('there is no MQTT client available for published request: {}'.format(item[0]))
-                            continue
-
-                        if item[0] == 'sensor_reading':
-                            logger.info('publishing reading via MQTT')
-                            publish_sensor_reading(mqtt_client, args['organization_id'], item[1])
-
-                            # Bypass the sleep command in order to keep draining the queue in real time.
-                            continue
-
-                        if item[0] == 'cmd_response': 
-                            logger.info('publishing commmand response via MQTT')
-                            publish_cmd_response(mqtt_client, args['organization_id'], item[1]) 
-
-                            # Bypass the sleep command in order to keep draining the queue in real time.
-                            continue
-                       
-                        else:
-                            logger.error('unknown MQTT publish item encountered: {}'.format(item[0]))
-
-                    except Exception as e:
-                        logger.error('exception occurred in main loop of MQTT thread: {}{}'.format(\
-                                     exc_info()[0], exc_info()[1]))
-               
-                except Empty:
-                    # This is ok. It just means the publish queue is empty.
-                    pass
+                for held_item in held_items:
+                    dispatch_queue_item(mqtt_client, args, held_item, journal, inflight)
+                held_items.clear()
+
+                if item:
+                    dispatch_queue_item(mqtt_client, args, item, journal, inflight)
+
+                # Once the broker is connected send everything that was saved while it was away.
+                if journal:
+                    replay_journal(mqtt_client, args, journal, inflight)
+
             else:
+                if item and item[0] not in ('wake', 'published'):
+                    if journal:
+                        journal.append(item)
+                    else:
+                        held_items.append(item)
+
                 # attempt to create a client if we don't have one but don't do it every second
                 if  time() - last_client_start_attempt_time >= args['client_create_retry_interval']: 
                     last_client_start_attempt_time = time()
@@ -286,8 +539,14 @@ def start(app_state, args, b):
                     if mqtt_client: 
                         subscribe_for_commands(mqtt_client, args['mqtt_client_id'])
 
-            
-            sleep(1)
+                        # The new client knows nothing about the records the old one had in flight.
+                        if journal:
+                            inflight.clear()
+                            unpublished['record'] = None
+                            journal.rewind()
+
+        if journal:
+            journal.close()
 
         logger.info('MQTT client interface thread stopping.')
 
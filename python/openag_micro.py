@@ -1,11 +1,31 @@
 #
-import re
+# Optional args:
+#   mc_response_timeout - seconds to wait for the micro-controller to answer a command (default 5).
+#   mc_pipeline_depth   - number of commands that can be sent before their responses arrive (default 1).
+#   mc_actuation_mode   - 'every_tick' (default) sends the actuator command string every second and takes
+#                         the sensor readings from its response. 'on_change' only sends the actuator command
+#                         string when an actuator or the camera pose changes (and every actuator_refresh_interval
+#                         seconds in case the micro-controller missed one) and reads the sensors separately.
+#   actuator_refresh_interval - seconds between repeats of an unchanged actuator command (default 60).
+#   sensor_poll_interval      - seconds between sensor reads in 'on_change' mode (default 1).
+#   sensor_read_cmd           - micro-controller command that the micro answers with a sensor reading line
+#                               ("0,x1,x2, ... xn") without changing the actuators. Required in 'on_change'
+#                               mode, which falls back to 'every_tick' without it. There is no default because
+#                               the command depends on the micro's firmware.
+#   history_size        - number of updates of each reading to keep in memory (default 3600). 0 turns it off.
+#
 import serial
+from math import isfinite
 from sys import exc_info
 from threading import Lock
 from time import sleep, time
 
 from python.logger import get_sub_logger 
+from python.stop import request_stop
+from python.reading_history import TableHistory, make_history
+from python.event_stream import event_stream
+from python.reading_table import ReadingTable
+from python.mc_serial_session import McSerialSession, cmd_priority, poll_priority, pose_priority
 from python.LogFileEntryTable import LogFileEntryTable
 
 logger = get_sub_logger(__name__)
@@ -20,7 +40,7 @@ def make_get(vals, reading_names:dict) -> 'func':
 
     def get(value_name):
         if value_name in reading_names:
-            return vals[reading_names[value_name]]
+            return vals.get(value_name)
         else:
             log_entry_table.add_log_entry(logger.error, 
                 'illegal value_name. Please specify one of {}.'.format(reading_names))
@@ -32,11 +52,6 @@ def make_get(vals, reading_names:dict) -> 'func':
 # Sensor readings are defined in the configuration file
 #
 
-# Provide a lock so that multiple threads are forced to wait for commands that
-# use the Arudiuno serial interface
-#
-serial_interface_lock = Lock()
-
 # target_indexes and cur_command will be filled based upon the configuration setting.
 target_indexes = []
 cur_command = []
@@ -44,8 +59,13 @@ cur_command = []
 cur_mc_cmd_str = None
 old_mc_cmd_str = None
 cur_mc_response = None
+cur_sensor_response = None
 old_mc_response = None
 
+# The mc thread and the camera pose commands both send commands. This lock keeps the
+# globals above (the last two commands and their responses) consistent with each other.
+mc_cmd_state_lock = Lock()
+
 # Create a command string for the Arduino -> b'0,false,true,...false\n'
 def make_fc_cmd(mc_state):
 
@@ -90,6 +110,35 @@ def make_fc_cmd(mc_state):
     return cmd + b'\n'
 
 
+# Convert a reading sent by the micro-controller (e.g. 20 or 20.5) to an int or a float. Readings are kept
+# as numbers and only formatted for display or for sending to the cloud. float() accepts nan and inf, which
+# can't be written as JSON, so they are rejected like any other garbled field.
+#
+def parse_reading(s):
+
+    try:
+        return int(s)
+    except ValueError:
+        f = float(s)
+        if not isfinite(f):
+            raise ValueError('reading {} is not a finite number'.format(s))
+        return f
+
+# Parse a sensor reading line of the form "0,x1,x2, ... xn" into [x1, x2, ... xn]. Return None if the line is
+# not a sensor reading line for the configured readings.
+#
+def parse_sensor_line(msg):
+
+    fields = msg.split(',')
+
+    if len(fields) != len(reading_names) + 1 or fields[0].strip() != '0':
+        return None
+
+    try:
+        return [parse_reading(f) for f in fields[1:]]
+    except ValueError:
+        return None
+
 def extract_sensor_values(mc_response, vals):
 
     # Note these globals -> global old_mc_cmd_str, cur_mc_cmd_str, old_mc_response, cur_mc_response
@@ -98,23 +147,19 @@ def extract_sensor_values(mc_response, vals):
     #      if the time stamp does not move forward then detect this and blank out the
     #      sensor readings.
     ts = time()
-    for r in vals:
-        r['ts'] = ts
    
     readings_found = False
 
     for msg in mc_response:
         if msg[0:1] == '0':
-            values = re.compile(r'(\d+\.\d+)|\d+').findall(msg)
 
             # Look for the a status code followed by the readings. 
-            #- if len(values) == 11:
-            if len(values) == len(reading_names) + 1:
+            values = parse_sensor_line(msg)
+
+            if values is not None:
                 readings_found = True
-                # Save each reading with a timestamp.
-                # TBD: Think about converting to the "native" values (e.g. int, float, etc) here.
-                for i in range (1, len(reading_names) + 1):
-                   vals[i-1]['value'] = values[i] 
+                # Save the readings with a timestamp.
+                vals.update_all(values, ts)
 
     if not readings_found:
         # when the arduino encounters one or more sensor errors it sends a line for each
@@ -127,8 +172,7 @@ def extract_sensor_values(mc_response, vals):
         log_entry_table.add_log_entry(
             logger.error, 'Error reading fopd microconroller sensors. Micro returned: {}'.format(mc_response))
 
-        for r in vals:
-            r['value'] = None
+        vals.update_all([None] * len(vals), ts)
 
 def make_help(args):
 
@@ -150,6 +194,10 @@ def make_help(args):
         s = s + "                                       Embed quotes (\") by using the \ character -> {0}.mc_cmd(\"(c 'co2 'ser ".format(prefix) + r'\"Z\")")' + '\n'
         s = s + '{}.state()                           - Show sensor readings and actuator state.\n'.format(prefix)
         s = s + "{}['sensor_readings'][index]         - Returns the sensor reading referenced by index.\n".format(prefix)
+        s = s + "{}.history(value_name, n=60)         - Return the last n [time stamp, value] pairs of a reading.\n".format(prefix)
+        s = s + "{}.history(value_name, start=ts, end=ts, points=None)\n".format(prefix)
+        s = s + "                                     - Return the readings between two time stamps, averaged into\n"
+        s = s + "                                       points values if points is given.\n"
         s = s + "                                       0: air humidity\n"
         s = s + "                                       1: air temperature\n"
         
@@ -161,7 +209,7 @@ def get(value_name):
 
     return 'OK'
 
-def make_cmd(mc_state, ser):
+def make_cmd(mc_state, session):
 
     '''
     This grow device hardware supports the following commands:
@@ -195,12 +243,14 @@ def make_cmd(mc_state, ser):
                 if cmd == 'on':
                     if cur_command[target_index] == 0:
                         logger.info('Received {0} on command. Will turn {0} on.'.format(target))
-                    cur_command[target_index] = 1
+                        cur_command[target_index] = 1
+                        notify_actuator_change(mc_state)
                     return 'OK'
                 elif cmd == 'off':
                     if cur_command[target_index] == 1:
                         logger.info('Received {0} off command. Will turn {0} off.'.format(target))
-                    cur_command[target_index] = 0
+                        cur_command[target_index] = 0
+                        notify_actuator_change(mc_state)
                     return 'OK'
             else:
                 logger.error('Unknown on/off command action received: {}'.format(target))
@@ -214,12 +264,13 @@ def make_cmd(mc_state, ser):
                 mc_state['camera']['pose'] = True 
 
                 # send a command to the arduino now so the lights go into pose mode ASAP
-                send_mc_cmd(ser, make_fc_cmd(mc_state))
+                send_actuator_cmd(mc_state, session, pose_priority)
 
                 logger.info('posing for a picture')
                 return 'OK'
             elif args[1] == 'off':
                 mc_state['camera']['pose'] = None
+                notify_actuator_change(mc_state)
                 logger.info('will stop posing for a picture')
                 return 'OK'
             else:
@@ -231,23 +282,19 @@ def make_cmd(mc_state, ser):
 
     return cmd
 
-def make_mc_cmd(ser):
+def make_mc_cmd(session):
 
     def mc_cmd(cmd_str):
         
-        result = None
+        if not session:
+            return None
+
+        response = session.request(bytes(cmd_str, "ascii") + b'\n', cmd_priority)
 
-        # wait until the serial interface is free.
-        serial_interface_lock.acquire()
+        if response is None:
+            return None
 
-        try:
-            cmd_str_bytes = bytes(cmd_str, "ascii")
-            ser.write(cmd_str_bytes + b'\n')
-            result = ser.read_until(b'OK\r\n').rstrip().decode('utf-8')
-            ser.reset_input_buffer()
-        finally:
-            serial_interface_lock.release()
-            return result
+        return '\r\n'.join(response + ['OK'])
 
     return mc_cmd
 
@@ -266,8 +313,14 @@ def cur_mc_response_as_str():
 def show_state():
 
     # Note use of global cur_mc_cmd_str
-    return 'current micro-controller string: {}\n'.format(cur_mc_cmd_str) +\
-           'current micro-controller response: {}\n'.format(cur_mc_response_as_str())
+    with mc_cmd_state_lock:
+        s = 'current micro-controller string: {}\n'.format(cur_mc_cmd_str) +\
+            'current micro-controller response: {}\n'.format(cur_mc_response_as_str())
+
+        if cur_sensor_response != None:
+            s = s + 'current sensor read response: {}\n'.format('\n'.join(cur_sensor_response))
+
+    return s
 
 
 def log_mc_response(response):
@@ -306,6 +359,26 @@ def log_cmd_changes():
     if show_response:
         log_mc_response(cur_mc_response)
 
+# Handle lines that the micro-controller sends when it hasn't been asked anything.
+#
+def make_line_handler():
+
+    def handle_line(line):
+        log_mc_response([line])
+
+    return handle_line
+
+# When the micro-controller resets its fc loop is off. Note the reset here and turn the
+# loop back on from the update loop because handlers can't send commands.
+#
+def make_reset_handler(mc_state):
+
+    def handle_reset(line):
+        mc_state['reset_detected'] = True
+        notify_actuator_change(mc_state)
+
+    return handle_reset
+
 def tokenize_mc_response(mc_response):
 
     # Remove the trailing "\r\nOK" and then split the micro-controller's response into an array of lines.
@@ -322,32 +395,64 @@ def tokenize_mc_response(mc_response):
 # Lastly the string "OK\r\n" is returned to mark the end of the micro-controller's response
 # to the command.
 #
-def send_mc_cmd(ser, cmd_str):
+def send_mc_cmd(session, cmd_str, priority=poll_priority):
 
-    serial_interface_lock.acquire()
+    global old_mc_cmd_str, cur_mc_cmd_str, old_mc_response, cur_mc_response
 
-    try:
-        # Update current state - So logger routines can intelligently log changes
-        global old_mc_cmd_str, cur_mc_cmd_str, old_mc_response, cur_mc_response
+    logger.debug('arduino command: {}'.format(cmd_str))
+
+    if session:
+        mc_response = session.request(cmd_str, priority)
+    else:
+        mc_response = None
+
+    logger.debug('arduino response {}'.format(mc_response))
+
+    if mc_response is None:
+        mc_response = []
+
+    # Update current state - So logger routines can intelligently log changes. The request is made
+    # without the lock so that a pose command does not wait for a poll's response.
+    with mc_cmd_state_lock:
         old_mc_cmd_str = cur_mc_cmd_str
         cur_mc_cmd_str = cmd_str 
         old_mc_response = cur_mc_response
-   
-        logger.debug('arduino command: {}'.format(cmd_str))
-        ser.write(cmd_str)
-        mc_response = ser.read_until(b'OK\r\n')
-        logger.debug('arduino response {}'.format(mc_response))
-        ser.reset_input_buffer()
-    except:
-        logger.error('serial interface error {}, {}'.format(exc_info()[0], exc_info()[1]))
-    finally:
-        serial_interface_lock.release()
-
-    cur_mc_response = tokenize_mc_response(mc_response)
-    log_cmd_changes()
+        cur_mc_response = mc_response
+        log_cmd_changes()
     
-    return cur_mc_response 
+    return mc_response 
+
 
+# Send the actuator command string and remember what was sent so that 'on_change' mode can tell
+# when it needs to be sent again.
+#
+def send_actuator_cmd(mc_state, session, priority=poll_priority):
+
+    cmd_str = make_fc_cmd(mc_state)
+    mc_state['last_actuator_cmd'] = cmd_str
+    mc_state['last_actuator_cmd_time'] = time()
+
+    event_stream.publish_state(mc_state['name'], {t:cur_command[i] == 1 for t, i in target_indexes.items()})
+
+    return send_mc_cmd(session, cmd_str, priority)
+
+# Read the sensors without sending the actuator command string.
+#
+def read_sensors(session, cmd_str, vals):
+
+    global cur_sensor_response
+
+    if session:
+        response = session.request(cmd_str, poll_priority)
+    else:
+        response = None
+
+    response = response if response is not None else []
+
+    with mc_cmd_state_lock:
+        cur_sensor_response = response
+
+    extract_sensor_values(response, vals)
 
 # TBD: check on the fc and see if it is ok
 # run unit tests and report failure in the log
@@ -370,26 +475,35 @@ def start_serial_connection(args):
         log_mc_response(tokenize_mc_response(ser.read_until(b'OK\r\n')))
         ser.reset_input_buffer()
 
-        return ser
+        # From here on the session owns the serial port.
+        session = McSerialSession(ser, args.get('mc_response_timeout', 5), args.get('mc_pipeline_depth', 1))
+        session.start()
+
+        return session
     except:
         logger.error('unable to start serial connection to micro-controller: {}, {}'.format(exc_info()[0], exc_info()[1]))
 
-def initialize_fc(mc_state, ser, vals, iterations):
+def initialize_fc(mc_state, session, vals, iterations):
+
+    mc_state['reset_detected'] = False
+
+    # Make sure that the actuator command string is sent again in 'on_change' mode.
+    mc_state['last_actuator_cmd'] = None
 
     # Turn the food computer micro-controller loop on
     logger.info("asking the food computer if it is on.")
-    log_mc_response(send_mc_cmd(ser, b"(fc 'read)\n"))
+    log_mc_response(send_mc_cmd(session, b"(fc 'read)\n"))
     logger.info("regardless of response tell fc to turn on.")
-    send_mc_cmd(ser, b"(fc 'on)\n")
-    log_mc_response(send_mc_cmd(ser, b"(fc 'read)\n"))
+    send_mc_cmd(session, b"(fc 'on)\n")
+    log_mc_response(send_mc_cmd(session, b"(fc 'read)\n"))
    
     # Ping the mc twice so that it does two update loops
     for i in range(0, iterations):
-       log_mc_response(send_mc_cmd(ser, make_fc_cmd(mc_state)))
+       log_mc_response(send_mc_cmd(session, make_fc_cmd(mc_state)))
        sleep(1)
 
 
-def start(app_state, args, b):
+def init(app_state, args):
 
     logger.info('fopd microcontroller interface thread starting.')
 
@@ -399,15 +513,26 @@ def start(app_state, args, b):
     reading_names = args['sensor_reading_names']
 
     # Start a serial connection with the Aruduino - Note that this resets the Arduino.
-    ser = start_serial_connection(args)
-    if not ser:
+    session = start_serial_connection(args)
+    if not session:
         # if no serial connection can be made then tell the system to stop.
-        app_state['stop'] = True
+        request_stop(app_state)
+
+    if args.get('mc_actuation_mode', 'every_tick') == 'on_change' and not args.get('sensor_read_cmd'):
+        logger.error("mc_actuation_mode 'on_change' needs a sensor_read_cmd. Using 'every_tick' instead.")
+        args['mc_actuation_mode'] = 'every_tick'
 
     # We have one state variable (i.e. camera_pose) so no need of a state structure
     mc_state = {}
     #- mc_state['camera_pose'] = None
     mc_state['camera'] = {'pose': None, 'camera_pose_cmds': args['camera_pose_cmds']} 
+    mc_state['name'] = args['name']
+    mc_state['reset_detected'] = False
+    mc_state['last_actuator_cmd'] = None
+    mc_state['last_actuator_cmd_time'] = 0
+    mc_state['next_sensor_poll_time'] = 0
+    mc_state['actuator_event'] = args['name'] + '_actuator_change'
+    mc_state['notify'] = app_state.get('runtime', {}).get('notify')
 
     # Initilize the actuators
     global target_indexes, cur_command
@@ -417,22 +542,107 @@ def start(app_state, args, b):
     # Inject your commands into app_state.
     app_state[args['name']] = {} 
     app_state[args['name']]['help'] = make_help(args)
-    app_state[args['name']]['cmd'] = make_cmd(mc_state, ser)
-    app_state[args['name']]['mc_cmd'] = make_mc_cmd(ser)
+    app_state[args['name']]['cmd'] = make_cmd(mc_state, session)
+    app_state[args['name']]['mc_cmd'] = make_mc_cmd(session)
     app_state[args['name']]['state'] = show_state
    
-    vals = app_state[args['name']]['sensor_readings'] = args['sensor_readings'] 
-    app_state[args['name']]['get'] = make_get(args['sensor_readings'], args['sensor_reading_names'])
+    vals = app_state[args['name']]['sensor_readings'] = ReadingTable(args['sensor_readings'], args['sensor_reading_names'])
+    app_state[args['name']]['get'] = make_get(vals, args['sensor_reading_names'])
+
+    if args.get('history_size', 3600) > 0:
+        app_state[args['name']]['history'] = make_history(TableHistory(vals, args.get('history_size', 3600)))
+
+    if session:
+        session.add_handler('line', make_line_handler())
+        session.add_handler('reset', make_reset_handler(mc_state))
 
-    if ser:
         # Start the fc loop and and let it run for n seconds where n = args['mc_start_delay'].
         # 10 is recommened for the fc version 1 in order to wait for the
         # co2 reading to be accurate.  TBD: There are more sophisticated ways - such as making the co2
         # reading "unavailible" until it is available.
-        initialize_fc(mc_state, ser, vals, args['mc_start_delay'])
+        initialize_fc(mc_state, session, vals, args['mc_start_delay'])
 
         # Take the first set of sensor readings
-        extract_sensor_values(send_mc_cmd(ser, make_fc_cmd(mc_state)), vals)
+        extract_sensor_values(send_actuator_cmd(mc_state, session), vals)
+
+    return mc_state, session, vals
+
+def check_reset(mc_state, session, vals):
+
+    if mc_state['reset_detected']:
+        logger.warning('the micro-controller has reset, re-initializing it.')
+        initialize_fc(mc_state, session, vals, 0)
+
+# In the event loop runtime an actuator change (or a micro reset) fires an event that runs the
+# 'on_change' actuator task right away instead of waiting for its next tick.
+#
+def notify_actuator_change(mc_state):
+
+    if mc_state['notify']:
+        mc_state['notify'](mc_state['actuator_event'])
+
+# 'on_change' mode - send the actuator command string if it has changed or is due for a refresh.
+# Returns the number of seconds until the next refresh is due.
+#
+def update_actuators(mc_state, session, vals, args):
+
+    check_reset(mc_state, session, vals)
+
+    if make_fc_cmd(mc_state) != mc_state['last_actuator_cmd'] or\
+       time() - mc_state['last_actuator_cmd_time'] >= args.get('actuator_refresh_interval', 60):
+        send_actuator_cmd(mc_state, session)
+
+    return max(0, mc_state['last_actuator_cmd_time'] + args.get('actuator_refresh_interval', 60) - time())
+
+def poll_sensors(session, vals, args):
+    read_sensors(session, bytes(args['sensor_read_cmd'], 'ascii') + b'\n', vals)
+
+def update_mc(mc_state, session, vals, args):
+
+    if args.get('mc_actuation_mode', 'every_tick') == 'on_change':
+
+        update_actuators(mc_state, session, vals, args)
+
+        if time() >= mc_state['next_sensor_poll_time']:
+            mc_state['next_sensor_poll_time'] = time() + args.get('sensor_poll_interval', 1)
+            poll_sensors(session, vals, args)
+
+        return
+
+    check_reset(mc_state, session, vals)
+
+    # Send a command string to the Arduino that actuates as per the current controller state.
+    cur_mc_response = send_actuator_cmd(mc_state, session)
+
+    # Look for a set of sensor readings and extract them if you find one.
+    extract_sensor_values(cur_mc_response, vals)
+
+# Event loop runtime entry point. See python/runtime.py
+def schedule(app_state, args):
+
+    mc_state, session, vals = init(app_state, args)
+
+    def stop():
+        if session:
+            session.close()
+        logger.info('fopd microcontroller interface thread stopping.')
+
+    if args.get('mc_actuation_mode', 'every_tick') == 'on_change':
+        # Actuator changes are sent as soon as they are made (see notify_actuator_change). The timer only
+        # repeats the command every actuator_refresh_interval seconds. The sensors are read at their own rate.
+        tasks = [{'name':args['name'] + '_actuators', 'interval':args.get('actuator_refresh_interval', 60),
+                  'events':(mc_state['actuator_event'],),
+                  'func':lambda: update_actuators(mc_state, session, vals, args)},
+                 {'name':args['name'] + '_sensors', 'interval':args.get('sensor_poll_interval', 1),
+                  'func':lambda: poll_sensors(session, vals, args)}]
+    else:
+        tasks = [{'name':args['name'], 'interval':1, 'func':lambda: update_mc(mc_state, session, vals, args)}]
+
+    return {'tasks':tasks, 'stop':stop}
+
+def start(app_state, args, b):
+
+    mc_state, session, vals = init(app_state, args)
 
     # Let the system know that you are good to go.
     try:
@@ -440,16 +650,18 @@ def start(app_state, args, b):
     except Exception as err:
         # assume a broken barrier
         logger.error('barrier error: {}'.format(str(err)))
-        app_state['stop'] = True
+        request_stop(app_state)
 
     while not app_state['stop']:
 
-        # Send a command string to the Arduino that actuates as per the current controller state.
-        cur_mc_response = send_mc_cmd(ser, make_fc_cmd(mc_state))
+        update_mc(mc_state, session, vals, args)
 
-        # Look for a set of sensor readings and extract them if you find one.
-        extract_sensor_values(cur_mc_response, vals)
+        if args.get('mc_actuation_mode', 'every_tick') == 'on_change':
+            sleep(min(1, args.get('sensor_poll_interval', 1)))
+        else:
+            sleep(1)
 
-        sleep(1)
+    if session:
+        session.close()
 
     logger.info('fopd microcontroller interface thread stopping.')
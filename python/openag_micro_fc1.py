@@ -11,6 +11,7 @@ import re
 import serial
 
 from python.logger import get_sub_logger 
+from python.stop import request_stop
 logger = get_sub_logger(__name__)
 
 # All the micro-controller sensor names will be put in the reading_names dictionary
@@ -417,7 +418,7 @@ def start(app_state, args, b):
     except Exception as err:
         # assume a broken barrier
         logger.error('barrier error: {}'.format(str(err)))
-        app_state['stop'] = True
+        request_stop(app_state)
 
     while not app_state['stop']:
 
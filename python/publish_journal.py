@@ -0,0 +1,335 @@
+# Durable store and forward journal for MQTT publish requests.
+#
+# Publish requests are appended to segment files in a journal directory. Each record is a
+# header (record length, crc32) followed by the json encoded request. A new segment is started
+# once the current one reaches segment_bytes. The index file remembers the position (segment number,
+# offset) of the first record that has not yet been acknowledged by the broker so that replay can
+# pick up where it left off after a restart.
+#
+# Disk usage is bounded by max_bytes. When the journal grows past max_bytes the oldest segment
+# is deleted, even if it holds records that were never published.
+#
+# Appends are written to the OS on every call but only fsync'ed every fsync_count records or
+# fsync_interval seconds so the SD card isn't hit on every sensor reading. A process crash loses
+# nothing, a power cut can lose at most the last unsynced batch.
+#
+# Delivery is at least once. Records that were published but not acknowledged before a
+# restart will be published again.
+#
+
+from collections import deque
+from json import dumps, loads
+from os import fsync, listdir, makedirs, path, remove, replace
+from struct import Struct
+from sys import exc_info
+from threading import Lock
+from time import time
+from zlib import crc32
+
+from python.logger import get_sub_logger
+
+logger = get_sub_logger(__name__)
+
+record_header = Struct('>II')
+
+class PublishJournal():
+
+    def __init__(self, directory, segment_bytes=1000*1000, max_bytes=50*1000*1000, fsync_count=20,
+                 fsync_interval=5, index_interval=5):
+
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.fsync_count = fsync_count
+        self.fsync_interval = fsync_interval
+        self.index_interval = index_interval
+
+        self.lock = Lock()
+
+        # Counters - see stats()
+        self.appended = 0
+        self.replayed = 0
+        self.evicted = 0
+        self.ack_times = deque()
+
+        makedirs(directory, exist_ok=True)
+
+        # segment number -> [size in bytes, number of records]
+        self.segments = {}
+        for f in listdir(directory):
+            if f.endswith('.seg'):
+                self.segments[int(f[0:-4])] = self.scan_segment(int(f[0:-4]))
+
+        # The committed position is the oldest record that has not been acknowledged. The read
+        # position is the next record to be replayed.
+        self.committed = self.read_index()
+        if self.committed[0] not in self.segments:
+            later_segments = [s for s in self.segments if s > self.committed[0]]
+            self.committed = (min(later_segments) if later_segments else self.committed[0], 0)
+        elif self.committed[1] > self.segments[self.committed[0]][0]:
+            self.committed = (self.committed[0], self.segments[self.committed[0]][0])
+        self.read_pos = self.committed
+        self.index_write_time = time()
+        self.index_dirty = False
+
+        self.backlog = self.count_records(self.committed)
+
+        self.write_segment = max(self.segments) if self.segments else self.committed[0]
+        if self.write_segment not in self.segments:
+            self.segments[self.write_segment] = [0, 0]
+        self.write_file = open(self.segment_path(self.write_segment), 'ab')
+        self.unsynced = 0
+        self.sync_time = time()
+
+        self.read_file = None
+        self.read_file_segment = None
+
+        logger.info('opened publish journal {}, {} unpublished records'.format(directory, self.backlog))
+
+    def segment_path(self, segment):
+        return path.join(self.directory, '{:010d}.seg'.format(segment))
+
+    def index_path(self):
+        return path.join(self.directory, 'index')
+
+    def read_index(self):
+
+        try:
+            with open(self.index_path()) as f:
+                index = loads(f.read())
+                return (index['segment'], index['offset'])
+        except FileNotFoundError:
+            return (0, 0)
+        except:
+            logger.error('cannot read the publish journal index, will replay from the oldest segment: {}, {}'.format(
+                         exc_info()[0], exc_info()[1]))
+            return (0, 0)
+
+    def write_index(self):
+
+        tmp_path = self.index_path() + '.tmp'
+
+        try:
+            with open(tmp_path, 'w') as f:
+                f.write(dumps({'segment':self.committed[0], 'offset':self.committed[1]}))
+                f.flush()
+                fsync(f.fileno())
+            replace(tmp_path, self.index_path())
+            self.index_dirty = False
+        except:
+            logger.error('cannot write the publish journal index: {}, {}'.format(exc_info()[0], exc_info()[1]))
+
+        self.index_write_time = time()
+
+    def scan_segment(self, segment, start=0):
+        """ Return [size, record count] for the records that follow start. A torn record at
+            the end of the segment (e.g. from a power cut in the middle of a write) is truncated. """
+
+        records = 0
+        offset = start
+
+        with open(self.segment_path(segment), 'r+b') as f:
+            f.seek(start)
+            while True:
+                header = f.read(record_header.size)
+                if len(header) < record_header.size:
+                    break
+                length, crc = record_header.unpack(header)
+                body = f.read(length)
+                if len(body) < length or crc32(body) != crc:
+                    break
+                records += 1
+                offset = f.tell()
+
+            if start == 0 and offset != f.seek(0, 2):
+                logger.warning('truncating torn record at the end of publish journal segment {}'.format(segment))
+                f.truncate(offset)
+
+        return [offset, records]
+
+    def count_records(self, position):
+
+        count = 0
+        for s in sorted(self.segments):
+            if s == position[0]:
+                count += self.scan_segment(s, position[1])[1]
+            elif s > position[0]:
+                count += self.segments[s][1]
+
+        return count
+
+    def total_bytes(self):
+        return sum([s[0] for s in self.segments.values()])
+
+    def append(self, item):
+
+        body = dumps(item).encode('utf-8')
+        record = record_header.pack(len(body), crc32(body)) + body
+
+        with self.lock:
+
+            if self.segments[self.write_segment][0] > 0 and\
+               self.segments[self.write_segment][0] + len(record) > self.segment_bytes:
+                self.roll_segment()
+
+            self.write_file.write(record)
+            self.write_file.flush()
+
+            self.segments[self.write_segment][0] += len(record)
+            self.segments[self.write_segment][1] += 1
+            self.appended += 1
+            self.backlog += 1
+            self.unsynced += 1
+
+            if self.unsynced >= self.fsync_count or time() - self.sync_time >= self.fsync_interval:
+                self.sync()
+
+            if self.total_bytes() > self.max_bytes:
+                self.evict_oldest_segment()
+
+    def sync(self):
+
+        fsync(self.write_file.fileno())
+        self.unsynced = 0
+        self.sync_time = time()
+
+    def roll_segment(self):
+
+        self.sync()
+        self.write_file.close()
+
+        self.write_segment += 1
+        self.segments[self.write_segment] = [0, 0]
+        self.write_file = open(self.segment_path(self.write_segment), 'ab')
+
+    def evict_oldest_segment(self):
+
+        oldest = min(self.segments)
+
+        if oldest == self.write_segment:
+            logger.error('the publish journal segment size is larger than the journal size limit')
+            return
+
+        if oldest >= self.committed[0]:
+            if oldest == self.committed[0]:
+                lost = self.scan_segment(oldest, self.committed[1])[1]
+            else:
+                lost = self.segments[oldest][1]
+            self.evicted += lost
+            self.backlog -= lost
+            logger.warning('publish journal is full, discarding {} unpublished records'.format(lost))
+
+        self.delete_segment(oldest)
+
+        if self.committed[0] <= oldest:
+            self.committed = (oldest + 1, 0)
+            self.index_dirty = True
+        if self.read_pos[0] <= oldest:
+            self.read_pos = (oldest + 1, 0)
+
+    def delete_segment(self, segment):
+
+        if self.read_file_segment == segment:
+            self.read_file.close()
+            self.read_file = None
+            self.read_file_segment = None
+
+        try:
+            remove(self.segment_path(segment))
+        except FileNotFoundError:
+            pass
+
+        del self.segments[segment]
+
+    def next_record(self):
+        """ Return (item, position) for the next record to replay or None if the journal has been
+            replayed up to the last append. Pass position to ack once the broker has the record. """
+
+        with self.lock:
+
+            while True:
+
+                segment, offset = self.read_pos
+
+                if segment not in self.segments:
+                    if segment < self.write_segment:
+                        self.read_pos = (segment + 1, 0)
+                        continue
+                    return None
+
+                if offset >= self.segments[segment][0]:
+                    if segment < self.write_segment:
+                        self.read_pos = (segment + 1, 0)
+                        continue
+                    return None
+
+                if self.read_file_segment != segment:
+                    if self.read_file:
+                        self.read_file.close()
+                    self.read_file = open(self.segment_path(segment), 'rb')
+                    self.read_file_segment = segment
+
+                self.read_file.seek(offset)
+                length, crc = record_header.unpack(self.read_file.read(record_header.size))
+                body = self.read_file.read(length)
+                self.read_pos = (segment, self.read_file.tell())
+
+                if crc32(body) != crc:
+                    logger.error('skipping corrupt publish journal record in segment {} at {}'.format(segment, offset))
+                    continue
+
+                return (loads(body.decode('utf-8')), self.read_pos)
+
+    def ack(self, position):
+        """ Mark every record before position as delivered. """
+
+        with self.lock:
+
+            if position <= self.committed:
+                return
+
+            # Delete fully delivered segments.
+            for s in sorted(self.segments):
+                if s < position[0] and s != self.write_segment:
+                    self.delete_segment(s)
+
+            self.committed = position
+            self.index_dirty = True
+            self.backlog = max(0, self.backlog - 1)
+            self.replayed += 1
+
+            now = time()
+            self.ack_times.append(now)
+            while self.ack_times[0] < now - 60:
+                self.ack_times.popleft()
+
+            if now - self.index_write_time >= self.index_interval:
+                self.write_index()
+
+    def rewind(self):
+        """ Replay again from the oldest unacknowledged record. """
+
+        with self.lock:
+            self.read_pos = self.committed
+
+    def close(self):
+
+        with self.lock:
+            self.sync()
+            self.write_file.close()
+            if self.read_file:
+                self.read_file.close()
+            if self.index_dirty:
+                self.write_index()
+
+    def stats(self):
+
+        with self.lock:
+
+            now = time()
+            while self.ack_times and self.ack_times[0] < now - 60:
+                self.ack_times.popleft()
+
+            return {'backlog':self.backlog, 'appended':self.appended, 'replayed':self.replayed,
+                    'evicted':self.evicted, 'replay_rate':len(self.ack_times) / 60,
+                    'segments':len(self.segments), 'bytes':self.total_bytes()}
@@ -17,6 +17,8 @@ import RPi.GPIO as GPIO
 
 from python.logger import get_sub_logger 
 from python.LogFileEntryTable import LogFileEntryTable
+from python.reading_history import TableHistory, make_history
+from python.reading_table import ReadingTable
 
 logger = get_sub_logger(__name__)
 log_entry_table = LogFileEntryTable(60*60)
@@ -25,11 +27,11 @@ def make_get(vals):
 
     def get(value_name):
 
-        for v in vals:
-            if v['value_name'] == value_name:
-                return v
+        v = vals.get(value_name)
+        if v is not None:
+            return v
 
-        return 'illegal value_name. Please specify one of {}.'.format(reading_names)
+        return 'illegal value_name. Please specify one of {}.'.format(vals.names())
 
     return get
 
@@ -151,7 +153,11 @@ def make_help(args):
         s = s + '                                       humidity, air_temp, TBD add other available options to this help message.\n'
         s = s + '{}.state()                           - Show sensor readings and actuator state.\n'.format(prefix)
         s = s + "{}['sensor_readings']                - Return a dictionary containing all the current sensor readings.\n".format(prefix)
-        s = s + '                                       Sensor readings are updated every second.'
+        s = s + '                                       Sensor readings are updated every second.\n'
+        s = s + "{}.history(value_name, n=60)         - Return the last n [time stamp, value] pairs of a reading.\n".format(prefix)
+        s = s + "{}.history(value_name, start=ts, end=ts, points=None)\n".format(prefix)
+        s = s + "                                     - Return the readings between two time stamps, averaged into\n"
+        s = s + "                                       points values if points is given."
         
         return s
 
@@ -267,7 +273,7 @@ def make_show_state(data_values: list, controls: list, state: dict):
     return show_state
 
 
-def start(app_state, args, b):
+def init(app_state, args):
 
     logger.setLevel(args['log_level'])
     logger.info('Raspberry Pi hardware interface thread starting.')
@@ -279,7 +285,7 @@ def start(app_state, args, b):
     # vals = []
     state = {'camera_pose':False}
     controls = []
-    data_values = []
+    data_values = ReadingTable()
 
     # Inject your commands into app_state.
     app_state[args['name']] = {} 
@@ -296,6 +302,10 @@ def start(app_state, args, b):
         if s['enabled']:
             s['online'] = s['sensor'].initialize()
 
+    # Keep the recent history of each reading. The sensors have added their readings by now.
+    if args.get('history_size', 3600) > 0:
+        app_state[args['name']]['history'] = make_history(TableHistory(data_values, args.get('history_size', 3600)))
+
     # Setup the GPIO based inputs and outputs
     GPIO.setwarnings(False)
     GPIO.setmode(GPIO.BOARD)
@@ -303,17 +313,34 @@ def start(app_state, args, b):
 
     app_state[args['name']]['cmd'] = make_cmd(controls, state)
 
+    return state, controls, i2c_sensors
+
+def update_hw(state, controls, i2c_sensors):
+
+    # Update outputs 
+    update_control_outputs(controls, state)
+
+    # Read the i2c sensors
+    update_i2c_sensor_readings(i2c_sensors) 
+
+# Event loop runtime entry point. See python/runtime.py
+def schedule(app_state, args):
+
+    state, controls, i2c_sensors = init(app_state, args)
+
+    return {'tasks':[{'name':args['name'], 'interval':1, 'func':lambda: update_hw(state, controls, i2c_sensors)}],
+            'stop':lambda: logger.info('Raspberry Pi hardware interface thread stopping.')}
+
+def start(app_state, args, b):
+
+    state, controls, i2c_sensors = init(app_state, args)
+
     # Let the system know that you are good to go.
     b.wait()
 
     while not app_state['stop']:
      
-        # Update outputs 
-        update_control_outputs(controls, state)
-
-        # Read the i2c sensors
-        update_i2c_sensor_readings(i2c_sensors) 
-
+        update_hw(state, controls, i2c_sensors)
         sleep(1)
 
     #TODO - add code that sets each control to it's default value when the resource is shutting down.
@@ -0,0 +1,159 @@
+# In memory history of sensor readings.
+#
+# ReadingHistory keeps the last size values of one reading, and their time stamps, in a pair of
+# fixed size arrays that are used as a ring buffer. Missing values (None) are stored as NaN.
+# Memory use is 16 bytes per entry no matter how long fopd runs.
+#
+# TableHistory attaches a ReadingHistory to every reading of a ReadingTable so that every update
+# (e.g. the 1 Hz updates of openag_micro or rp_hw_controller) is recorded.
+#
+
+from array import array
+from math import isnan
+from threading import Lock
+
+nan = float('nan')
+
+class ReadingHistory():
+
+    def __init__(self, size):
+
+        self.size = size
+        self.values = array('d', [nan]) * size
+        self.times = array('d', [nan]) * size
+
+        # next is the position of the next entry, count is the number of entries in the buffer.
+        self.next = 0
+        self.count = 0
+
+        self.lock = Lock()
+
+    def append(self, value, ts):
+
+        if value is None:
+            value = nan
+
+        with self.lock:
+            self.values[self.next] = value
+            self.times[self.next] = ts
+            self.next = (self.next + 1) % self.size
+            self.count = min(self.count + 1, self.size)
+
+    def position(self, i):
+        """ Return the array position of the i'th oldest entry """
+        return (self.next - self.count + i) % self.size
+
+    def entry(self, i):
+
+        p = self.position(i)
+        v = self.values[p]
+        return [self.times[p], None if isnan(v) else v]
+
+    def find(self, ts):
+        """ Return the number of entries older than ts. Entries are assumed to be in time order. """
+
+        lo = 0
+        hi = self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.times[self.position(mid)] < ts:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def bounds(self):
+        """ Return the time stamps of the oldest and newest entries or None if there are none. """
+
+        with self.lock:
+            if self.count == 0:
+                return None
+            return (self.times[self.position(0)], self.times[self.position(self.count - 1)])
+
+    def last(self, n):
+        """ Return the newest n entries as [ts, value] pairs, oldest first. """
+
+        with self.lock:
+            return [self.entry(i) for i in range(max(0, self.count - n), self.count)]
+
+    def between(self, start, end):
+        """ Return the entries with start <= ts <= end as [ts, value] pairs, oldest first. """
+
+        with self.lock:
+            first = self.find(start)
+            last = self.find(end)
+            while last < self.count and self.times[self.position(last)] <= end:
+                last += 1
+            return [self.entry(i) for i in range(first, last)]
+
+    def downsample(self, start, end, points):
+        """ Split start to end into points buckets and return [ts, mean value] for each bucket
+            that has values. ts is the middle of the bucket. """
+
+        width = (end - start) / points
+        if width <= 0:
+            return []
+
+        sums = [0.0] * points
+        counts = [0] * points
+
+        for ts, v in self.between(start, end):
+            if v is not None:
+                b = min(int((ts - start) / width), points - 1)
+                sums[b] += v
+                counts[b] += 1
+
+        return [[start + (b + 0.5) * width, sums[b] / counts[b]] for b in range(points) if counts[b] > 0]
+
+class TableHistory():
+
+    def __init__(self, table, size):
+
+        self.table = table
+        self.histories = [ReadingHistory(size) for i in range(len(table))]
+        self.names = {}
+        for i in range(len(table)):
+            self.names[table.name_of(i)] = i
+
+        table.add_listener(self.record)
+
+    def record(self, i, value, ts):
+
+        # Readings added to the table after the history was created are not recorded.
+        if i < len(self.histories):
+            self.histories[i].append(value, ts)
+
+    def get(self, name):
+        """ Return the ReadingHistory of the reading called name or None. """
+
+        i = self.names.get(name)
+        if i is None:
+            return None
+        return self.histories[i]
+
+def make_history(history):
+
+    def show_history(name, n=None, start=None, end=None, points=None):
+
+        h = history.get(name)
+        if h is None:
+            return 'unknown reading {}. Please specify one of {}.'.format(name, list(history.names.keys()))
+
+        if start is None and end is None and not points:
+            return h.last(n if n is not None else 60)
+
+        bounds = h.bounds()
+        if bounds is None:
+            return []
+
+        if start is None:
+            start = bounds[0]
+        if end is None:
+            end = bounds[1]
+
+        if points:
+            return h.downsample(start, end, points)
+
+        return h.between(start, end)
+
+    return show_history
@@ -0,0 +1,92 @@
+# Running statistics (rollups) of sensor readings.
+#
+# TableRollup listens to a ReadingTable and keeps the count, min, max, mean, standard deviation
+# and last value of every reading since the last call to take. The mean and standard deviation
+# are updated incrementally (Welford's method) so no readings are stored.
+#
+
+from math import sqrt
+from threading import Lock
+from time import time
+
+class RollupAccumulator():
+
+    __slots__ = ('count', 'missing', 'mean', 'm2', 'min', 'max', 'last')
+
+    def __init__(self):
+
+        self.count = 0
+        self.missing = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = None
+        self.max = None
+        self.last = None
+
+    def add(self, value):
+
+        if value is None:
+            self.missing += 1
+            return
+
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        self.last = value
+
+    def result(self):
+
+        if self.count == 0:
+            return {'count':0, 'missing':self.missing, 'min':None, 'max':None, 'mean':None, 'stddev':None,
+                    'last':None}
+
+        return {'count':self.count, 'missing':self.missing, 'min':self.min, 'max':self.max, 'mean':self.mean,
+                'stddev':sqrt(self.m2 / self.count), 'last':self.last}
+
+rollup_fields = ('value_name', 'device_name', 'device_id', 'subject', 'subject_location_id', 'attribute', 'units')
+
+class TableRollup():
+
+    def __init__(self, table):
+
+        self.table = table
+        self.lock = Lock()
+        self.start = time()
+        self.accumulators = [RollupAccumulator() for i in range(len(table))]
+
+        table.add_listener(self.record)
+
+    def record(self, i, value, ts):
+
+        with self.lock:
+            if i < len(self.accumulators):
+                self.accumulators[i].add(value)
+
+    def take(self):
+        """ Return a rollup (dictionary) for each reading that was updated since the last call and
+            start a new interval. """
+
+        with self.lock:
+            accumulators = self.accumulators
+            self.accumulators = [RollupAccumulator() for i in range(len(accumulators))]
+            start = self.start
+            end = self.start = time()
+
+        rollups = []
+
+        for r, a in zip(self.table, accumulators):
+            if a.count == 0 and a.missing == 0:
+                continue
+            rollup = {'start':start, 'end':end}
+            for f in rollup_fields:
+                rollup[f] = r[f]
+            rollup.update(a.result())
+            rollups.append(rollup)
+
+        return rollups
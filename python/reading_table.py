@@ -0,0 +1,181 @@
+# Table of the current sensor readings of a resource.
+#
+# Each reading is a Reading record. Records can be used like the sensor reading dictionaries that
+# the resources used to share (e.g. r['value'], r['ts'], dict(r)) but only the resource that owns
+# the table changes them, via update or update_all, and it does so while holding the table's lock.
+# Everybody else gets copies (iterating over the table, table[i], get and snapshot) that are
+# taken while holding the lock so a reading's value and time stamp always belong together.
+#
+# Readings are looked up by name (e.g. 'air_temp') through a dictionary instead of by scanning
+# the list. Every update gives the reading the next sequence number of the table so consumers can
+# tell what changed since they last looked.
+#
+# Listeners added with add_listener are called as func(index, value, ts) after every update, on
+# the thread that made the update.
+#
+
+from itertools import count
+from sys import exc_info
+from threading import Lock
+from time import monotonic, time
+
+from python.logger import get_sub_logger
+
+logger = get_sub_logger(__name__)
+
+class Reading():
+
+    __slots__ = ('value_name', 'type', 'device_name', 'device_id', 'subject', 'subject_location_id',
+                 'attribute', 'value', 'units', 'ts', 'mono_ts', 'seq')
+
+    def __init__(self, config):
+
+        for k in self.__slots__:
+            setattr(self, k, config.get(k))
+
+    def __getitem__(self, key):
+
+        try:
+            return getattr(self, key)
+        except (AttributeError, TypeError):
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self.__slots__
+
+    def get(self, key, default=None):
+        return getattr(self, key, default) if key in self.__slots__ else default
+
+    def keys(self):
+        return self.__slots__
+
+    def copy(self):
+
+        r = Reading.__new__(Reading)
+        for k in self.__slots__:
+            setattr(r, k, getattr(self, k))
+        return r
+
+    def __repr__(self):
+        return repr(dict(self))
+
+class ReadingTable():
+
+    def __init__(self, readings=(), names=None):
+        """ readings is a list of sensor reading configurations (dictionaries). names optionally
+            maps reading names to their position in readings. Otherwise the value_name of each reading
+            is used. """
+
+        self.lock = Lock()
+        self.records = []
+        self.index = {}
+        self.sequence = count(1)
+        self.seq = 0
+        self.listeners = []
+
+        for r in readings:
+            self.add(r)
+
+        if names:
+            self.index.update(names)
+
+    def add(self, config):
+        """ Add a reading and return its index. """
+
+        with self.lock:
+            self.records.append(Reading(config))
+            i = len(self.records) - 1
+            if config.get('value_name'):
+                self.index[config['value_name']] = i
+            return i
+
+    def index_of(self, name):
+        return self.index.get(name)
+
+    def names(self):
+        return list(self.index.keys())
+
+    def name_of(self, i):
+        """ Return the name of reading i. Readings without a name are called subject_attribute. """
+
+        for name, index in self.index.items():
+            if index == i:
+                return name
+
+        return '{}_{}'.format(self.records[i].subject, self.records[i].attribute)
+
+    def add_listener(self, func):
+        self.listeners.append(func)
+
+    def notify(self, updates):
+
+        for func in self.listeners:
+            for i, value, ts in updates:
+                try:
+                    func(i, value, ts)
+                except:
+                    logger.error('reading table listener failed: {}, {}'.format(exc_info()[0], exc_info()[1]))
+
+    def set(self, i, value, ts, mono_ts):
+
+        r = self.records[i]
+        r.value = value
+        r.ts = ts
+        r.mono_ts = mono_ts
+        self.seq = r.seq = next(self.sequence)
+
+    def update(self, i, value, ts=None):
+        """ Set the value of reading i. ts defaults to now. """
+
+        if ts is None:
+            ts = time()
+
+        with self.lock:
+            self.set(i, value, ts, monotonic())
+
+        if self.listeners:
+            self.notify(((i, value, ts),))
+
+    def update_all(self, values, ts=None):
+        """ Set every reading at once. values is a list with a value for each reading. """
+
+        if ts is None:
+            ts = time()
+        mono_ts = monotonic()
+
+        with self.lock:
+            for i, v in enumerate(values):
+                self.set(i, v, ts, mono_ts)
+
+        if self.listeners:
+            self.notify([(i, v, ts) for i, v in enumerate(values)])
+
+    def get(self, name):
+        """ Return a copy of the reading called name or None. """
+
+        i = self.index.get(name)
+        if i is None:
+            return None
+
+        with self.lock:
+            return self.records[i].copy()
+
+    def snapshot(self):
+        """ Return a copy of every reading and the table's sequence number, all taken at the same time. """
+
+        with self.lock:
+            return [r.copy() for r in self.records], self.seq
+
+    def __getitem__(self, i):
+
+        with self.lock:
+            return self.records[i].copy()
+
+    def __iter__(self):
+        return iter(self.snapshot()[0])
+
+    def __len__(self):
+        return len(self.records)
+
+    def __repr__(self):
+        return repr(list(self))
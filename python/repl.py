@@ -13,6 +13,7 @@ from jose import jws
 from requests import post
 
 from python.logger import get_sub_logger 
+from python.stop import request_stop
 from python.encryption.nacl_fop import decrypt
 
 from config import device_id, hmac_secret_key_b64_cipher, fop_jose_id
@@ -85,7 +86,7 @@ def make_exit(app_state):
 
     def exit_cmd():
          logger.info('shutting down')
-         app_state['stop'] = True
+         request_stop(app_state)
          return 'shutting down, please wait a few seconds.'
 
     return exit_cmd
@@ -217,7 +218,7 @@ def start(app_state, silent_mode, barrier, start_cmd=None):
         except Exception as err:
             # assume a broken barrier
             logger.error('barrier error: {}'.format(str(err)))
-            app_state['stop'] = True
+            request_stop(app_state)
 
     if start_cmd:
         if silent_mode:
@@ -0,0 +1,279 @@
+# Event loop runtime for fopd resources.
+#
+# By default each resource runs on its own thread and wakes up once a second to see if it has
+# work to do (see main.py).  If the configuration file contains
+#
+#   system = {..., 'runtime':{'mode':'event_loop', 'max_workers':2, 'coalesce_window':0.5}, ...}
+#
+# then every resource whose module provides a schedule function is run by one asyncio event loop
+# instead. Resources without a schedule function still get their own thread.
+#
+# schedule(app_state, args) initializes the resource (i.e. everything start does before it waits
+# on the barrier) and returns a dictionary:
+#
+#   {'tasks':[{'name':'data_logger', 'interval':20*60, 'func':f, 'blocking':True, 'events':('sample',)}, ...],
+#    'stop':g}
+#
+#   interval - run func every interval seconds. None means only run it when one of its events fires.
+#   run_at_start - run func as soon as the runtime starts instead of waiting for the first interval tick.
+#   func     - takes no arguments. If it returns a number then the task is next run that many seconds
+#              later instead of after interval seconds.
+#   blocking - func does blocking I/O (serial, I2C, subprocesses, http) so run it on the worker pool
+#              instead of on the event loop. Defaults to True.
+#   pool     - optional. Run func on a worker thread of its own, shared only with the other tasks that
+#              name the same pool. Slow work (e.g. taking a picture or rendering charts) uses this so
+#              that it can't hold up the control loops.
+#   events   - run func whenever one of these events fires. Any thread can fire an event with
+#              app_state['runtime']['notify'](event_name). For example the micro-controller's
+#              actuator task runs as soon as an actuator is switched (see openag_micro.py).
+#   stop     - optional. Called once after the event loop has stopped.
+#
+# Timers are coalesced: tasks with the same interval are aligned to the same clock ticks and every
+# task due within coalesce_window seconds of the earliest one is run in the same wakeup. The loop
+# thread sleeps until the next task is due so an idle fopd does not wake up once a second per
+# resource. Blocking work runs on a small pool of max_workers threads (default 2), except for the
+# tasks that name a pool of their own, and a task is never run concurrently with itself.
+#
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from heapq import heappush, heappop
+from itertools import count
+from math import ceil
+from sys import exc_info
+
+from python.logger import get_sub_logger
+from python.stop import request_stop
+
+logger = get_sub_logger(__name__)
+
+class EventLoopRuntime():
+
+    def __init__(self, app_state, config):
+
+        self.app_state = app_state
+        self.max_workers = config.get('max_workers', 2)
+        self.coalesce_window = config.get('coalesce_window', 0.5)
+
+        self.loop = None
+        self.wake_event = None
+        self.tasks = []
+        self.stop_funcs = []
+
+        # pool name -> ThreadPoolExecutor for the tasks that name a pool.
+        self.pools = {}
+
+        # heap of (due time, sequence number, task)
+        self.timers = []
+        self.sequence = count()
+
+        self.wakeups = 0
+
+        app_state['runtime'] = {'notify':self.notify, 'status':self.status}
+
+    def notify(self, event):
+        """ Fire an event. Safe to call from any thread. """
+
+        if self.loop and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.fire_event, event)
+
+    def status(self):
+
+        s = 'event loop wakeups: {}, worker threads: {}\n'.format(self.wakeups, self.max_workers)
+        for t in self.tasks:
+            s = s + '{}: interval {}, pool {}, runs {}, failures {}, skipped {}\n'.format(
+                    t['name'], t['interval'], t['pool'], t['runs'], t['failures'], t['skipped'])
+        return s
+
+    def add_tasks(self, tasks):
+
+        for t in tasks:
+            self.tasks.append({'name':t['name'], 'interval':t.get('interval'), 'func':t['func'],
+                               'blocking':t.get('blocking', True), 'events':t.get('events', ()),
+                               'pool':t.get('pool'),
+                               'run_at_start':t.get('run_at_start', False),
+                               'due':None, 'running':False, 'event_pending':False, 'runs':0, 'failures':0,
+                               'skipped':0})
+
+    def init_resources(self, resources):
+
+        # Initialize the resources in parallel because some of them (e.g. the micro-controller)
+        # take several seconds to start and the other resources are waiting at the barrier.
+        with ThreadPoolExecutor(max_workers=max(1, len(resources))) as init_pool:
+
+            futures = [(r, init_pool.submit(r['module'].schedule, self.app_state, r['args'])) for r in resources]
+
+            for r, f in futures:
+                try:
+                    result = f.result()
+                    self.add_tasks(result.get('tasks', []))
+                    if result.get('stop'):
+                        self.stop_funcs.append(result['stop'])
+                    logger.info('{} will run on the event loop'.format(r['args']['name']))
+                except:
+                    logger.error('cannot initialize resource {}: {}, {}'.format(r['args']['name'],
+                                 exc_info()[0], exc_info()[1]))
+
+    def schedule_task(self, task, delay=None):
+
+        now = self.loop.time()
+
+        if delay is not None:
+            task['due'] = now + delay
+        elif task['due'] is None and task['interval']:
+            # Align the first run to the interval so that tasks with the same interval share wakeups.
+            task['due'] = ceil(now / task['interval']) * task['interval']
+        elif task['interval']:
+            # Stay on the interval grid. If the task ran late then skip the ticks that were missed.
+            task['due'] = task['due'] + task['interval'] * max(1, ceil((now - task['due']) / task['interval']))
+        else:
+            task['due'] = None
+            return
+
+        heappush(self.timers, (task['due'], next(self.sequence), task))
+        self.wake_event.set()
+
+    def call_task(self, task):
+
+        try:
+            return task['func']()
+        except:
+            task['failures'] += 1
+            logger.error('task {} failed: {}, {}'.format(task['name'], exc_info()[0], exc_info()[1]))
+            return None
+
+    def task_done(self, task, result, timer_run):
+
+        task['running'] = False
+        task['runs'] += 1
+
+        if not isinstance(result, (int, float)) or isinstance(result, bool):
+            result = None
+
+        # Only timer driven runs put the task back on the timer heap. Event driven runs leave
+        # the task's existing timer alone.
+        if timer_run and not self.app_state['stop']:
+            self.schedule_task(task, result)
+
+        # An event fired while the task was running. Run it again so that the event is not lost.
+        if task['event_pending'] and not self.app_state['stop']:
+            task['event_pending'] = False
+            self.start_task(task, False)
+
+    def start_task(self, task, timer_run):
+
+        if task['running']:
+            if timer_run:
+                task['skipped'] += 1
+                logger.debug('task {} is still running, skipping this run'.format(task['name']))
+                self.schedule_task(task)
+            else:
+                task['event_pending'] = True
+            return
+
+        task['running'] = True
+
+        if task['blocking']:
+            future = self.loop.run_in_executor(self.pools.get(task['pool']), self.call_task, task)
+            future.add_done_callback(lambda f: self.task_done(task, f.result(), timer_run))
+        else:
+            self.task_done(task, self.call_task(task), timer_run)
+
+    def fire_event(self, event):
+
+        for t in self.tasks:
+            if event in t['events']:
+                self.start_task(t, False)
+
+    def wake(self):
+        self.wake_event.set()
+
+    def wake_on_stop(self):
+        """ stop callback - Safe to call from any thread. """
+
+        if self.loop and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.wake)
+
+    async def run_timers(self):
+
+        self.wake_event = asyncio.Event()
+
+        for t in self.tasks:
+            if t['run_at_start']:
+                self.schedule_task(t, 0)
+            elif t['interval']:
+                self.schedule_task(t)
+
+        while not self.app_state['stop']:
+
+            if self.timers:
+                delay = self.timers[0][0] - self.loop.time()
+            else:
+                delay = None
+
+            if delay is None or delay > 0:
+                self.wake_event.clear()
+                try:
+                    await asyncio.wait_for(self.wake_event.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+
+            self.wakeups += 1
+
+            # Run every task that is due now or within the coalesce window. Collect them before starting
+            # any of them so that a task that reschedules itself inside the window waits for the next wakeup.
+            horizon = self.loop.time() + self.coalesce_window
+            due_tasks = []
+
+            while self.timers and self.timers[0][0] <= horizon:
+                due, seq, task = heappop(self.timers)
+                if task['due'] == due:
+                    due_tasks.append(task)
+                # else the task was rescheduled after this timer was set.
+
+            for task in due_tasks:
+                if not self.app_state['stop']:
+                    self.start_task(task, True)
+
+    def run(self, resources, barrier):
+        """ Thread target. resources is a list of {'module':m, 'args':args} """
+
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        self.app_state['stop_callbacks'].append(self.wake_on_stop)
+
+        self.init_resources(resources)
+
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        self.loop.set_default_executor(executor)
+
+        for t in self.tasks:
+            if t['blocking'] and t['pool'] and t['pool'] not in self.pools:
+                self.pools[t['pool']] = ThreadPoolExecutor(max_workers=1)
+
+        # Let the system know that you are good to go.
+        try:
+            barrier.wait()
+        except Exception as err:
+            # assume a broken barrier
+            logger.error('barrier error: {}'.format(str(err)))
+            request_stop(self.app_state)
+
+        logger.info('event loop runtime starting {} tasks with {} worker threads'.format(len(self.tasks), self.max_workers))
+
+        try:
+            self.loop.run_until_complete(self.run_timers())
+        finally:
+            executor.shutdown(wait=True)
+            for p in self.pools.values():
+                p.shutdown(wait=True)
+            self.loop.close()
+
+        for f in self.stop_funcs:
+            try:
+                f()
+            except:
+                logger.error('resource stop function failed: {}, {}'.format(exc_info()[0], exc_info()[1]))
+
+        logger.info('event loop runtime stopping')
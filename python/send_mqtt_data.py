@@ -4,6 +4,7 @@
 
 from sys import path, exc_info
 import datetime
+from json import dumps
 from python.logger import get_sub_logger 
 from logging import getLogger
 
@@ -20,7 +21,7 @@ def send_sensor_data_via_mqtt_v2(s, mqtt_client, organization_id):
                     '"subject":"'             + s['subject'] + '", '\
                     '"subject_location_id":"' + s['subject_location_id'] + '", '\
                     '"attribute":"'           + s['attribute'] + '", '\
-                    '"value":"'               + s['value'] + '", '\
+                    '"value":"'               + str(s['value']) + '", '\
                     '"units":"'               + s['units'] + '", '\
                     '"time":"'                + datetime.datetime.utcfromtimestamp(s['ts']).isoformat() + '"}'
   
@@ -42,30 +43,118 @@ def make_sensor_reading_payload(sr):
         if sr['units']:
             units = sr['units']
 
-        return  '{"sensor":"'             + sr['device_name'] + '", '\
-                '"device_id":"'           + sr['device_id'] + '", '\
-                '"subject":"'             + sr['subject'] + '", '\
-                '"subject_location_id":"' + sr['subject_location_id'] + '", '\
-                '"attribute":"'           + sr['attribute'] + '", '\
-                '"value":"'               + sr['value'] + '", '\
-                '"units":"'               + units + '", '\
-                '"time":"'                + datetime.datetime.utcfromtimestamp(sr['ts']).isoformat() + '"}'
+        # The v1 payload carries every value as a string.
+        return dumps({'sensor':sr['device_name'], 'device_id':sr['device_id'], 'subject':sr['subject'],
+                      'subject_location_id':sr['subject_location_id'], 'attribute':sr['attribute'],
+                      'value':str(sr['value']), 'units':units,
+                      'time':datetime.datetime.utcfromtimestamp(sr['ts']).isoformat()},
+                     separators=(', ', ':'))
     except:
         logger.error('exception occurred creating mqtt topic for sensor reading: {}, error: {}{}'.format(\
                       sr, exc_info()[0], exc_info()[1]))
 
-def publish_mqtt_topic(mqtt_client, topic, payload_value):
+# data/v2 payloads carry all the readings of one data logger sample in a single message.
+# The payload is columnar json:
+#
+#   {"schema":"fopd.readings.columnar.1", "ts":1538000000.0,
+#    "common":{"sensor":"arduino", "device_id":"..."},
+#    "columns":{"subject":["air", "air"], "attribute":["humidity", "temperature"], "value":[40.1, 22.5],
+#               "units":["Percentage", "Celsius"], "subject_location_id":[...], "dt":[0.0, 0.0]}}
+#
+# ts is the earliest reading time (seconds since the unix epoch, UTC) and dt holds each reading's
+# offset from it. Fields that have the same value for every reading are sent once in common.
+#
+readings_v2_schema_id = 'fopd.readings.columnar.1'
+readings_v2_fields = ('device_name', 'device_id', 'subject', 'subject_location_id', 'attribute', 'units')
+readings_v2_field_names = {'device_name':'sensor'}
+
+def make_sensor_readings_payload_v2(readings):
 
-   result = mqtt_client.publish(topic, payload=payload_value, qos=2)
+    try:
+        ts = min([r['ts'] for r in readings])
+
+        common = {}
+        columns = {}
+
+        for f in readings_v2_fields:
+            col = [r[f] for r in readings]
+            if col.count(col[0]) == len(col):
+                common[readings_v2_field_names.get(f, f)] = col[0]
+            else:
+                columns[readings_v2_field_names.get(f, f)] = col
+
+        columns['value'] = [r['value'] for r in readings]
+        columns['dt'] = [round(r['ts'] - ts, 3) for r in readings]
+
+        return dumps({'schema':readings_v2_schema_id, 'ts':ts, 'common':common, 'columns':columns}, 
+                     separators=(',', ':'))
+    except:
+        logger.error('exception occurred creating mqtt payload for sensor readings: {}, error: {}{}'.format(\
+                      readings, exc_info()[0], exc_info()[1]))
+
+# rollup/v1 payloads carry the rollups of one data logger interval:
+#
+#   {"schema":"fopd.readings.rollup.1", "start":1538000000.0, "end":1538001200.0,
+#    "rollups":[{"sensor":"arduino", "device_id":"...", "subject":"air", "subject_location_id":"...",
+#                "attribute":"temperature", "units":"Celsius", "count":1200, "missing":0, "min":21.2,
+#                "max":24.9, "mean":22.7, "stddev":0.8, "last":22.5}, ...]}
+#
+rollup_schema_id = 'fopd.readings.rollup.1'
+rollup_fields = ('device_id', 'subject', 'subject_location_id', 'attribute', 'units', 'count', 'missing',
+                 'min', 'max', 'mean', 'stddev', 'last')
+
+def make_rollups_payload(rollups):
+
+    try:
+        payload_rollups = []
+        for r in rollups:
+            pr = {'sensor':r['device_name']}
+            for f in rollup_fields:
+                pr[f] = r[f]
+            payload_rollups.append(pr)
+
+        return dumps({'schema':rollup_schema_id, 'start':min([r['start'] for r in rollups]),
+                      'end':max([r['end'] for r in rollups]), 'rollups':payload_rollups},
+                     separators=(',', ':'))
+    except:
+        logger.error('exception occurred creating mqtt payload for rollups: {}, error: {}{}'.format(\
+                      rollups, exc_info()[0], exc_info()[1]))
+
+def publish_mqtt_topic(mqtt_client, topic, payload_value, qos=2):
+
+   result = mqtt_client.publish(topic, payload=payload_value, qos=qos)
    logger.info('published topic: {}'.format(topic))
    return result
 
-def publish_sensor_reading(mqtt_client, org_id, sensor_reading):
+# The publish functions return None, without publishing anything, if the payload can't be made
+# (the make_xxx_payload functions log why) so that the caller does not treat the data as sent.
+#
+def publish_sensor_reading(mqtt_client, org_id, sensor_reading, qos=2):
+
+    payload = make_sensor_reading_payload(sensor_reading)
+    if payload is None:
+        return None
+
+    return publish_mqtt_topic(mqtt_client, 'data/v1/' + org_id, payload, qos)
+
+def publish_sensor_readings(mqtt_client, org_id, sensor_readings, qos=2):
+
+    payload = make_sensor_readings_payload_v2(sensor_readings)
+    if payload is None:
+        return None
+
+    return publish_mqtt_topic(mqtt_client, 'data/v2/' + org_id, payload, qos)
+
+def publish_sensor_rollups(mqtt_client, org_id, rollups, qos=2):
+
+    payload = make_rollups_payload(rollups)
+    if payload is None:
+        return None
 
-    publish_mqtt_topic(mqtt_client, 'data/v1/' + org_id, make_sensor_reading_payload(sensor_reading))
+    return publish_mqtt_topic(mqtt_client, 'rollup/v1/' + org_id, payload, qos)
 
-def publish_cmd_response(mqtt_client, org_id, response):
+def publish_cmd_response(mqtt_client, org_id, response, qos=2):
 
     # TODO: Need to implement /cr/v2/[client_id] publishing. See note about ACLs
     #       elsewhere in this file.
-    publish_mqtt_topic(mqtt_client, 'cr/v1/' + org_id, response)
+    return publish_mqtt_topic(mqtt_client, 'cr/v1/' + org_id, response, qos)
@@ -0,0 +1,17 @@
+from sys import exc_info
+
+from python.logger import get_sub_logger 
+
+logger = get_sub_logger(__name__)
+
+def request_stop(app_state):
+    """ Tell fopd to stop. Sets app_state['stop'] and calls the stop callbacks so that resources
+        that block waiting for work (e.g. on a queue) wake up and see the stop flag. """
+
+    app_state['stop'] = True
+
+    for stop_callback in app_state.get('stop_callbacks', []):
+        try:
+            stop_callback()
+        except:
+            logger.error('stop callback failed: {}, {}'.format(exc_info()[0], exc_info()[1]))
@@ -0,0 +1,131 @@
+# Time-lapse videos of the camera archive.
+#
+# The pictures in the camera picture directory are named after the (UTC) time they were taken,
+# e.g. 20181017_14_00_05.jpg, so a time range is selected by comparing names. start and end are
+# name prefixes: '20181017' is midnight at the start of October 17th, '20181017_12' is noon.
+#
+# The pictures are piped through one ffmpeg process, one file at a time in fixed size chunks,
+# so memory use stays flat no matter how many pictures there are. The video is named after the
+# start of its time range so that it can be handed to the camera subscribers like a picture
+# (e.g. FopCloudStorage uploads it).
+#
+
+from os import listdir, makedirs, path, remove, replace
+from subprocess import DEVNULL, PIPE, Popen
+from sys import exc_info
+from tempfile import TemporaryFile
+from time import time
+
+from python.logger import get_sub_logger
+
+logger = get_sub_logger(__name__)
+
+read_chunk_size = 64 * 1024
+
+# ffmpeg output options for each video format.
+encoder_options = {'mp4': ['-c:v', 'libx264', '-pix_fmt', 'yuv420p', '-vf', 'scale=trunc(iw/2)*2:trunc(ih/2)*2',
+                           '-movflags', '+faststart', '-f', 'mp4'],
+                   'webp':['-c:v', 'libwebp', '-loop', '0', '-f', 'webp']}
+
+def pad_time(t):
+    """ Expand a picture name prefix (e.g. '20181017') to a full picture time (20181017_00_00_00). """
+    return t + '00000000_00_00_00'[len(t):]
+
+def archived_pictures(directory, start, end=None):
+    """ Return the paths of the pictures taken from start up to (but not including) end, oldest first. """
+
+    return [path.join(directory, n) for n in sorted(listdir(directory))
+            if n.endswith('.jpg') and n >= start and (end is None or n < end)]
+
+def build_timelapse(pictures, dest, fps=10, video_format='mp4'):
+    """ Encode the pictures into a video at dest. Returns dest or None if the video could not be made. """
+
+    if not pictures:
+        logger.warning('there are no pictures for time-lapse {}'.format(dest))
+        return None
+
+    tmp = dest + '.tmp'
+    cmd = ['ffmpeg', '-y', '-loglevel', 'error', '-f', 'image2pipe', '-framerate', str(fps), '-c:v', 'mjpeg',
+           '-i', '-'] + encoder_options[video_format] + [tmp]
+
+    try:
+        with TemporaryFile() as errors:
+
+            encoder = Popen(cmd, stdin=PIPE, stdout=DEVNULL, stderr=errors)
+
+            try:
+                for p in pictures:
+                    try:
+                        with open(p, 'rb') as f:
+                            for chunk in iter(lambda: f.read(read_chunk_size), b''):
+                                encoder.stdin.write(chunk)
+                    except FileNotFoundError:
+                        # The picture was deleted (e.g. by the daily clean up) after the list was made.
+                        logger.warning('picture {} no longer exists, skipping it'.format(p))
+            except BrokenPipeError:
+                # ffmpeg has exited. Its error is logged below.
+                pass
+            finally:
+                # Always reap ffmpeg, even if it exited early and closing its input fails.
+                try:
+                    encoder.stdin.close()
+                except BrokenPipeError:
+                    pass
+                returncode = encoder.wait()
+
+            if returncode != 0:
+                errors.seek(0)
+                logger.error('ffmpeg failed (return code {}) making time-lapse {}: {}'.format(returncode, dest,
+                             errors.read().decode('utf-8', 'replace')))
+                if path.exists(tmp):
+                    remove(tmp)
+                return None
+
+        replace(tmp, dest)
+        logger.info('made time-lapse {} from {} pictures'.format(dest, len(pictures)))
+        return dest
+
+    except:
+        logger.error('cannot make time-lapse {}: {}, {}'.format(dest, exc_info()[0], exc_info()[1]))
+        if path.exists(tmp):
+            remove(tmp)
+        return None
+
+def delete_old_timelapses(timelapse_directory, max_day_age):
+    """ Delete the videos in timelapse_directory that are more than max_day_age days old. """
+
+    if not path.isdir(timelapse_directory):
+        return
+
+    oldest = time() - max_day_age * 24 * 60 * 60
+
+    for n in listdir(timelapse_directory):
+        p = path.join(timelapse_directory, n)
+        try:
+            if path.isfile(p) and path.getmtime(p) < oldest:
+                remove(p)
+                logger.info('deleted old time-lapse {}'.format(p))
+        except:
+            logger.error('cannot delete time-lapse {}: {}, {}'.format(p, exc_info()[0], exc_info()[1]))
+
+def make_timelapse(picture_directory, timelapse_directory, start, end=None, fps=10, video_format='mp4'):
+    """ Make a time-lapse of the pictures taken from start up to end. Returns its path or None. """
+
+    if video_format not in encoder_options:
+        logger.error('unknown time-lapse format {}. Please specify one of {}.'.format(video_format,
+                     list(encoder_options.keys())))
+        return None
+
+    try:
+        makedirs(timelapse_directory, exist_ok=True)
+        pictures = archived_pictures(picture_directory, start, end)
+    except OSError:
+        logger.error('cannot make time-lapse: {}, {}'.format(exc_info()[0], exc_info()[1]))
+        return None
+
+    name = pad_time(start)
+    if end:
+        name = name + '_to_' + end
+
+    return build_timelapse(pictures, path.join(timelapse_directory, '{}.{}'.format(name, video_format)), fps,
+                           video_format)
@@ -1,15 +1,36 @@
+# Web chart generator
+#
+# Optional args:
+#   chart_points  - the number of readings shown on each chart (default 60).
+#   render_mode   - 'interval' (default) renders every chart to web/static every charting_interval seconds.
+#                   'on_demand' only renders a chart when the local web server asks for it.
+#   chart_ttl     - on_demand mode: a chart that was checked for new readings less than this many seconds
+#                   ago is served as is (default 60).
+#   chart_workers - on_demand mode: the number of charts that are rendered at the same time (default 2).
+#
+# Each chart caches its readings so that only new readings are fetched from couchdb and the
+# chart is only rendered again when there are new readings (see python/generate_chart.py).
+#
+# Writes the following app_state variables:
+#   app_state[name]['chart_list']
+#   app_state[name]['get_chart']      - on_demand mode only. get_chart(chart_file_name) returns (svg, version).
+#   app_state[name]['refresh_charts'] - on_demand mode only. Start refreshing every chart that is out of date.
+#
+
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 #- from subprocess import check_call, CalledProcessError
 from subprocess import CalledProcessError
-from sys import path
-from time import sleep, time
+from sys import exc_info, path
+from threading import Lock
+from time import monotonic, sleep, time
 
-from python.generate_chart import generate_chart
+from python.generate_chart import generate_chart, render_chart
 from python.logger import get_sub_logger 
 
 logger = get_sub_logger(__name__)
 
-def start(app_state, args, b):
+def init(app_state, args):
 
    logger.info('starting web chart generator controller')
    logger.setLevel(args['log_level'])
@@ -19,34 +40,123 @@ def start(app_state, args, b):
    # Set the intial timestamp to 0 thus forcing a web chart generation at start up.
    state = {'last_charting_ts':0, 'last_chart_generation_date':None}
 
-   # Let the system know that you are good to go.
-   b.wait()
+   if args.get('render_mode', 'interval') == 'on_demand':
+      state['pool'] = ThreadPoolExecutor(max_workers=args.get('chart_workers', 2))
+      app_state[args['name']]['get_chart'], app_state[args['name']]['refresh_charts'] = \
+         make_on_demand_charts(args, state)
 
-   while not app_state['stop']:
+   return state
 
-      this_ts = time()
+def make_on_demand_charts(args, state):
+
+   charts = {}
+   for chart_info in args['chart_list']:
+      charts[chart_info['chart_file_name']] = {'info':chart_info, 'svg':None, 'version':None,
+                                               'checked':None, 'future':None}
+   lock = Lock()
+
+   def refresh(chart):
+
+      svg, version = render_chart(args['couchdb_location_url'], chart['info'], logger, args.get('chart_points', 60))
+
+      with lock:
+         if svg is not None:
+            chart['svg'] = svg
+            chart['version'] = version
+            logger.info('rendered {}'.format(chart['info']['chart_file_name']))
+         chart['checked'] = monotonic()
+         chart['future'] = None
+
+   # Call while holding lock. Returns the future of the chart's refresh or None if the chart is up to date.
+   def start_refresh(chart):
 
-      if this_ts - state['last_charting_ts'] > args['charting_interval']:
+      if chart['future'] is None and \
+         (chart['checked'] is None or monotonic() - chart['checked'] > args.get('chart_ttl', 60)):
+         chart['future'] = state['pool'].submit(refresh, chart)
 
-         # Generate the charts
-         # Figure out how the script directory is getting put in the path. Or in other words
-         # how does the system find this command file.
-         # Need to make location of the render.sh script a config file setting.
+      return chart['future']
 
+   def refresh_charts():
+
+      with lock:
+         for chart in charts.values():
+            start_refresh(chart)
+
+   def get_chart(chart_file_name):
+
+      chart = charts.get(chart_file_name)
+      if chart is None:
+         return None, None
+
+      with lock:
+         future = start_refresh(chart)
+
+      if future is not None:
          try:
+            future.result(timeout=30)
+         except:
+            logger.error('chart {} is not ready: {}, {}'.format(chart_file_name, exc_info()[0], exc_info()[1]))
+
+      with lock:
+         return chart['svg'], chart['version']
+
+   return get_chart, refresh_charts
+
+def stop(state):
+
+   if 'pool' in state:
+      state['pool'].shutdown(wait=False)
+
+   logger.info('shutting down chart generator')
+
+def make_charts(args, state, this_ts):
+
+   # Generate the charts
+   # Figure out how the script directory is getting put in the path. Or in other words
+   # how does the system find this command file.
+   # Need to make location of the render.sh script a config file setting.
+
+   try:
+
+      for chart_info in args['chart_list']:
+
+         generate_chart(args['couchdb_location_url'], chart_info, logger, args.get('chart_points', 60))
+
+      state['last_charting_ts'] = this_ts
+      state['last_chart_generation_date'] = datetime.now()
+
+      logger.info('Created new web charts.')
+
+   except CalledProcessError as e:
+      logger.error('render.sh call failed with the following results:{}'.format(e))
+
+# Event loop runtime entry point. See python/runtime.py
+def schedule(app_state, args):
 
-            for chart_info in args['chart_list']:
+   state = init(app_state, args)
 
-               generate_chart(args['couchdb_location_url'], chart_info, logger)
+   if 'pool' in state:
+      return {'tasks':[], 'stop':lambda: stop(state)}
 
-            state['last_charting_ts'] = this_ts
-            state['last_chart_generation_date'] = datetime.now()
+   return {'tasks':[{'name':args['name'], 'interval':args['charting_interval'], 'run_at_start':True, 'pool':'charts',
+                     'func':lambda: make_charts(args, state, time())}],
+           'stop':lambda: stop(state)}
 
-            logger.info('Created new web charts.')
+def start(app_state, args, b):
+
+   state = init(app_state, args)
+
+   # Let the system know that you are good to go.
+   b.wait()
 
-         except CalledProcessError as e:
-            logger.error('render.sh call failed with the following results:{}'.format(charting_results))
+   while not app_state['stop']:
+
+      this_ts = time()
+
+      # In on_demand mode the charts are rendered by the web server's requests.
+      if 'pool' not in state and this_ts - state['last_charting_ts'] > args['charting_interval']:
+         make_charts(args, state, this_ts)
 
       sleep(1)
 
-   logger.info('shutting down chart generator')
+   stop(state)
@@ -1,8 +1,17 @@
+from gzip import compress
+from json import dumps
+from math import ceil, isfinite
 from sys import exc_info
+from threading import Lock
+from time import monotonic, sleep, time
+from zlib import crc32
 
-from flask import Flask, render_template, __version__, make_response
+from flask import Flask, Response, g, render_template, __version__, make_response, request
+from werkzeug.serving import make_server, WSGIRequestHandler
 
+from python.event_stream import event_stream
 from python.logger import get_sub_logger 
+from python.stop import request_stop
 
 class fopdwFlask(Flask):
 
@@ -21,6 +30,110 @@ class fopdwFlask(Flask):
 
 logger = get_sub_logger(__name__)
 
+# Responses bigger than this are gzipped for clients that accept it.
+gzip_min_size = 512
+gzip_mimetypes = ('text/html', 'text/css', 'text/plain', 'application/javascript', 'application/json',
+                  'image/svg+xml')
+
+# Limit the number of points in a /v1/series response.
+max_series_points = 2000
+
+class KeepAliveRequestHandler(WSGIRequestHandler):
+
+    # HTTP/1.1 lets a browser fetch the page, its style sheet and its charts over one connection.
+    protocol_version = 'HTTP/1.1'
+
+def make_json_response(payload, etag):
+
+    resp = make_response(dumps(payload, separators=(',', ':')))
+    resp.headers['Content-Type'] = 'application/json'
+    resp.headers['Cache-Control'] = 'no-cache'
+    resp.set_etag(etag)
+
+    return resp
+
+# after_request hook - gzip compressible responses for clients that accept it.
+def gzip_response(resp):
+
+    if resp.status_code != 200 or resp.is_streamed or 'Content-Encoding' in resp.headers \
+       or resp.mimetype not in gzip_mimetypes:
+        return resp
+
+    resp.headers['Vary'] = 'Accept-Encoding'
+
+    if 'gzip' not in request.headers.get('Accept-Encoding', ''):
+        return resp
+
+    # Static files are sent straight from the file unless we ask for the data.
+    resp.direct_passthrough = False
+    body = resp.get_data()
+
+    if len(body) >= gzip_min_size:
+        resp.set_data(compress(body, 6))
+        resp.headers['Content-Encoding'] = 'gzip'
+
+    return resp
+
+def make_request_stats():
+    """ Return functions that record and show the number of requests and the response time of
+        each endpoint. Streamed responses (e.g. /v1/stream) are timed to their first byte. """
+
+    stats = {}
+    lock = Lock()
+
+    def before():
+        g.request_start = monotonic()
+
+    def after(resp):
+
+        if 'request_start' in g:
+            elapsed = monotonic() - g.request_start
+            endpoint = request.endpoint or 'not_found'
+            with lock:
+                s = stats.setdefault(endpoint, {'count':0, 'total':0.0, 'max':0.0})
+                s['count'] += 1
+                s['total'] += elapsed
+                s['max'] = max(s['max'], elapsed)
+
+        return resp
+
+    def show_stats():
+
+        with lock:
+            lines = ['{}: {} requests, mean {:.1f} ms, max {:.1f} ms'.format(
+                     e, s['count'], 1000 * s['total'] / s['count'], 1000 * s['max'])
+                     for e, s in sorted(stats.items())]
+
+        return '\n'.join(lines) if lines else 'no requests yet'
+
+    return before, after, show_stats
+
+def serve(app, app_state, args):
+    """ Run app on a threaded WSGI server until fopd stops. """
+
+    handler = type('FopdRequestHandler', (KeepAliveRequestHandler,), {'timeout':args.get('keepalive_timeout', 15)})
+
+    server = make_server(args['host'], args['port'], app, threaded=True, request_handler=handler)
+
+    # shutdown makes serve_forever return. It is called from the repl's exit command.
+    app_state['stop_callbacks'].append(server.shutdown)
+
+    logger.info('serving the local web site on {}:{}'.format(args['host'], args['port']))
+
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+def not_modified(etag):
+
+    if etag in request.if_none_match:
+        resp = make_response('', 304)
+        resp.set_etag(etag)
+        return resp
+
+    return None
+
 def start(app_state, args, barrier):
 
     '''
@@ -30,6 +143,25 @@ def start(app_state, args, barrier):
                        the name here (e.g. 'chart_list_source':'wc'). If there
                        are no charts available on this fopd then set this value to None
                        (e.g. 'chart_list_source':None)
+
+    readings_source:   The resource whose sensor readings are served by /v1/readings and
+                       /v1/series/<reading> (e.g. 'readings_source':'mc').
+
+    server_mode:       'development' (default) runs Flask's development server. 'production' runs a
+                       threaded WSGI server with HTTP keep-alive that stops when fopd stops.
+    keepalive_timeout: production mode: close idle browser connections after this many seconds
+                       (default 15).
+    static_max_age:    Browsers may cache static files (e.g. styles.css) for this many seconds
+                       (default 60).
+
+    stream_max_clients:  The most browsers that can watch /v1/stream at once (default 8).
+    stream_keepalive:    Send a keepalive comment after this many quiet seconds (default 15).
+    stream_min_interval: Wait at least this many seconds between stream messages so that bursts
+                         of changes are sent together (default 0.5).
+
+    Charts are served from /charts/<chart_file_name>. If the chart list source renders charts on
+    demand (see python/web_chart_controller.py) then the chart is rendered when it is requested,
+    otherwise the chart file in web/static is served.
     '''
 
     #TODO - add authentication to the application.
@@ -37,12 +169,29 @@ def start(app_state, args, barrier):
     logger.info('starting Flask version {}'.format(__version__))
 
     app = fopdwFlask(__name__)
+    app.config['SEND_FILE_MAX_AGE_DEFAULT'] = args.get('static_max_age', 60)
+
+    # Flask runs the after_request functions in the reverse order of registration so the
+    # request time includes the compression time.
+    before_request, after_request, show_stats = make_request_stats()
+    app.before_request(before_request)
+    app.after_request(after_request)
+    app.after_request(gzip_response)
+
+    app_state[args['name']] = {'stats':show_stats}
+    app_state[args['name']]['help'] = lambda: '{0}.help()  - Displays this help page.\n'\
+                                              '{0}.stats() - Show the number of requests and the response time of each page.\n'.format(args['name'])
 
     @app.route('/')
     def home():
 
-        if args['chart_list_source']:
+        if args.get('chart_list_source'):
             cl = app_state[args['chart_list_source']]['chart_list']
+
+            # Start rendering the charts now, in parallel, so that they are ready (or nearly so)
+            # when the browser asks for them.
+            if 'refresh_charts' in app_state[args['chart_list_source']]:
+                app_state[args['chart_list_source']]['refresh_charts']()
         else:
             cl = [] 
         resp = make_response(render_template('home.html', 
@@ -51,6 +200,123 @@ def start(app_state, args, barrier):
         resp.headers['Cache-Control'] = 'max-age:0, must-revalidate'
         return resp
 
+    @app.route('/charts/<chart_file_name>')
+    def chart(chart_file_name):
+
+        if not (args.get('chart_list_source') and 'get_chart' in app_state[args['chart_list_source']]):
+            return app.send_static_file(chart_file_name)
+
+        svg, version = app_state[args['chart_list_source']]['get_chart'](chart_file_name)
+
+        if svg is None:
+            return make_response('chart {} is not available'.format(chart_file_name), 404)
+
+        resp = make_response(svg)
+        resp.headers['Content-Type'] = 'image/svg+xml'
+        resp.headers['Cache-Control'] = 'no-cache'
+        resp.set_etag(str(version))
+        return resp.make_conditional(request)
+
+    # The current value of every reading.
+    @app.route('/v1/readings')
+    def readings():
+
+        if not args.get('readings_source') or args['readings_source'] not in app_state:
+            return make_response('no readings source is configured', 404)
+
+        table = app_state[args['readings_source']]['sensor_readings']
+
+        # The table's sequence number changes whenever a reading does.
+        etag = 'r{}'.format(table.seq)
+        resp = not_modified(etag)
+        if resp:
+            return resp
+
+        records, seq = table.snapshot()
+
+        return make_json_response({'readings':[{'name':table.name_of(i), 'subject':r['subject'],
+                                                'attribute':r['attribute'], 'value':r['value'],
+                                                'units':r['units'], 'ts':r['ts']}
+                                               for i, r in enumerate(records)]},
+                                  etag)
+
+    # The history of one reading as [time stamp, value] pairs. from and to are unix time stamps and
+    # default to the last hour. If step (seconds) is given then the values are averaged over
+    # step wide buckets.
+    @app.route('/v1/series/<reading>')
+    def series(reading):
+
+        if not args.get('readings_source') or 'history' not in app_state.get(args['readings_source'], {}):
+            return make_response('no reading history is available', 404)
+
+        source = app_state[args['readings_source']]
+
+        try:
+            end = float(request.args.get('to', time()))
+            start = float(request.args.get('from', end - 3600))
+            step = request.args.get('step')
+            if not isfinite(start) or not isfinite(end) or (step is not None and not (isfinite(float(step)) and float(step) > 0)):
+                return make_response('from, to and step must be numbers', 400)
+            points = None
+            if step is not None:
+                points = int(ceil((end - start) / float(step)))
+                if points <= 0 or points > max_series_points:
+                    return make_response('step must split from - to into 1 to {} points'.format(max_series_points), 400)
+        except ValueError:
+            return make_response('from, to and step must be numbers', 400)
+
+        # The response only changes when a reading is updated. (A window that defaults to the last
+        # hour also slides with the clock but the readings are updated far more often than that matters.)
+        etag = 's{}-{:x}'.format(source['sensor_readings'].seq, crc32(request.full_path.encode('utf-8')))
+        resp = not_modified(etag)
+        if resp:
+            return resp
+
+        values = source['history'](reading, start=start, end=end, points=points)
+
+        if isinstance(values, str):
+            # unknown reading
+            return make_response(values, 404)
+
+        return make_json_response({'reading':reading, 'from':start, 'to':end, 'step':None if step is None else float(step),
+                                   'values':values},
+                                  etag)
+
+    # Server-sent events stream of reading and actuator changes. See python/event_stream.py
+    @app.route('/v1/stream')
+    def stream():
+
+        if args.get('readings_source') in app_state:
+            event_stream.watch_table(args['readings_source'], app_state[args['readings_source']]['sensor_readings'])
+
+        client = event_stream.subscribe(args.get('stream_max_clients', 8))
+
+        if client is None:
+            return make_response('too many stream clients', 503)
+
+        def generate():
+
+            try:
+                yield 'retry: 5000\n\n'
+
+                while not app_state['stop'] and not client.closed:
+
+                    events = client.take(args.get('stream_keepalive', 15))
+
+                    if events:
+                        yield ''.join(['event: {}\ndata: {}\n\n'.format(name, dumps(data, separators=(',', ':')))
+                                       for name, data in events])
+                    else:
+                        yield ': keepalive\n\n'
+
+                    sleep(args.get('stream_min_interval', 0.5))
+            finally:
+                event_stream.unsubscribe(client)
+
+        resp = Response(generate(), mimetype='text/event-stream')
+        resp.headers['Cache-Control'] = 'no-cache'
+        return resp
+
     @app.route('/config.html')
     def config():
         return make_response(render_template('config.html'))
@@ -61,21 +327,29 @@ def start(app_state, args, barrier):
         return make_response(app_state['mqtt']['status']())
 
 
+    # Release the stream clients when fopd stops.
+    app_state['stop_callbacks'].append(event_stream.close)
+
     # Let the system know that you are good to go.
     try:
         barrier.wait()
     except Exception as err:
         # assume a broken barrier
         logger.error('barrier error: {}'.format(str(err)))
-        app_state['stop'] = True
+        request_stop(app_state)
 
     # Start the Flask application. Note: app.run does not return.
     if not app_state['stop']:
 
         try:
-           app.run(host=args['host'], port=args['port'])
+           if args.get('server_mode', 'development') == 'production':
+               serve(app, app_state, args)
+           else:
+               app.run(host=args['host'], port=args['port'])
         except:
-           logger.error('Local web server has crashed: {}'.format(exc_info()[0], exc_info()[1]))
+           logger.error('Local web server has crashed: {}, {}'.format(exc_info()[0], exc_info()[1]))
 
-
-        logger.error('fopd will continue running, however the local webserver has stoppped')
+        if app_state['stop']:
+            logger.info('local web server stopped')
+        else:
+            logger.error('fopd will continue running, however the local webserver has stoppped')